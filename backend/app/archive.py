@@ -0,0 +1,345 @@
+import asyncio
+import bisect
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, select, text
+from app.cache import TTLCache
+from app.db import SessionLocal, engine
+from app.encoding import loads
+from app.log import get_logger
+from app.messaging import MESSAGE_COLUMNS, encode_message
+from app.models import Message
+
+logger = get_logger(__name__)
+
+# Messages older than this many days are moved out of the messages table
+# into the archive (0 disables the archiver; archived history stays readable)
+MESSAGE_ARCHIVE_AFTER_DAYS = float(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS", "0"))
+# Segment files live here, one per chat. Every worker on every host must
+# see the same directory: rows are deleted from the database once archived
+MESSAGE_ARCHIVE_DIR = os.getenv("MESSAGE_ARCHIVE_DIR", "./archive")
+# Set to true to confirm MESSAGE_ARCHIVE_DIR is storage shared by all hosts
+# (or that there is only one); the archiver refuses to start otherwise
+MESSAGE_ARCHIVE_SHARED = os.getenv("MESSAGE_ARCHIVE_SHARED", "false").lower() == "true"
+# zstd (needs the zstandard package) or zlib; stored per chunk, so it can
+# be changed without rewriting existing segments
+MESSAGE_ARCHIVE_CODEC = os.getenv("MESSAGE_ARCHIVE_CODEC", "zstd")
+MESSAGE_ARCHIVE_ZSTD_LEVEL = int(os.getenv("MESSAGE_ARCHIVE_ZSTD_LEVEL", "9"))
+# Messages per compressed chunk; the sparse index has one entry per chunk
+MESSAGE_ARCHIVE_CHUNK = int(os.getenv("MESSAGE_ARCHIVE_CHUNK", "256"))
+# Messages moved per archiver run, committed per chat in slices of this size
+MESSAGE_ARCHIVE_BATCH = int(os.getenv("MESSAGE_ARCHIVE_BATCH", "10000"))
+MESSAGE_ARCHIVE_INTERVAL = float(os.getenv("MESSAGE_ARCHIVE_INTERVAL", "3600"))
+# Decompressed chunks kept for readers paging through old history
+MESSAGE_ARCHIVE_CHUNK_CACHE = int(os.getenv("MESSAGE_ARCHIVE_CHUNK_CACHE", "256"))
+# Per-chat boundaries kept in memory for request handlers, and how long one
+# is trusted before the index is looked at again (archiver runs on other
+# hosts become visible after at most this long)
+MESSAGE_ARCHIVE_BOUNDARY_CACHE = int(os.getenv("MESSAGE_ARCHIVE_BOUNDARY_CACHE", "100000"))
+MESSAGE_ARCHIVE_BOUNDARY_TTL = float(os.getenv("MESSAGE_ARCHIVE_BOUNDARY_TTL", "60"))
+
+CODECS = {"zstd": 1, "zlib": 2}
+
+# Sparse index entry: first id, last id, offset and length in the segment,
+# message count, codec
+_ENTRY = struct.Struct("<qqQIIB7x")
+
+
+def _compress(codec: int, data: bytes) -> bytes:
+    if codec == CODECS["zstd"]:
+        import zstandard
+        return zstandard.ZstdCompressor(level=MESSAGE_ARCHIVE_ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(codec: int, data: bytes) -> bytes:
+    if codec == CODECS["zstd"]:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class MessageArchive:
+    """Append-only, compressed per-chat segment files for old messages.
+
+    Each chat has a segment of compressed chunks, every chunk holding up to
+    ``chunk`` consecutive messages as JSON lines in the MessageOut
+    encoding, and an index with one fixed-size entry per chunk. A chunk is
+    written and synced before its index entry, so a crash leaves at most
+    unreferenced bytes at the end of a segment. Each chat's archive is a
+    prefix of its history: everything up to ``boundary()`` is here, newer
+    messages are in the database.
+
+    Without shared storage (``enabled`` false) nothing can have been
+    archived, so ``current_boundary()`` answers 0 without touching the disk.
+    """
+
+    def __init__(self, root: str = MESSAGE_ARCHIVE_DIR, codec: str = MESSAGE_ARCHIVE_CODEC,
+                 chunk: int = MESSAGE_ARCHIVE_CHUNK, chunk_cache: int = MESSAGE_ARCHIVE_CHUNK_CACHE,
+                 enabled: bool = MESSAGE_ARCHIVE_SHARED):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown archive codec: {codec}")
+        self.root = root
+        self.codec = CODECS[codec]
+        self.chunk = chunk
+        self.enabled = enabled
+        self._indexes = {}  # chat_id -> (index file size, entries)
+        self._lock = threading.Lock()
+        # Chunks never change once written
+        self._chunks = TTLCache(chunk_cache, ttl=3600)
+        self._boundaries = TTLCache(MESSAGE_ARCHIVE_BOUNDARY_CACHE, ttl=MESSAGE_ARCHIVE_BOUNDARY_TTL)
+        self.chunks_read = 0
+        self.archived = 0
+
+    def _paths(self, chat_id: int):
+        directory = os.path.join(self.root, f"{chat_id % 256:02x}")
+        return os.path.join(directory, f"{chat_id}.seg"), os.path.join(directory, f"{chat_id}.idx")
+
+    def _index(self, chat_id: int) -> list:
+        _, index_path = self._paths(chat_id)
+        try:
+            size = os.stat(index_path).st_size
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            cached = self._indexes.get(chat_id)
+        if cached is not None and cached[0] == size:
+            return cached[1]
+        with open(index_path, "rb") as f:
+            data = f.read(size - size % _ENTRY.size)
+        entries = [_ENTRY.unpack_from(data, offset) for offset in range(0, len(data), _ENTRY.size)]
+        with self._lock:
+            self._indexes[chat_id] = (size, entries)
+        return entries
+
+    def boundary(self, chat_id: int) -> int:
+        """Newest archived message id of the chat (0: nothing archived)."""
+        entries = self._index(chat_id)
+        return entries[-1][1] if entries else 0
+
+    async def current_boundary(self, chat_id: int) -> int:
+        """``boundary()`` for the event loop: served from memory, the index is read in a thread."""
+        if not self.enabled:
+            return 0
+        boundary = self._boundaries.get(chat_id)
+        if boundary is None:
+            boundary = await asyncio.to_thread(self.boundary, chat_id)
+            self._boundaries.set(chat_id, boundary)
+        return boundary
+
+    def append(self, chat_id: int, messages: list) -> int:
+        """Archive ``(id, encoded)`` pairs in ascending id order.
+
+        Messages at or below the boundary are skipped, so retrying after a
+        crash between archiving and deleting does not duplicate them.
+        Returns how many were written.
+        """
+        boundary = self.boundary(chat_id)
+        messages = [item for item in messages if item[0] > boundary]
+        if not messages:
+            return 0
+        segment_path, index_path = self._paths(chat_id)
+        os.makedirs(os.path.dirname(segment_path), exist_ok=True)
+        entries = []
+        with open(segment_path, "ab") as segment:
+            offset = segment.seek(0, os.SEEK_END)
+            for start in range(0, len(messages), self.chunk):
+                part = messages[start:start + self.chunk]
+                data = _compress(self.codec, b"\n".join(encoded for _, encoded in part))
+                segment.write(data)
+                entries.append(_ENTRY.pack(part[0][0], part[-1][0], offset, len(data), len(part), self.codec))
+                offset += len(data)
+            segment.flush()
+            os.fsync(segment.fileno())
+        with open(index_path, "ab") as index:
+            index.write(b"".join(entries))
+            index.flush()
+            os.fsync(index.fileno())
+        self._boundaries.set(chat_id, messages[-1][0])
+        self.archived += len(messages)
+        return len(messages)
+
+    def _read_chunk(self, chat_id: int, entry) -> list:
+        _, _, offset, length, _, codec = entry
+        key = (chat_id, offset)
+        messages = self._chunks.get(key)
+        if messages is None:
+            segment_path, _ = self._paths(chat_id)
+            with open(segment_path, "rb") as segment:
+                segment.seek(offset)
+                data = _decompress(codec, segment.read(length))
+            messages = [(loads(line)["id"], line) for line in data.split(b"\n")]
+            self._chunks.set(key, messages)
+            self.chunks_read += 1
+        return messages
+
+    def read_before(self, chat_id: int, before_id: int = None, limit: int = 50) -> list:
+        """The ``limit`` newest archived messages older than ``before_id``, oldest first."""
+        if limit <= 0:
+            return []
+        entries = self._index(chat_id)
+        end = len(entries) if before_id is None else bisect.bisect_left([e[0] for e in entries], before_id)
+        found = []
+        for entry in reversed(entries[:end]):
+            older = [m for m in self._read_chunk(chat_id, entry) if before_id is None or m[0] < before_id]
+            found = older + found
+            if len(found) >= limit:
+                break
+        return found[-limit:]
+
+    def read_after(self, chat_id: int, after_id: int, limit: int = 50) -> list:
+        """The ``limit`` oldest archived messages newer than ``after_id``, oldest first."""
+        entries = self._index(chat_id)
+        start = bisect.bisect_right([e[1] for e in entries], after_id)
+        found = []
+        for entry in entries[start:]:
+            found.extend(m for m in self._read_chunk(chat_id, entry) if m[0] > after_id)
+            if len(found) >= limit:
+                break
+        return found[:limit]
+
+    def extend_page(self, chat_id: int, page: list, before_id, after_id, want: int) -> list:
+        """Complete a history page read from the database with archived messages.
+
+        ``page`` holds ``(id, encoded)`` pairs in ascending order; the
+        result has up to ``want`` of them, continuing across the boundary
+        in the direction of the cursor.
+        """
+        if after_id is not None:
+            return (self.read_after(chat_id, after_id, want) + page)[:want]
+        upper = page[0][0] if page else before_id
+        return self.read_before(chat_id, upper, want - len(page)) + page
+
+    def stats(self) -> dict:
+        return {
+            "codec": next(name for name, code in CODECS.items() if code == self.codec),
+            "archived": self.archived,
+            "chunks_read": self.chunks_read,
+            "cached_chunks": len(self._chunks),
+        }
+
+
+def archive_messages(db, archive: MessageArchive, cutoff: datetime,
+                     batch: int = MESSAGE_ARCHIVE_BATCH) -> int:
+    """Move messages sent before ``cutoff`` from the database to ``archive``.
+
+    For each chat, everything up to its newest message older than the
+    cutoff moves, so the archive stays a prefix of the chat's history.
+    Works in slices: archive, then delete and commit. Takes a sync session;
+    returns how many messages moved (at most ``batch``).
+    """
+    # The table's newest message always stays: SQLite hands out max(id) + 1,
+    # so deleting it would reuse ids that are already in the archive
+    newest = db.scalar(select(func.max(Message.id)))
+    bounds = db.execute(
+        select(Message.chat_id, func.max(Message.id))
+        .where(Message.timestamp < cutoff, Message.id < newest)
+        .group_by(Message.chat_id)
+    ).all()
+    moved = 0
+    for chat_id, upto in bounds:
+        while moved < batch:
+            rows = db.execute(
+                select(*MESSAGE_COLUMNS)
+                .where(Message.chat_id == chat_id, Message.id <= upto)
+                .order_by(Message.id)
+                .limit(batch - moved)
+            ).all()
+            if not rows:
+                break
+            archive.append(chat_id, [(row.id, encode_message(row)) for row in rows])
+            db.execute(delete(Message).where(Message.chat_id == chat_id, Message.id <= rows[-1].id))
+            db.commit()
+            moved += len(rows)
+        if moved >= batch:
+            break
+    return moved
+
+
+# Held for a whole run, so only one archiver in the deployment works at a time
+_LOCK_KEY = 0x6D736761
+
+
+class Archiver:
+    """Background task moving old messages to the archive.
+
+    Only one process archives at a time: on PostgreSQL the others skip the
+    run while another holds a session advisory lock, on SQLite (one host)
+    while another holds the lock file in the archive directory.
+    """
+
+    def __init__(self, archive: MessageArchive, session_factory, lock_engine,
+                 after_days: float = MESSAGE_ARCHIVE_AFTER_DAYS, interval: float = MESSAGE_ARCHIVE_INTERVAL,
+                 shared: bool = MESSAGE_ARCHIVE_SHARED):
+        self.archive = archive
+        self.session_factory = session_factory
+        self.lock_engine = lock_engine
+        self.after_days = after_days
+        self.interval = interval
+        self.shared = shared
+        self._task = None
+
+    def _archive(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(days=self.after_days)
+        with self.session_factory() as db:
+            return archive_messages(db, self.archive, cutoff)
+
+    def run_once(self) -> int:
+        os.makedirs(self.archive.root, exist_ok=True)
+        if self.lock_engine.dialect.name == "postgresql":
+            # A dedicated connection keeps the session lock across the
+            # run's commits
+            with self.lock_engine.connect() as conn:
+                if not conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": _LOCK_KEY}).scalar():
+                    return 0
+                try:
+                    return self._archive()
+                finally:
+                    conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _LOCK_KEY})
+        import fcntl
+        with open(os.path.join(self.archive.root, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            return self._archive()
+
+    def start(self):
+        if self.after_days <= 0:
+            return
+        if not self.shared:
+            # Archived rows leave the database; hosts that cannot see the
+            # directory would serve truncated history
+            raise RuntimeError(
+                "MESSAGE_ARCHIVE_AFTER_DAYS is set but MESSAGE_ARCHIVE_SHARED is not: "
+                "point MESSAGE_ARCHIVE_DIR at storage shared by all hosts and set MESSAGE_ARCHIVE_SHARED=true"
+            )
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                moved = await asyncio.to_thread(self.run_once)
+                if moved:
+                    logger.info("messages_archived", messages=moved)
+            except Exception as e:
+                logger.error("message_archive_failed", exc_info=e)
+            await asyncio.sleep(self.interval)
+
+
+message_archive = MessageArchive()
+archiver = Archiver(message_archive, SessionLocal, engine)
@@ -1,4 +1,7 @@
+import asyncio
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from passlib.context import CryptContext
@@ -7,6 +10,14 @@ SECRET_KEY = os.getenv("SECRET_KEY", "supersecretkey123456789")  # nosec B101 -
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# bcrypt work factor for new hashes; existing hashes with a different cost
+# are upgraded on the next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Hashing runs in its own small pool so a login storm cannot starve the
+# shared threadpool; requests beyond HASH_QUEUE_DEPTH are rejected outright
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_QUEUE_DEPTH = int(os.getenv("HASH_QUEUE_DEPTH", str(HASH_WORKERS * 8)))
+
 # Initialize bcrypt - use direct bcrypt due to passlib/bcrypt version compatibility issues
 import bcrypt
 _use_direct_bcrypt = True
@@ -22,7 +33,7 @@ def hash_password(password: str) -> str:
     
     if _use_direct_bcrypt:
         import bcrypt
-        salt = bcrypt.gensalt()
+        salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
         hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
         return hashed.decode('utf-8')
     else:
@@ -53,6 +64,53 @@ def verify_password(plain: str, hashed: str) -> bool:
     else:
         return pwd_context.verify(plain, hashed)
 
+def needs_rehash(hashed: str) -> bool:
+    """Return True if a bcrypt hash was made with a cost other than BCRYPT_ROUNDS."""
+    # Hash layout: $2b$<cost>$<salt+digest>
+    parts = hashed.split("$")
+    try:
+        return int(parts[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+class HashingPoolFull(Exception):
+    """Raised when the hashing pool already has its maximum number of jobs queued."""
+
+class HashingPool:
+    """Bounded thread pool for bcrypt work.
+
+    bcrypt releases the GIL while hashing, so threads give real parallelism.
+    At most ``max_pending`` jobs may be running or queued at once; further
+    submissions fail immediately with HashingPoolFull instead of piling up.
+    ``max_pending <= 0`` leaves the queue unbounded.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+
+    async def run(self, fn, *args):
+        if self._slots is None:
+            return await asyncio.wrap_future(self._executor.submit(fn, *args))
+        if not self._slots.acquire(blocking=False):
+            raise HashingPoolFull()
+        future = self._executor.submit(fn, *args)
+        # Release on completion, not when the caller stops waiting, so a
+        # cancelled request still counts against the limit until bcrypt ends
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+hashing_pool = HashingPool(HASH_WORKERS, HASH_QUEUE_DEPTH)
+
+async def hash_password_async(password: str) -> str:
+    return await hashing_pool.run(hash_password, password)
+
+async def verify_password_async(plain: str, hashed: str) -> bool:
+    return await hashing_pool.run(verify_password, plain, hashed)
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a time-to-live.
+
+    The cache holds at most ``maxsize`` entries; inserting into a full cache
+    evicts the least recently used one. Expired entries are dropped lazily
+    when they are looked up or when they reach the LRU end.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """Store a value; ``ttl`` overrides the cache-wide time-to-live."""
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def discard_where(self, predicate) -> int:
+        """Remove every entry whose value matches ``predicate``; return how many."""
+        with self._lock:
+            stale = [key for key, (_, value) in self._data.items() if predicate(value)]
+            for key in stale:
+                del self._data[key]
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,159 @@
+import asyncio
+import itertools
+import os
+import time
+from collections import deque
+from fastapi import WebSocket
+from app.log import get_logger
+
+logger = get_logger(__name__)
+
+# Outbound queue limits for every WebSocket connection
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")
+# Upper bound for a single send; slower clients are disconnected
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+
+# What to do when a payload arrives for a connection whose queue is full:
+# - drop_oldest: discard the oldest queued payload to make room;
+# - coalesce: a payload with a coalesce key replaces the queued payload with
+#   the same key (at any queue depth); otherwise behave like drop_oldest;
+# - disconnect: treat the client as a slow consumer and close the socket.
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Close code sent to slow consumers ("try again later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+_connection_ids = itertools.count(1)
+
+
+class Connection:
+    """A WebSocket with a bounded outbound queue drained by a single writer task.
+
+    Producers call ``send``, which never blocks: the payload is queued and
+    the writer task delivers queued payloads in order. A stalled client can
+    therefore only fill its own queue, never hold up a broadcaster.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int, max_queue: int = None,
+                 overflow_policy: str = None, send_timeout: float = None, on_close=None):
+        overflow_policy = overflow_policy or WS_OVERFLOW_POLICY
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.id = next(_connection_ids)
+        self.websocket = websocket
+        self.user_id = user_id
+        self.max_queue = max_queue or WS_QUEUE_SIZE
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout or WS_SEND_TIMEOUT
+        self.closed = False
+        # Chats whose broadcasts this connection receives
+        self.chats = set()
+        self._on_close = on_close
+        # Entries are [coalesce_key, payload] lists so coalescing can swap
+        # the payload of an entry that is already queued
+        self._queue = deque()
+        self._pending_keys = {}
+        self._ready = asyncio.Event()
+        self._writer = None
+        self.connected_at = time.time()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_queue_depth = 0
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def send(self, payload: str, coalesce_key=None) -> bool:
+        """Queue a payload for delivery; return False if it was not accepted."""
+        if self.closed:
+            return False
+
+        if coalesce_key is not None and self.overflow_policy == "coalesce":
+            entry = self._pending_keys.get(coalesce_key)
+            if entry is not None:
+                entry[1] = payload
+                self.coalesced += 1
+                return True
+
+        if len(self._queue) >= self.max_queue:
+            if self.overflow_policy == "disconnect":
+                self._spawn_close(SLOW_CONSUMER_CLOSE_CODE)
+                return False
+            oldest = self._queue.popleft()
+            self._forget_key(oldest)
+            self.dropped += 1
+
+        entry = [coalesce_key, payload]
+        self._queue.append(entry)
+        if coalesce_key is not None:
+            self._pending_keys[coalesce_key] = entry
+        self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+        self._ready.set()
+        return True
+
+    def _forget_key(self, entry):
+        key = entry[0]
+        if key is not None and self._pending_keys.get(key) is entry:
+            del self._pending_keys[key]
+
+    async def _write_loop(self):
+        while not self.closed:
+            if not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            entry = self._queue.popleft()
+            self._forget_key(entry)
+            try:
+                await asyncio.wait_for(self.websocket.send_text(entry[1]), timeout=self.send_timeout)
+            except Exception as e:
+                logger.warning("ws_send_failed", connection=self.id, user_id=self.user_id, error=repr(e))
+                await self.close(SLOW_CONSUMER_CLOSE_CODE)
+                return
+            self.sent += 1
+
+    def _spawn_close(self, code):
+        task = asyncio.create_task(self.close(code))
+        _closing_tasks.add(task)
+        task.add_done_callback(_closing_tasks.discard)
+
+    async def close(self, code: int = None):
+        """Stop the writer and unregister; send a close frame if ``code`` is given."""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._pending_keys.clear()
+        self._ready.set()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        if self._on_close is not None:
+            self._on_close(self)
+        if code is not None:
+            try:
+                await asyncio.wait_for(self.websocket.close(code=code), timeout=self.send_timeout)
+            except Exception:
+                pass
+
+    def metrics(self) -> dict:
+        return {
+            "id": self.id,
+            "connected_seconds": round(time.time() - self.connected_at, 3),
+            "queue_depth": len(self._queue),
+            "max_queue_depth": self.max_queue_depth,
+            "queue_limit": self.max_queue,
+            "overflow_policy": self.overflow_policy,
+            "subscriptions": len(self.chats),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+
+_closing_tasks = set()
@@ -1,12 +1,95 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 import os
+import threading
+import time
+from uuid import uuid4
+
+# Connection pool sizing. Every worker process gets its own sync and async
+# pool, so the server-side connection budget is roughly
+# workers * 2 * (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Server-side statement timeout in milliseconds (PostgreSQL only, 0 = off)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# PgBouncer in transaction pooling mode rejects startup parameters and
+# cannot keep server-side prepared statements across transactions
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() == "true"
+
+
+class PoolMetrics:
+    """Checkout counters and wait times for one connection pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def observe(self, waited: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+
+class _TimedCheckoutMixin:
+    """Measures how long callers wait to get a connection out of the pool."""
+
+    @property
+    def metrics(self) -> PoolMetrics:
+        # Pools are recreated on dispose(); each instance keeps its own counters
+        if "_metrics" not in self.__dict__:
+            self._metrics = PoolMetrics()
+        return self._metrics
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.observe(time.perf_counter() - started, timed_out=True)
+            raise
+        self.metrics.observe(time.perf_counter() - started)
+        return connection
+
+
+class InstrumentedQueuePool(_TimedCheckoutMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(_TimedCheckoutMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+POOL_OPTIONS = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+}
 
 # Use SQLite for local testing, PostgreSQL for production
 if os.getenv("USE_SQLITE", "false").lower() == "true":
     SQLALCHEMY_DATABASE_URL = "sqlite:///./test_messenger.db"
-    engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+    ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./test_messenger.db"
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False},
+        poolclass=InstrumentedQueuePool, **POOL_OPTIONS
+    )
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=InstrumentedAsyncQueuePool, **POOL_OPTIONS)
 else:
     # Use environment variables for database configuration
     db_host = os.getenv("DB_HOST", "db")
@@ -14,11 +97,45 @@ else:
     db_password = os.getenv("DB_PASSWORD", "password")  # nosec B108 - default only for development
     db_name = os.getenv("DB_NAME", "messenger")
     db_port = os.getenv("DB_PORT", "5432")
-    
+
     SQLALCHEMY_DATABASE_URL = f"postgresql+psycopg2://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
-    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    ASYNC_DATABASE_URL = f"postgresql+asyncpg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+
+    sync_connect_args = {}
+    async_connect_args = {}
+    if DB_PGBOUNCER:
+        # No prepared statement caches: the next transaction may run on a
+        # different server connection
+        async_connect_args["statement_cache_size"] = 0
+        async_connect_args["prepared_statement_cache_size"] = 0
+        # asyncpg still prepares each statement under a name; its default
+        # per-connection counter names collide on shared server connections
+        async_connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid4()}__"
+    elif DB_STATEMENT_TIMEOUT_MS > 0:
+        sync_connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+        async_connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL, connect_args=sync_connect_args,
+        poolclass=InstrumentedQueuePool, **POOL_OPTIONS
+    )
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL, connect_args=async_connect_args,
+        poolclass=InstrumentedAsyncQueuePool, **POOL_OPTIONS
+    )
+
+    if DB_PGBOUNCER and DB_STATEMENT_TIMEOUT_MS > 0:
+        # Startup options are not forwarded by PgBouncer, so set the
+        # timeout per transaction instead
+        def set_local_statement_timeout(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+        event.listen(engine, "begin", set_local_statement_timeout)
+        event.listen(async_engine.sync_engine, "begin", set_local_statement_timeout)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Used by the hot endpoints so DB round trips do not block the event loop.
+# Objects stay loaded after commit, so responses need no refresh query.
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 def get_db():
@@ -27,3 +144,25 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def pool_stats(pool) -> dict:
+    """Snapshot of a pool's occupancy and checkout wait times."""
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    in_use = pool.checkedout()
+    metrics = pool.metrics
+    return {
+        "size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "checked_out": in_use,
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "utilization": round(in_use / capacity, 3) if capacity else 0.0,
+        "checkouts": metrics.checkouts,
+        "timeouts": metrics.timeouts,
+        "wait_avg_ms": round(metrics.wait_total / metrics.checkouts * 1000, 3) if metrics.checkouts else 0.0,
+        "wait_max_ms": round(metrics.wait_max * 1000, 3),
+    }
@@ -0,0 +1,145 @@
+import hmac
+import os
+import time
+from typing import Optional
+from fastapi import Depends, HTTPException, Header
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from jose import JWTError, jwt
+from app.auth import SECRET_KEY, ALGORITHM
+from app.cache import TTLCache
+from app.db import get_async_db, get_db
+from app.models import User
+
+# Authenticated users are cached per token so hot paths skip both the JWT
+# decode and the User lookup. Entries never outlive the token itself.
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+
+_token_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+# Operator token for /api/metrics, sent as X-Metrics-Token. The metrics show
+# other users' connections and server internals, so a user JWT is not
+# enough; without a token configured the endpoints are disabled.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+class CurrentUser:
+    """Session-independent snapshot of an authenticated user."""
+    __slots__ = ("id", "username")
+
+    def __init__(self, id: int, username: str):
+        self.id = id
+        self.username = username
+
+    def __repr__(self):
+        return f"CurrentUser(id={self.id!r}, username={self.username!r})"
+
+
+def _decode_username(token: str) -> tuple:
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        username = payload.get("sub")
+        if username is None:
+            raise HTTPException(status_code=401, detail="Invalid token")
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return username, payload
+
+
+def _remember(token: str, payload: dict, row) -> CurrentUser:
+    if row is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    user = CurrentUser(id=row.id, username=row.username)
+    ttl = AUTH_CACHE_TTL
+    if payload.get("exp") is not None:
+        ttl = min(ttl, payload["exp"] - time.time())
+    if ttl > 0:
+        _token_cache.set(token, user, ttl=ttl)
+    return user
+
+
+def _load_user(token: str, db: Session) -> CurrentUser:
+    """Decode the token and look its user up, caching the result."""
+    username, payload = _decode_username(token)
+    row = db.query(User.id, User.username).filter(User.username == username).first()
+    return _remember(token, payload, row)
+
+
+async def _load_user_async(token: str, db: AsyncSession) -> CurrentUser:
+    username, payload = _decode_username(token)
+    result = await db.execute(select(User.id, User.username).where(User.username == username))
+    return _remember(token, payload, result.first())
+
+
+def _bearer_token(authorization: Optional[str]) -> str:
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return authorization.split(" ")[1]
+
+
+def get_cached_user(token: str) -> Optional[CurrentUser]:
+    """Return the cached user for a token without touching the database."""
+    return _token_cache.get(token)
+
+
+def resolve_user(token: str, db: Session) -> Optional[CurrentUser]:
+    """Map a JWT to its user, or None if the token or the user is invalid."""
+    cached = _token_cache.get(token)
+    if cached is not None:
+        return cached
+    try:
+        return _load_user(token, db)
+    except HTTPException:
+        return None
+
+
+async def resolve_user_async(token: str, db: AsyncSession) -> Optional[CurrentUser]:
+    cached = _token_cache.get(token)
+    if cached is not None:
+        return cached
+    try:
+        return await _load_user_async(token, db)
+    except HTTPException:
+        return None
+
+
+def get_current_user(authorization: str = Header(None), db: Session = Depends(get_db)) -> CurrentUser:
+    token = _bearer_token(authorization)
+    cached = _token_cache.get(token)
+    if cached is not None:
+        return cached
+    return _load_user(token, db)
+
+
+async def get_current_user_async(authorization: str = Header(None),
+                                 db: AsyncSession = Depends(get_async_db)) -> CurrentUser:
+    """Same as get_current_user, for endpoints running on the async session."""
+    token = _bearer_token(authorization)
+    cached = _token_cache.get(token)
+    if cached is not None:
+        return cached
+    return await _load_user_async(token, db)
+
+
+def require_metrics_token(x_metrics_token: str = Header(None)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    if not x_metrics_token or not hmac.compare_digest(x_metrics_token, METRICS_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid metrics token")
+
+
+# Invalidation hooks: call these whenever a user is renamed, deleted or has
+# their sessions revoked, so no cached token keeps resolving to stale data.
+
+def invalidate_token(token: str):
+    _token_cache.pop(token)
+
+
+def invalidate_user(user_id: int) -> int:
+    return _token_cache.discard_where(lambda user: user.id == user_id)
+
+
+def clear_user_cache():
+    _token_cache.clear()
@@ -0,0 +1,37 @@
+import orjson
+from fastapi.responses import Response
+
+# orjson writes datetimes in ISO 8601 like datetime.isoformat(), so its
+# output matches what the stdlib encoder produced for the same payloads.
+# Naive datetimes carry no offset, as before.
+
+
+def dumps(obj) -> bytes:
+    return orjson.dumps(obj)
+
+
+def dumps_text(obj) -> str:
+    """Encode for WebSocket text frames and the broadcast bus."""
+    return orjson.dumps(obj).decode()
+
+
+loads = orjson.loads
+
+
+def join_array(items) -> bytes:
+    """A JSON array from already encoded JSON values."""
+    return b"[" + b",".join(items) + b"]"
+
+
+class JSONBytesResponse(Response):
+    """A response whose body is encoded by orjson, or already encoded bytes.
+
+    Endpoints on the hot path return this directly, so FastAPI's
+    ``jsonable_encoder`` and response-model validation are skipped.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return orjson.dumps(content)
@@ -0,0 +1,124 @@
+import asyncio
+import os
+from app.log import get_logger
+
+logger = get_logger(__name__)
+
+# Opt-in: route message inserts from all senders through one write-behind
+# queue so concurrent sends share a transaction (and its fsync)
+MESSAGE_GROUP_COMMIT = os.getenv("MESSAGE_GROUP_COMMIT", "false").lower() == "true"
+# A micro-batch is flushed when it holds this many messages...
+MESSAGE_GROUP_COMMIT_MAX = int(os.getenv("MESSAGE_GROUP_COMMIT_MAX", "256"))
+# ...or this long after its first message arrived, whichever comes first
+MESSAGE_GROUP_COMMIT_DELAY_MS = float(os.getenv("MESSAGE_GROUP_COMMIT_DELAY_MS", "2"))
+
+
+class _Request:
+    __slots__ = ("user_id", "drafts", "future")
+
+    def __init__(self, user_id: int, drafts: list, future: asyncio.Future):
+        self.user_id = user_id
+        self.drafts = drafts
+        self.future = future
+
+
+class GroupCommitWriter:
+    """Collects message writes from concurrent callers into micro-batches.
+
+    ``flush`` receives a list of ``(user_id, drafts)`` requests and returns,
+    per request, either its saved messages or an exception for that caller
+    alone; if ``flush`` itself raises, every caller in the batch gets the
+    error. Batches are flushed one at a time: while one commits, the next
+    one fills up, so the batch size grows with load instead of the number of
+    transactions.
+    """
+
+    def __init__(self, flush, max_batch: int = MESSAGE_GROUP_COMMIT_MAX,
+                 delay: float = MESSAGE_GROUP_COMMIT_DELAY_MS / 1000):
+        self.flush = flush
+        self.max_batch = max_batch
+        self.delay = delay
+        self._queue = None
+        self._full = None
+        self._queued = 0
+        self._task = None
+        self._loop = None
+        self.batches = 0
+        self.messages = 0
+
+    async def submit(self, user_id: int, drafts: list) -> list:
+        """Queue one caller's messages; resolves once their batch is committed."""
+        self._ensure_running()
+        future = self._loop.create_future()
+        self._queue.put_nowait(_Request(user_id, drafts, future))
+        self._queued += len(drafts)
+        if self._queued >= self.max_batch:
+            self._full.set()
+        return await future
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        # Started lazily, and again if the previous loop (tests) went away
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._full = asyncio.Event()
+            self._queued = 0
+            self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        """Flush what is queued and stop the background task."""
+        if self._task is None or self._task.done():
+            return
+        self._queue.put_nowait(None)
+        await self._task
+
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            if self._queued < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+            batch, size, stopping = [first], len(first.drafts), False
+            while size < self.max_batch and not self._queue.empty():
+                request = self._queue.get_nowait()
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                size += len(request.drafts)
+            self._queued -= size
+            if self._queued < self.max_batch:
+                self._full.clear()
+            await self._flush(batch, size)
+            if stopping:
+                return
+
+    async def _flush(self, batch: list, size: int):
+        try:
+            results = await self.flush([(request.user_id, request.drafts) for request in batch])
+        except Exception as e:
+            logger.error("group_commit_failed", exc_info=e, requests=len(batch), messages=size)
+            results = [e] * len(batch)
+        self.batches += 1
+        self.messages += size
+        for request, result in zip(batch, results):
+            if request.future.done():
+                continue
+            if isinstance(result, Exception):
+                request.future.set_exception(result)
+            else:
+                request.future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": MESSAGE_GROUP_COMMIT,
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch": round(self.messages / self.batches, 2) if self.batches else 0.0,
+            "queued": self._queued,
+        }
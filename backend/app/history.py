@@ -0,0 +1,158 @@
+import bisect
+import os
+import threading
+from collections import OrderedDict
+from app.encoding import join_array
+
+# Newest messages kept per chat for GET /api/messages/{chat_id}; a first
+# page with a larger limit than this is always read from the database
+MESSAGE_CACHE_PER_CHAT = int(os.getenv("MESSAGE_CACHE_PER_CHAT", "100"))
+# Bounds for the whole cache; the least recently read chat is dropped first
+MESSAGE_CACHE_CHATS = int(os.getenv("MESSAGE_CACHE_CHATS", "1000"))
+MESSAGE_CACHE_BYTES = int(os.getenv("MESSAGE_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+
+class CachedChat:
+    """The newest messages of one chat as encoded JSON objects, oldest first."""
+    __slots__ = ("ids", "items", "size", "has_older")
+
+    def __init__(self, has_older: bool):
+        self.ids = []
+        self.items = []
+        self.size = 0
+        # Whether the chat has messages older than the first cached one
+        self.has_older = has_older
+
+
+class RecentMessagesCache:
+    """Per-chat LRU cache of the newest messages, pre-encoded for responses.
+
+    Send paths write new messages through with ``append``; a first page
+    that misses is read from the database and stored with ``fill``. Writes
+    made by other workers only arrive as bus events, so those chats are
+    dropped with ``invalidate`` and refilled on the next read.
+
+    A read that started before a write to the same chat must not store its
+    (now stale) page. Every write bumps a version counter and remembers it
+    per chat; ``fill`` is rejected if the chat was written since the version
+    the reader took before querying.
+    """
+
+    def __init__(self, per_chat: int = MESSAGE_CACHE_PER_CHAT, max_chats: int = MESSAGE_CACHE_CHATS,
+                 max_bytes: int = MESSAGE_CACHE_BYTES):
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self._chats = OrderedDict()
+        self._bytes = 0
+        self._version = 0
+        # chat_id -> version of its last write, bounded; versions of
+        # forgotten chats are covered by _written_floor
+        self._written = OrderedDict()
+        self._written_floor = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self) -> int:
+        """Take before querying the database for a page to ``fill`` with."""
+        with self._lock:
+            return self._version
+
+    def page(self, chat_id: int, limit: int):
+        """``(body, next_cursor)`` for a chat's newest page, or None on a miss."""
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            # Serve only when the cache holds the whole page
+            if chat is None or (len(chat.items) < limit and chat.has_older):
+                self.misses += 1
+                return None
+            self._chats.move_to_end(chat_id)
+            self.hits += 1
+            items = chat.items[-limit:]
+            has_more = len(chat.items) > limit or chat.has_older
+            next_cursor = chat.ids[-limit] if has_more else None
+            return join_array(items), next_cursor
+
+    def fill(self, chat_id: int, messages: list, has_older: bool, version: int):
+        """Store a chat's newest messages, ``(id, encoded)`` pairs oldest first."""
+        if self.per_chat <= 0 or self.max_chats <= 0:
+            return
+        with self._lock:
+            if version < max(self._written_floor, self._written.get(chat_id, 0)):
+                return
+            self._drop(chat_id)
+            chat = CachedChat(has_older or len(messages) > self.per_chat)
+            for message_id, encoded in messages[-self.per_chat:]:
+                chat.ids.append(message_id)
+                chat.items.append(encoded)
+                chat.size += len(encoded)
+            self._chats[chat_id] = chat
+            self._bytes += chat.size
+            self._evict()
+
+    def append(self, chat_id: int, message_id: int, encoded: bytes):
+        """Write-through of a newly saved message."""
+        with self._lock:
+            self._touch(chat_id)
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                return
+            # Concurrent sends can commit and arrive here out of id order
+            index = bisect.bisect_left(chat.ids, message_id)
+            if index < len(chat.ids) and chat.ids[index] == message_id:
+                return
+            chat.ids.insert(index, message_id)
+            chat.items.insert(index, encoded)
+            chat.size += len(encoded)
+            self._bytes += len(encoded)
+            while len(chat.ids) > self.per_chat:
+                chat.ids.pop(0)
+                dropped = chat.items.pop(0)
+                chat.size -= len(dropped)
+                self._bytes -= len(dropped)
+                chat.has_older = True
+            self._evict()
+
+    def invalidate(self, chat_id: int):
+        with self._lock:
+            self._touch(chat_id)
+            self._drop(chat_id)
+
+    def clear(self):
+        with self._lock:
+            self._chats.clear()
+            self._written.clear()
+            self._bytes = 0
+            self._written_floor = self._version
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "chats": len(self._chats),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _touch(self, chat_id: int):
+        self._version += 1
+        self._written[chat_id] = self._version
+        self._written.move_to_end(chat_id)
+        # Remembering a few times more chats than are cached is enough to
+        # reject stale fills; older writes fall back to the floor
+        while len(self._written) > 4 * max(self.max_chats, 1):
+            _, self._written_floor = self._written.popitem(last=False)
+
+    def _drop(self, chat_id: int):
+        chat = self._chats.pop(chat_id, None)
+        if chat is not None:
+            self._bytes -= chat.size
+
+    def _evict(self):
+        while self._chats and (len(self._chats) > self.max_chats or self._bytes > self.max_bytes):
+            _, chat = self._chats.popitem(last=False)
+            self._bytes -= chat.size
+
+
+recent_messages = RecentMessagesCache()
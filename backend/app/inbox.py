@@ -0,0 +1,112 @@
+import os
+from sqlalchemy import bindparam, case, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import ChatMember, Message, UserChat
+
+# Characters of the last message kept for the chat list preview
+INBOX_PREVIEW_CHARS = int(os.getenv("INBOX_PREVIEW_CHARS", "100"))
+
+_user_chats = UserChat.__table__
+
+# Executed once per (chat, sender) with executemany. The sender's own row
+# only gets the new preview; every other member's unread count grows.
+_record_messages = update(_user_chats).where(
+    _user_chats.c.chat_id == bindparam("b_chat_id")
+).values(
+    last_message_time=bindparam("b_time"),
+    last_message_preview=bindparam("b_preview"),
+    unread_count=_user_chats.c.unread_count + case(
+        (_user_chats.c.user_id == bindparam("b_sender"), 0), else_=bindparam("b_count")
+    ),
+)
+
+
+def preview(content: str) -> str:
+    return content[:INBOX_PREVIEW_CHARS]
+
+
+def new_chat_entries(chat, members: list) -> list:
+    """Inbox rows for a new chat; ``members`` are ``(user_id, username)`` pairs.
+
+    A chat with two members is private and each side sees it named after
+    the other one, like the chat list always showed it.
+    """
+    entries = []
+    for user_id, _ in members:
+        name = chat.name
+        if len(members) == 2:
+            other = next(username for member_id, username in members if member_id != user_id)
+            name = f"Chat with {other}"
+        entries.append(UserChat(
+            user_id=user_id, chat_id=chat.id, display_name=name,
+            last_message_time=chat.last_message_time, unread_count=0,
+        ))
+    return entries
+
+
+async def record_messages(db: AsyncSession, messages: list, now):
+    """Update every member's inbox row for newly inserted messages.
+
+    One executemany UPDATE with a parameter set per (chat, sender); sets
+    are ordered by their newest message, so each chat ends up previewing
+    its latest one. Runs in the caller's transaction.
+    """
+    groups = {}
+    for message in messages:
+        group = groups.setdefault((message.chat_id, message.user_id), [0, message])
+        group[0] += 1
+        if message.id > group[1].id:
+            group[1] = message
+    params = [
+        {"b_chat_id": chat_id, "b_sender": sender, "b_count": count, "b_time": now, "b_preview": preview(last.content)}
+        for (chat_id, sender), (count, last) in sorted(groups.items(), key=lambda item: item[1][1].id)
+    ]
+    await db.execute(_record_messages, params)
+
+
+async def mark_read(db: AsyncSession, user_id: int, chat_id: int, message_id: int = None, archived_id: int = 0):
+    """Move a member's read cursor forward and recount their unread messages.
+
+    ``message_id`` defaults to the chat's newest message and is clamped to
+    it; the cursor never moves back. Only messages after the cursor are
+    counted, a range of the ``(chat_id, id)`` index, so marking a chat read
+    costs the same however long its history is. ``archived_id`` is the
+    chat's archive boundary, so a chat whose messages were all archived can
+    still be read up to its newest one; archived messages are not counted
+    as unread. Returns ``(cursor, unread_count)``, or None if the user is
+    not a member.
+    """
+    latest_id = select(func.max(Message.id)).where(Message.chat_id == chat_id).scalar_subquery()
+    row = (await db.execute(
+        select(ChatMember.id, ChatMember.last_read_message_id, latest_id)
+        .where(ChatMember.chat_id == chat_id, ChatMember.user_id == user_id)
+    )).first()
+    if row is None:
+        return None
+    member_id, cursor, latest = row
+    target = max(latest or 0, archived_id)
+    if message_id is not None:
+        target = min(message_id, target)
+    if cursor is None or target > cursor:
+        # Guarded, so a concurrent request that got further is not undone
+        await db.execute(
+            update(ChatMember)
+            .where(ChatMember.id == member_id)
+            .where((ChatMember.last_read_message_id.is_(None)) | (ChatMember.last_read_message_id < target))
+            .values(last_read_message_id=target)
+        )
+        cursor = target
+
+    # Counted inside the UPDATE so an increment from a concurrent send
+    # cannot be overwritten with a count taken before it
+    unread = select(func.count(Message.id)).where(
+        Message.chat_id == chat_id, Message.id > (cursor or 0), Message.user_id != user_id
+    ).scalar_subquery()
+    unread_count = await db.scalar(
+        update(UserChat)
+        .where(UserChat.user_id == user_id, UserChat.chat_id == chat_id)
+        .values(unread_count=unread)
+        .returning(UserChat.unread_count)
+    )
+    await db.commit()
+    return cursor, unread_count or 0
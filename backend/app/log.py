@@ -0,0 +1,213 @@
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import uuid
+from datetime import datetime, timezone
+from app.encoding import dumps_text
+
+# Minimum level written; per-message events are logged at DEBUG or sampled
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json: one JSON object per line; text: human-readable key=value lines
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Share of sampled per-message events that are written (0 disables them)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+# Records waiting for the writer thread; when full, new records are dropped
+# instead of blocking the event loop
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Correlation ids, attached to every record logged while they are set. The
+# HTTP middleware sets request_id; a WebSocket sets connection_id for its
+# handler and writer task.
+request_id = contextvars.ContextVar("request_id", default=None)
+connection_id = contextvars.ContextVar("connection_id", default=None)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+_REQUEST_ID_KEY = REQUEST_ID_HEADER.lower().encode()
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class StructuredLogger:
+    """Logs an event name plus keyword fields instead of a formatted string.
+
+    Fields are only collected when the level is enabled, so disabled debug
+    events cost one level check.
+    """
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+
+    def _log(self, level: int, event: str, fields: dict, exc_info=None):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, exc_info=exc_info, extra={"fields": fields}, stacklevel=3)
+
+    def debug(self, event: str, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, exc_info=None, **fields):
+        self._log(logging.ERROR, event, fields, exc_info=exc_info)
+
+    def sampled(self, event: str, rate: float = None, **fields):
+        """An INFO event emitted for only a share of calls (per-message events)."""
+        rate = LOG_SAMPLE_RATE if rate is None else rate
+        if rate > 0 and random.random() < rate and self.logger.isEnabledFor(logging.INFO):
+            fields["sample_rate"] = rate
+            self._log(logging.INFO, event, fields)
+
+
+def get_logger(name: str) -> StructuredLogger:
+    return StructuredLogger(name)
+
+
+def record_fields(record: logging.LogRecord) -> dict:
+    fields = {}
+    for name in ("request_id", "connection_id"):
+        value = getattr(record, name, None)
+        if value is not None:
+            fields[name] = value
+    fields.update(getattr(record, "fields", None) or {})
+    # Plain logging calls with extra={...} (e.g. from libraries)
+    for key, value in vars(record).items():
+        if key not in _STANDARD_ATTRS and key not in ("fields", "request_id", "connection_id"):
+            fields[key] = value
+    return fields
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(record_fields(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return dumps_text({key: value if isinstance(value, (str, int, float, bool, type(None))) else repr(value)
+                           for key, value in entry.items()})
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(f"{key}={value}" for key, value in record_fields(record).items())
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        if fields:
+            line = f"{line} {fields}"
+        if record.exc_info:
+            line = f"{line}\n{self.formatException(record.exc_info)}"
+        return line
+
+
+class CorrelationFilter(logging.Filter):
+    """Copies the correlation ids of the logging context onto the record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        record.connection_id = connection_id.get()
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread; never blocks when it falls behind."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        # Correlation ids live in context variables, so read them here on
+        # the logging side, before the record changes thread
+        self.addFilter(CorrelationFilter())
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The listener runs in this process, so the record is passed as is
+        # and formatted on the writer thread rather than the event loop
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_handler = None
+_lock = threading.Lock()
+
+
+def configure_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream=None):
+    """Route the root logger through a bounded queue to a writer thread.
+
+    Safe to call more than once; later calls replace the configuration.
+    """
+    global _listener, _handler
+    with _lock:
+        stop_logging()
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JSONFormatter() if fmt == "json" else TextFormatter())
+        _handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+        root = logging.getLogger()
+        root.handlers = [h for h in root.handlers if not isinstance(h, DroppingQueueHandler)]
+        root.addHandler(_handler)
+        root.setLevel(level)
+        _listener.start()
+
+
+def stop_logging():
+    """Flush queued records and stop the writer thread."""
+    global _listener, _handler
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
+
+
+def dropped_records() -> int:
+    return _handler.dropped if _handler is not None else 0
+
+
+class CorrelationIdMiddleware:
+    """ASGI middleware giving every HTTP request a correlation id.
+
+    A valid incoming ``X-Request-ID`` is kept, otherwise one is generated;
+    it is set for the request's logging context and echoed in the response.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        incoming = None
+        for name, value in scope["headers"]:
+            if name == _REQUEST_ID_KEY:
+                incoming = value.decode("latin-1")
+                break
+        rid = incoming if incoming and len(incoming) <= 128 and incoming.isprintable() else uuid.uuid4().hex
+        token = request_id.set(rid)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(_REQUEST_ID_KEY, rid.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
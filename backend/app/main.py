@@ -1,7 +1,15 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .routers import users, chats, messages
-from app.websocket import router as ws_router
+from .routers import users, chats, messages, metrics
+from app.websocket import router as ws_router, broadcast_bus
+from app.auth import hashing_pool
+from app.db import async_engine
+from app.messaging import message_writer
+from app.partitions import partition_maintainer
+from app.archive import archiver
+from app.log import REQUEST_ID_HEADER, CorrelationIdMiddleware, configure_logging, stop_logging
+
+configure_logging()
 
 app = FastAPI(title="Mini Messenger API")
 
@@ -12,10 +20,57 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", REQUEST_ID_HEADER],
 )
+# Outermost, so the id is set for everything logged while handling a request
+app.add_middleware(CorrelationIdMiddleware)
 
 # Подключаем роутеры
 app.include_router(users.router, prefix="/api/users", tags=["users"])
 app.include_router(chats.router, prefix="/api/chats", tags=["chats"])
 app.include_router(messages.router, prefix="/api/messages", tags=["messages"])
+app.include_router(metrics.router, prefix="/api/metrics", tags=["metrics"])
 app.include_router(ws_router, prefix="/ws")
+
+@app.on_event("startup")
+async def start_broadcast_bus():
+    await broadcast_bus.start()
+
+@app.on_event("startup")
+async def start_partition_maintenance():
+    # No-op unless messages is partitioned (PostgreSQL, MESSAGE_PARTITIONING)
+    partition_maintainer.start(async_engine)
+
+@app.on_event("startup")
+async def start_archiver():
+    # No-op unless MESSAGE_ARCHIVE_AFTER_DAYS is set
+    archiver.start()
+
+@app.on_event("shutdown")
+async def stop_broadcast_bus():
+    await broadcast_bus.stop()
+
+@app.on_event("shutdown")
+def shutdown_hashing_pool():
+    hashing_pool.shutdown()
+
+@app.on_event("shutdown")
+async def flush_message_writer():
+    # Commit queued group-commit messages before the engine goes away
+    await message_writer.stop()
+
+@app.on_event("shutdown")
+async def stop_archiver():
+    await archiver.stop()
+
+@app.on_event("shutdown")
+async def stop_partition_maintenance():
+    await partition_maintainer.stop()
+
+@app.on_event("shutdown")
+async def dispose_async_engine():
+    await async_engine.dispose()
+
+@app.on_event("shutdown")
+def flush_logs():
+    stop_logging()
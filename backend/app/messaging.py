@@ -0,0 +1,137 @@
+from datetime import datetime
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db import AsyncSessionLocal
+from app.encoding import dumps, dumps_text
+from app.group_commit import MESSAGE_GROUP_COMMIT, GroupCommitWriter
+from app.history import recent_messages
+from app.inbox import record_messages
+from app.models import Chat, Message
+
+
+class ChatNotFound(Exception):
+    def __init__(self, chat_id: int):
+        super().__init__(f"Chat {chat_id} not found")
+        self.chat_id = chat_id
+
+
+def message_data(message: Message, username: str) -> dict:
+    """The message as delivered to WebSocket clients."""
+    return {
+        "type": "message",
+        "id": message.id,
+        "chat_id": message.chat_id,
+        "user_id": message.user_id,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        # The sender is the authenticated user, no need to look it up
+        "username": username,
+    }
+
+
+# Columns of MessageOut, so history pages can be read as plain row tuples
+MESSAGE_COLUMNS = (Message.id, Message.chat_id, Message.user_id, Message.content, Message.timestamp)
+
+
+def encode_message(message) -> bytes:
+    """A message (ORM object or MESSAGE_COLUMNS row) encoded as MessageOut."""
+    return dumps({
+        "id": message.id,
+        "chat_id": message.chat_id,
+        "user_id": message.user_id,
+        "content": message.content,
+        "timestamp": message.timestamp,
+    })
+
+
+async def save_messages(db: AsyncSession, user_id: int, drafts: list) -> list:
+    """Persist messages from one sender and commit; return them in input order.
+
+    ``drafts`` are objects with ``chat_id`` and ``content``. However many
+    messages and chats there are, this is one chat lookup, one multi-row
+    INSERT ... RETURNING, one UPDATE of ``last_message_time``, one
+    (executemany) UPDATE of the members' inbox rows and one commit.
+    Raises ChatNotFound (and writes nothing) if any chat does not exist.
+    Saved messages are written through to this worker's history cache.
+
+    With ``MESSAGE_GROUP_COMMIT`` on, the messages are queued instead and
+    committed together with other senders' messages in the next micro-batch.
+    """
+    if MESSAGE_GROUP_COMMIT:
+        return await message_writer.submit(user_id, drafts)
+    [result] = await write_messages(db, [(user_id, drafts)])
+    if isinstance(result, ChatNotFound):
+        raise result
+    return result
+
+
+async def write_messages(db: AsyncSession, requests: list) -> list:
+    """Persist several ``(user_id, drafts)`` requests in one transaction.
+
+    Returns, per request, its messages in input order, or a ChatNotFound if
+    the request names a missing chat (such a request writes nothing; the
+    others are unaffected).
+    """
+    chat_ids = sorted({draft.chat_id for _, drafts in requests for draft in drafts})
+    existing = set(await db.scalars(select(Chat.id).where(Chat.id.in_(chat_ids))))
+
+    now = datetime.utcnow()
+    results, rows, owners = [], [], []
+    for index, (user_id, drafts) in enumerate(requests):
+        missing = next((draft.chat_id for draft in drafts if draft.chat_id not in existing), None)
+        if missing is not None:
+            results.append(ChatNotFound(missing))
+            continue
+        results.append([])
+        for draft in drafts:
+            rows.append({"chat_id": draft.chat_id, "user_id": user_id, "content": draft.content, "timestamp": now})
+            owners.append(index)
+    if not rows:
+        return results
+
+    # On SQLite, asking SQLAlchemy for RETURNING rows in parameter order
+    # falls back to one INSERT per row. SQLite hands out rowids in VALUES
+    # order within a statement, so sorting by id restores the input order.
+    in_order = db.bind.dialect.name != "sqlite"
+    messages = list(await db.scalars(insert(Message).returning(Message, sort_by_parameter_order=in_order), rows))
+    if not in_order:
+        messages.sort(key=lambda message: message.id)
+    for owner, message in zip(owners, messages):
+        results[owner].append(message)
+    written_chat_ids = sorted({row["chat_id"] for row in rows})
+    await db.execute(update(Chat).where(Chat.id.in_(written_chat_ids)).values(last_message_time=now))
+    await record_messages(db, messages, now)
+    await db.commit()
+    for message in messages:
+        recent_messages.append(message.chat_id, message.id, encode_message(message))
+    return results
+
+
+async def _flush_group(requests: list) -> list:
+    async with AsyncSessionLocal() as db:
+        return await write_messages(db, requests)
+
+
+message_writer = GroupCommitWriter(_flush_group)
+
+
+def batch_frame(chat_id: int, items: list) -> str:
+    return dumps_text({"type": "message_batch", "chat_id": chat_id, "messages": items})
+
+
+def chat_frames(messages: list, username: str) -> dict:
+    """Serialize messages into one WebSocket frame per chat.
+
+    A single message keeps the plain message shape; several messages for
+    the same chat are sent together as a ``message_batch`` frame.
+    """
+    by_chat = {}
+    for message in messages:
+        by_chat.setdefault(message.chat_id, []).append(message_data(message, username))
+    frames = {}
+    for chat_id, items in by_chat.items():
+        if len(items) == 1:
+            frames[chat_id] = dumps_text(items[0])
+        else:
+            frames[chat_id] = batch_frame(chat_id, items)
+    return frames
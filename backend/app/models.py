@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Text, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, Text, DateTime, Index, DDL, event, func
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .db import Base
@@ -20,6 +20,14 @@ class ChatMember(Base):
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # Read cursor: newest message id this member has read (None: nothing yet)
+    last_read_message_id = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        # Membership checks and the per-user chat list
+        Index("ix_chat_members_user_id_chat_id", "user_id", "chat_id"),
+        Index("uq_chat_members_chat_id_user_id", "chat_id", "user_id", unique=True),
+    )
 
 class Message(Base):
     __tablename__ = "messages"
@@ -28,3 +36,53 @@ class Message(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Keyset pagination in get_messages: WHERE chat_id = ? AND id < ? ORDER BY id
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        Index("ix_messages_chat_id_timestamp", "chat_id", "timestamp"),
+    )
+
+class UserChat(Base):
+    """A user's entry in their chat list (inbox), maintained on write.
+
+    Holds what the sidebar shows, so listing chats is one scan of the
+    user's rows in ``last_message_time`` order with no joins.
+    """
+    __tablename__ = "user_chats"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id"), primary_key=True)
+    # Chat name as this user sees it ("Chat with <other user>" for private chats)
+    display_name = Column(String, nullable=True)
+    last_message_preview = Column(String, nullable=True)
+    last_message_time = Column(DateTime, nullable=True)
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+    __table_args__ = (
+        # GET /api/chats/: WHERE user_id = ? ORDER BY last_message_time DESC
+        Index("ix_user_chats_user_id_last_message_time", "user_id", "last_message_time"),
+        # Write path: every member's row of a chat
+        Index("ix_user_chats_chat_id", "chat_id"),
+    )
+
+# Case-insensitive username lookups in register/login: lower(username) = ?
+Index("ix_users_username_lower", func.lower(User.username))
+
+
+# Message search on SQLite (app.search): an external-content FTS5 table over
+# messages.content kept in sync by triggers. PostgreSQL uses the GIN index on
+# to_tsvector(content) created by migration 0004 instead.
+MESSAGES_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); END",
+]
+for statement in MESSAGES_FTS_DDL:
+    event.listen(Message.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Message.__table__, "after_drop", DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect="sqlite"))
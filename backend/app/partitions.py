@@ -0,0 +1,115 @@
+import asyncio
+import os
+from sqlalchemy import text
+from app.log import get_logger
+
+logger = get_logger(__name__)
+
+# PostgreSQL only, opt-in: migration 0007 turns messages into a table
+# partitioned by ranges of message ids. Ids grow with time, so each
+# partition is a time bucket, and history pages (keyset ranges on id) only
+# touch the partitions their cursor reaches. Must be set when the
+# migration runs; SQLite ignores it.
+MESSAGE_PARTITIONING = os.getenv("MESSAGE_PARTITIONING", "false").lower() == "true"
+# Message ids per partition
+MESSAGE_PARTITION_SIZE = int(os.getenv("MESSAGE_PARTITION_SIZE", "10000000"))
+# Empty partitions kept ready above the one receiving inserts
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", "2"))
+# Seconds between checks for missing future partitions
+MESSAGE_PARTITION_CHECK_INTERVAL = float(os.getenv("MESSAGE_PARTITION_CHECK_INTERVAL", "3600"))
+
+# Serializes partition creation between workers
+_LOCK_KEY = 0x6D736770
+
+_IS_PARTITIONED = text(
+    "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('messages')"
+)
+_EXISTING = text(
+    "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+    "WHERE i.inhparent = to_regclass('messages')"
+)
+
+
+def partition_name(index: int) -> str:
+    return f"messages_p{index:05d}"
+
+
+def partition_ddl(index: int, size: int = MESSAGE_PARTITION_SIZE) -> str:
+    """CREATE statement for the partition holding ids [index * size, (index + 1) * size)."""
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(index)} PARTITION OF messages "
+        f"FOR VALUES FROM ({index * size}) TO ({(index + 1) * size})"
+    )
+
+
+def planned_partitions(max_id: int, size: int = MESSAGE_PARTITION_SIZE,
+                       ahead: int = MESSAGE_PARTITIONS_AHEAD) -> list:
+    """Indexes of the partition holding ``max_id`` and the ``ahead`` after it.
+
+    Older partitions are never planned, so ones that were detached or
+    dropped are not recreated.
+    """
+    current = max_id // size
+    return list(range(current, current + ahead + 1))
+
+
+def ensure_partitions(conn) -> list:
+    """Create missing future partitions; returns their names.
+
+    Takes a sync connection (use ``run_sync`` from async code) and does
+    nothing when messages is not partitioned.
+    """
+    if conn.dialect.name != "postgresql" or conn.execute(_IS_PARTITIONED).first() is None:
+        return []
+    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _LOCK_KEY})
+    existing = set(conn.execute(_EXISTING).scalars())
+    # The newest id comes from the last partitions' (id) index
+    max_id = conn.execute(text("SELECT coalesce(max(id), 0) FROM messages")).scalar()
+    created = []
+    for index in planned_partitions(max_id):
+        if partition_name(index) not in existing:
+            conn.execute(text(partition_ddl(index)))
+            created.append(partition_name(index))
+    return created
+
+
+class PartitionMaintainer:
+    """Background task that keeps future message partitions created.
+
+    An insert whose id has no partition fails, so partitions are created
+    ``MESSAGE_PARTITIONS_AHEAD`` ranges before they are needed.
+    """
+
+    def __init__(self, interval: float = MESSAGE_PARTITION_CHECK_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    def start(self, engine):
+        if not MESSAGE_PARTITIONING or engine.dialect.name != "postgresql":
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run(engine))
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self, engine):
+        while True:
+            try:
+                async with engine.begin() as conn:
+                    created = await conn.run_sync(ensure_partitions)
+                if created:
+                    logger.info("message_partitions_created", partitions=created)
+            except Exception as e:
+                logger.error("message_partition_maintenance_failed", exc_info=e)
+            await asyncio.sleep(self.interval)
+
+
+partition_maintainer = PartitionMaintainer()
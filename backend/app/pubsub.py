@@ -0,0 +1,341 @@
+import asyncio
+import os
+import uuid
+from app.encoding import dumps_text, loads
+from app.log import get_logger
+
+logger = get_logger(__name__)
+
+# Which transport carries broadcasts between workers:
+# - memory: deliver only to sockets in this process (single worker);
+# - postgres: PostgreSQL LISTEN/NOTIFY on the application database;
+# - redis: Redis (or any protocol-compatible server) PUBLISH/SUBSCRIBE.
+BROADCAST_BACKEND = os.getenv("BROADCAST_BACKEND", "memory").lower()
+BROADCAST_CHANNEL = os.getenv("BROADCAST_CHANNEL", "messenger_broadcast")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Identifies this process so a connection exclusion is only applied by the
+# worker that actually owns the connection
+WORKER_ID = uuid.uuid4().hex[:12]
+
+
+class Event:
+    """A payload to deliver to every local socket in a chat.
+
+    ``seq`` orders replayable events within the chat (the newest message id
+    in the payload); events without one are not kept for replay. Events
+    with a ``coalesce_key`` supersede a still-queued event with the same key
+    on connections using the coalesce overflow policy.
+    """
+    __slots__ = ("chat_id", "payload", "exclude_user_id", "origin", "exclude_connection", "seq", "coalesce_key")
+
+    def __init__(self, chat_id: int, payload: str, exclude_user_id: int = None,
+                 origin: str = WORKER_ID, exclude_connection: int = None, seq: int = None,
+                 coalesce_key: str = None):
+        self.chat_id = chat_id
+        self.payload = payload
+        self.exclude_user_id = exclude_user_id
+        self.origin = origin
+        self.exclude_connection = exclude_connection
+        self.seq = seq
+        self.coalesce_key = coalesce_key
+
+
+def encode_event(event: Event) -> str:
+    # A one-line JSON header followed by the payload verbatim, so the
+    # already-serialized payload is not escaped and re-encoded
+    header = dumps_text({
+        "chat_id": event.chat_id,
+        "exclude_user_id": event.exclude_user_id,
+        "origin": event.origin,
+        "exclude_connection": event.exclude_connection,
+        "seq": event.seq,
+        "coalesce_key": event.coalesce_key,
+    })
+    return f"{header}\n{event.payload}"
+
+
+def decode_event(data: str) -> Event:
+    header, _, payload = data.partition("\n")
+    fields = loads(header)
+    return Event(
+        fields["chat_id"], payload,
+        exclude_user_id=fields.get("exclude_user_id"),
+        origin=fields.get("origin"),
+        exclude_connection=fields.get("exclude_connection"),
+        seq=fields.get("seq"),
+        coalesce_key=fields.get("coalesce_key"),
+    )
+
+
+class BroadcastBackend:
+    """Carries broadcast events to every worker.
+
+    ``handler`` is called with each Event on every worker, including the one
+    that published it, and fans the event out to that worker's own sockets.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self._started = None
+
+    async def start(self):
+        pass
+
+    async def _start_once(self, start):
+        """Await a single ``start()`` shared by all callers.
+
+        A start that fails is forgotten, so the next caller tries again
+        instead of re-raising the same error forever.
+        """
+        if self._started is None:
+            self._started = asyncio.ensure_future(start())
+        started = self._started
+        try:
+            # A cancelled caller must not cancel the start others wait on
+            await asyncio.shield(started)
+        except BaseException:
+            if started.done() and self._started is started:
+                self._started = None
+            raise
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: Event):
+        raise NotImplementedError
+
+    def _dispatch(self, data: str):
+        try:
+            event = decode_event(data)
+        except (ValueError, KeyError) as e:
+            logger.warning("broadcast_event_malformed", error=repr(e))
+            return
+        try:
+            self.handler(event)
+        except Exception as e:
+            # One bad event must not stop the listener delivering the rest
+            logger.error("broadcast_dispatch_failed", exc_info=e, chat_id=event.chat_id)
+
+
+class InMemoryBackend(BroadcastBackend):
+    """Single-process backend: events go straight to local sockets."""
+
+    async def publish(self, event: Event):
+        self.handler(event)
+
+
+class LocalHub:
+    """In-process stand-in for a message broker, shared by LocalBackends.
+
+    Lets tests run several "workers" in one process and check that an event
+    published on one reaches sockets held by the others.
+    """
+
+    def __init__(self):
+        self.backends = []
+
+
+class LocalBackend(BroadcastBackend):
+    def __init__(self, handler, hub: LocalHub):
+        super().__init__(handler)
+        self.hub = hub
+
+    async def start(self):
+        if self not in self.hub.backends:
+            self.hub.backends.append(self)
+
+    async def stop(self):
+        if self in self.hub.backends:
+            self.hub.backends.remove(self)
+
+    async def publish(self, event: Event):
+        data = encode_event(event)
+        for backend in list(self.hub.backends):
+            backend._dispatch(data)
+
+
+class PostgresBackend(BroadcastBackend):
+    """LISTEN/NOTIFY on the application database (requires asyncpg).
+
+    NOTIFY payloads are limited to 8000 bytes, so larger events are written
+    to a small unlogged spool table and only their id is notified.
+    Notifications are dispatched by one task in arrival order, so a spooled
+    event is not overtaken by smaller ones notified after it.
+    """
+
+    NOTIFY_LIMIT = 7900
+    SPOOL_RETENTION_SECONDS = 60
+
+    def __init__(self, handler, dsn: str, channel: str = BROADCAST_CHANNEL):
+        super().__init__(handler)
+        self.dsn = dsn
+        self.channel = channel
+        self._pool = None
+        self._listener = None
+        self._dispatcher = None
+        self._received = asyncio.Queue()
+
+    async def start(self):
+        await self._start_once(self._start)
+
+    async def _start(self):
+        import asyncpg
+        pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=4)
+        try:
+            await pool.execute(
+                "CREATE UNLOGGED TABLE IF NOT EXISTS broadcast_spool ("
+                "id BIGSERIAL PRIMARY KEY, payload TEXT NOT NULL, "
+                "created_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            )
+        except BaseException:
+            await pool.close()
+            raise
+        self._pool = pool
+        self._dispatcher = asyncio.ensure_future(self._dispatch_in_order())
+        self._listener = asyncio.ensure_future(self._listen_forever())
+
+    async def _listen_forever(self):
+        import asyncpg
+        while True:
+            lost = asyncio.get_running_loop().create_future()
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                conn.add_termination_listener(lambda _: lost.done() or lost.set_result(None))
+                await conn.add_listener(self.channel, self._on_notify)
+                await lost
+                logger.warning("broadcast_listen_lost")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("broadcast_listen_failed", error=repr(e))
+            await asyncio.sleep(1)
+
+    def _on_notify(self, connection, pid, channel, data):
+        self._received.put_nowait(data)
+
+    async def _dispatch_in_order(self):
+        while True:
+            data = await self._received.get()
+            if data.startswith("@"):
+                try:
+                    data = await self._pool.fetchval(
+                        "SELECT payload FROM broadcast_spool WHERE id = $1", int(data[1:])
+                    )
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("broadcast_spool_read_failed", spool_id=data[1:], error=repr(e))
+                    continue
+                if data is None:
+                    logger.warning("broadcast_spool_expired")
+                    continue
+            self._dispatch(data)
+
+    async def publish(self, event: Event):
+        await self.start()
+        data = encode_event(event)
+        if len(data.encode("utf-8")) > self.NOTIFY_LIMIT:
+            async with self._pool.acquire() as conn:
+                spool_id = await conn.fetchval(
+                    "INSERT INTO broadcast_spool (payload) VALUES ($1) RETURNING id", data
+                )
+                await conn.execute(
+                    "DELETE FROM broadcast_spool WHERE created_at < now() - make_interval(secs => $1)",
+                    self.SPOOL_RETENTION_SECONDS,
+                )
+            data = f"@{spool_id}"
+        await self._pool.execute("SELECT pg_notify($1, $2)", self.channel, data)
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        if self._pool is not None:
+            await self._pool.close()
+        self._started = None
+
+
+class RedisBackend(BroadcastBackend):
+    """PUBLISH/SUBSCRIBE on a Redis-compatible server (requires redis>=4.2).
+
+    The subscription is recreated with backoff whenever it fails, since
+    this worker's own sockets are fed through it too.
+    """
+
+    RETRY_MIN_SECONDS = 1
+    RETRY_MAX_SECONDS = 30
+
+    def __init__(self, handler, url: str = REDIS_URL, channel: str = BROADCAST_CHANNEL):
+        super().__init__(handler)
+        self.url = url
+        self.channel = channel
+        self._client = None
+        self._reader = None
+
+    async def start(self):
+        await self._start_once(self._start)
+
+    async def _start(self):
+        import redis.asyncio as redis
+        self._client = redis.from_url(self.url, decode_responses=True)
+        pubsub = self._client.pubsub()
+        await pubsub.subscribe(self.channel)
+        self._reader = asyncio.ensure_future(self._read(pubsub))
+
+    async def _read(self, pubsub):
+        delay = self.RETRY_MIN_SECONDS
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self._client.pubsub()
+                    await pubsub.subscribe(self.channel)
+                    logger.info("broadcast_subscribe_restored")
+                delay = self.RETRY_MIN_SECONDS
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self._dispatch(message["data"])
+                logger.warning("broadcast_subscribe_lost")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("broadcast_subscribe_failed", error=repr(e), retry_in=delay)
+            if pubsub is not None:
+                try:
+                    await pubsub.reset()
+                except Exception:
+                    pass
+                pubsub = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RETRY_MAX_SECONDS)
+
+    async def publish(self, event: Event):
+        await self.start()
+        await self._client.publish(self.channel, encode_event(event))
+
+    async def stop(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self._client is not None:
+            await self._client.close()
+        self._started = None
+
+
+def create_backend(handler, name: str = None) -> BroadcastBackend:
+    name = (name or BROADCAST_BACKEND).lower()
+    if name == "memory":
+        return InMemoryBackend(handler)
+    if name == "postgres":
+        from app.db import DB_PGBOUNCER, SQLALCHEMY_DATABASE_URL
+        if not SQLALCHEMY_DATABASE_URL.startswith("postgresql"):
+            raise ValueError("BROADCAST_BACKEND=postgres requires a PostgreSQL database")
+        if DB_PGBOUNCER:
+            # A transaction pooler hands LISTEN's session to other clients
+            # and never delivers the notifications
+            raise ValueError("BROADCAST_BACKEND=postgres does not work through PgBouncer (DB_PGBOUNCER); use redis")
+        dsn = "postgresql://" + SQLALCHEMY_DATABASE_URL.split("://", 1)[1]
+        return PostgresBackend(handler, dsn)
+    if name == "redis":
+        return RedisBackend(handler)
+    raise ValueError(f"Unknown BROADCAST_BACKEND: {name}")
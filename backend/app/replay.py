@@ -0,0 +1,83 @@
+import bisect
+import os
+import threading
+from collections import OrderedDict, deque
+
+# Recent events kept per chat for clients resuming after a reconnect
+WS_REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "200"))
+# Chats with a buffer; the least recently written chat's buffer is dropped
+WS_REPLAY_CHATS = int(os.getenv("WS_REPLAY_CHATS", "10000"))
+
+
+class ChatReplayBuffer:
+    """Ring buffer of one chat's recent events, ordered by sequence number.
+
+    Sequence numbers are message ids, so they increase monotonically per
+    chat but are not contiguous. The buffer is complete for every sequence
+    number above ``floor``: the newest evicted event, or just below the
+    first event recorded (events before it were never seen here).
+    """
+
+    def __init__(self, maxlen: int, first_seq: int):
+        self.maxlen = maxlen
+        self.floor = first_seq - 1
+        self._seqs = deque()
+        self._payloads = deque()
+
+    def record(self, seq: int, payload: str):
+        if seq <= self.floor:
+            return
+        # Workers publish concurrently, so an event can arrive slightly out of order
+        index = len(self._seqs)
+        if self._seqs and seq <= self._seqs[-1]:
+            index = bisect.bisect_left(self._seqs, seq)
+            if index < len(self._seqs) and self._seqs[index] == seq:
+                return
+        self._seqs.insert(index, seq)
+        self._payloads.insert(index, payload)
+        while len(self._seqs) > self.maxlen:
+            self.floor = self._seqs.popleft()
+            self._payloads.popleft()
+
+    def since(self, last_seq: int):
+        """Payloads of events after ``last_seq``, or None if some were evicted."""
+        if last_seq < self.floor:
+            return None
+        index = bisect.bisect_right(self._seqs, last_seq)
+        return list(self._payloads)[index:]
+
+
+class ReplayBuffers:
+    """Per-chat replay buffers, bounded in events per chat and in chat count."""
+
+    def __init__(self, buffer_size: int = WS_REPLAY_BUFFER_SIZE, max_chats: int = WS_REPLAY_CHATS):
+        self.buffer_size = buffer_size
+        self.max_chats = max_chats
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, chat_id: int, seq: int, payload: str):
+        if self.buffer_size <= 0 or self.max_chats <= 0:
+            return
+        with self._lock:
+            buffer = self._buffers.get(chat_id)
+            if buffer is None:
+                buffer = self._buffers[chat_id] = ChatReplayBuffer(self.buffer_size, seq)
+                while len(self._buffers) > self.max_chats:
+                    self._buffers.popitem(last=False)
+            else:
+                self._buffers.move_to_end(chat_id)
+            buffer.record(seq, payload)
+
+    def since(self, chat_id: int, last_seq: int):
+        """Payloads after ``last_seq`` for a chat, or None to fall back to the DB."""
+        with self._lock:
+            buffer = self._buffers.get(chat_id)
+            return buffer.since(last_seq) if buffer is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+
+    def __len__(self):
+        return len(self._buffers)
@@ -1,69 +1,76 @@
-from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from app.db import get_db
-from app.models import Chat, User, ChatMember
-from app.schemas import ChatOut
-from jose import JWTError, jwt
-from app.auth import SECRET_KEY
+from sqlalchemy import desc, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db import get_async_db, get_db
+from app.archive import message_archive
+from app.encoding import JSONBytesResponse
+from app.inbox import mark_read, new_chat_entries
+from app.models import Chat, User, ChatMember, UserChat
+from app.schemas import ChatOut, InboxChatOut, ReadReceipt, ReadStateOut, UnreadOut
+from app.dependencies import CurrentUser, get_current_user, get_current_user_async
+from app.websocket import publish_read_state
 
 router = APIRouter()
 
-def get_current_user(authorization: str = Header(None), db: Session = Depends(get_db)):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Not authenticated")
+@router.get("/", response_model=list[InboxChatOut])
+async def get_chats(current_user: CurrentUser = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    # The user's inbox rows already hold the display name, preview and
+    # unread count, so this is one scan of the (user_id, last_message_time)
+    # index. The rows are encoded directly; InboxChatOut only documents the shape.
+    rows = (await db.execute(
+        select(
+            UserChat.chat_id,
+            UserChat.display_name,
+            UserChat.last_message_time,
+            UserChat.last_message_preview,
+            UserChat.unread_count,
+        ).where(
+            UserChat.user_id == current_user.id
+        ).order_by(desc(UserChat.last_message_time))
+    )).all()
     
-    token = authorization.split(" ")[1]
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        username = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
-        raise HTTPException(status_code=401, detail="User not found")
-    return user
+    return JSONBytesResponse([
+        {
+            "id": row.chat_id,
+            "name": row.display_name,
+            "last_message_time": row.last_message_time,
+            "last_message_preview": row.last_message_preview,
+            "unread_count": row.unread_count,
+        }
+        for row in rows
+    ])
 
-@router.get("/", response_model=list[ChatOut])
-def get_chats(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Get only chats where the current user is a member
-    chats = db.query(Chat).join(ChatMember).filter(
-        ChatMember.user_id == current_user.id
-    ).order_by(desc(Chat.last_message_time)).all()
-    
-    # Format chat names based on chat type and other members
-    result = []
-    for chat in chats:
-        # Get all members of this chat
-        members = db.query(ChatMember).filter(ChatMember.chat_id == chat.id).all()
-        member_ids = [m.user_id for m in members]
-        
-        # If it's a private chat (2 members), show the other user's name
-        if len(member_ids) == 2:
-            # Find the other user (not current_user)
-            other_user_id = [uid for uid in member_ids if uid != current_user.id][0]
-            other_user = db.query(User).filter(User.id == other_user_id).first()
-            if other_user:
-                # Create a copy of chat data with modified name
-                chat_dict = {
-                    "id": chat.id,
-                    "name": f"Chat with {other_user.username}",
-                    "last_message_time": chat.last_message_time
-                }
-                result.append(chat_dict)
-            else:
-                result.append(chat)
-        else:
-            # Public chat - use original name
-            result.append(chat)
-    
-    return result
+@router.get("/unread", response_model=UnreadOut)
+async def get_unread(current_user: CurrentUser = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    """Unread badges for all of the user's chats from one read of their inbox rows."""
+    rows = (await db.execute(
+        select(UserChat.chat_id, UserChat.unread_count)
+        .where(UserChat.user_id == current_user.id, UserChat.unread_count > 0)
+    )).all()
+    return {
+        "total": sum(row.unread_count for row in rows),
+        "chats": [{"chat_id": row.chat_id, "unread_count": row.unread_count} for row in rows],
+    }
+
+@router.post("/{chat_id}/read", response_model=ReadStateOut)
+async def read_chat(chat_id: int, receipt: Optional[ReadReceipt] = None,
+                    current_user: CurrentUser = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    """Mark the chat read up to ``message_id`` (default: its newest message)."""
+    state = await mark_read(
+        db, current_user.id, chat_id, receipt.message_id if receipt else None,
+        archived_id=await message_archive.current_boundary(chat_id),
+    )
+    if state is None:
+        raise HTTPException(status_code=403, detail="Not a member of this chat")
+    cursor, unread_count = state
+    if cursor is not None:
+        await publish_read_state(chat_id, current_user.id, cursor)
+    return {"chat_id": chat_id, "last_read_message_id": cursor, "unread_count": unread_count}
 
 @router.post("/", response_model=ChatOut)
-def create_chat(name: str = None, user_id: int = None, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def create_chat(name: str = None, user_id: int = None, current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)):
     try:
         if user_id:
             # Create private chat with specific user
@@ -87,12 +94,16 @@ def create_chat(name: str = None, user_id: int = None, current_user: User = Depe
         # Add current user as a member of the chat
         member = ChatMember(chat_id=chat.id, user_id=current_user.id)
         db.add(member)
+        members = [(current_user.id, current_user.username)]
         
         # If it's a private chat, add the other user as well
         if user_id:
             other_member = ChatMember(chat_id=chat.id, user_id=user_id)
             db.add(other_member)
+            members.append((user.id, user.username))
         
+        # Every member's inbox entry, in the same transaction as the membership
+        db.add_all(new_chat_entries(chat, members))
         db.commit()
         return chat
     except HTTPException:
@@ -1,112 +1,191 @@
-from fastapi import APIRouter, Depends, HTTPException, Header
-from sqlalchemy.orm import Session
-from datetime import datetime
-import json
-from app.db import get_db
-from app.models import Message, User, Chat
-from app.schemas import MessageCreate
-from app.auth import SECRET_KEY
-from app.websocket import active_connections, connection_users
-from jose import JWTError, jwt
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
+import asyncio
+import os
+from app.archive import message_archive
+from app.db import get_async_db
+from app.encoding import JSONBytesResponse, dumps_text, join_array
+from app.history import MESSAGE_CACHE_PER_CHAT, recent_messages
+from app.log import get_logger
+from app.messaging import MESSAGE_COLUMNS, ChatNotFound, chat_frames, encode_message, message_data, save_messages
+from app.models import Message, Chat, ChatMember
+from app.schemas import MessageBatchCreate, MessageCreate, MessageOut, MessageSearchResult
+from app.search import MESSAGE_SEARCH_LIMIT_DEFAULT, MESSAGE_SEARCH_LIMIT_MAX, search_messages as find_messages
+from app.dependencies import CurrentUser, get_current_user_async
+from app.websocket import publish
 
 router = APIRouter()
+logger = get_logger(__name__)
 
-def get_current_user(authorization: str = Header(None), db: Session = Depends(get_db)):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    token = authorization.split(" ")[1]
+# Page size for GET /api/messages/{chat_id}; requests above the cap are clamped
+MESSAGES_PAGE_DEFAULT = int(os.getenv("MESSAGES_PAGE_DEFAULT", "50"))
+MESSAGES_PAGE_MAX = int(os.getenv("MESSAGES_PAGE_MAX", "200"))
+# Largest accepted POST /api/messages/batch
+MESSAGES_BATCH_MAX = int(os.getenv("MESSAGES_BATCH_MAX", "500"))
+
+@router.post("/", response_model=MessageOut)
+async def send_message(msg: MessageCreate, current_user: CurrentUser = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        username = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+        # Chat lookup, insert, last_message_time update and commit; the
+        # session keeps attributes loaded after commit, so id and timestamp
+        # are available without a refresh query
+        [message] = await save_messages(db, current_user.id, [msg])
+    except ChatNotFound:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
+    
+    # Broadcast message to all WebSocket connections in this chat. Other
+    # workers may hold sockets for it, so publish even if none are local.
+    # Serialize once and publish once; every worker queues it on its own
+    # sockets for this chat, and delivery happens in each connection's
+    # writer task, so the response does not wait for slow clients. The
+    # sender is excluded since they already see the message locally.
+    logger.sampled("message_sent", message_id=message.id, chat_id=message.chat_id, user_id=current_user.id)
+    await publish(msg.chat_id, dumps_text(message_data(message, current_user.username)),
+                  exclude_user_id=current_user.id, seq=message.id)
     
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
-        raise HTTPException(status_code=401, detail="User not found")
-    return user
+    return JSONBytesResponse(encode_message(message))
 
-@router.post("/")
-async def send_message(msg: MessageCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+@router.post("/batch", response_model=list[MessageOut])
+async def send_messages_batch(batch: MessageBatchCreate, current_user: CurrentUser = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    """Send many messages, possibly to several chats, in one transaction.
+
+    The batch is all or nothing: if any chat does not exist nothing is
+    saved. Each chat receives a single WebSocket frame for its messages.
+    """
+    if len(batch.messages) > MESSAGES_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {MESSAGES_BATCH_MAX} messages per batch")
     try:
-        # Check if chat exists
-        chat = db.query(Chat).filter(Chat.id == msg.chat_id).first()
-        if not chat:
-            raise HTTPException(status_code=404, detail="Chat not found")
-        
-        message = Message(chat_id=msg.chat_id, user_id=current_user.id, content=msg.content)
-        db.add(message)
-        
-        # Update chat's last_message_time
-        chat.last_message_time = datetime.utcnow()
-        
-        db.commit()
-        db.refresh(message)
-        
-        # Broadcast message to all WebSocket connections in this chat
-        print(f"Checking WebSocket connections for chat {msg.chat_id}")
-        print(f"Active connections: {list(active_connections.keys())}")
-        if msg.chat_id in active_connections:
-            print(f"Chat {msg.chat_id} has {len(active_connections[msg.chat_id])} connections")
-        
-        if msg.chat_id in active_connections and len(active_connections[msg.chat_id]) > 0:
-            message_data = {
-                "id": message.id,
-                "chat_id": message.chat_id,
-                "user_id": message.user_id,
-                "content": message.content,
-                "timestamp": message.timestamp.isoformat()
-            }
-            # Get username for the message
-            user = db.query(User).filter(User.id == message.user_id).first()
-            if user:
-                message_data["username"] = user.username
-            
-            message_json = json.dumps(message_data)
-            # Send to all connected clients in this chat, EXCEPT the sender
-            # (sender already sees the message locally)
-            disconnected = []
-            sender_user_id = current_user.id
-            connections_to_notify = [conn for conn in active_connections[msg.chat_id] 
-                                   if connection_users.get(conn) != sender_user_id]
-            
-            print(f"Broadcasting message {message.id} to {len(connections_to_notify)} connections (excluding sender {sender_user_id})")
-            
-            for conn in connections_to_notify:
-                try:
-                    await conn.send_text(message_json)
-                    print(f"Message sent to connection (user_id: {connection_users.get(conn)})")
-                except Exception as e:
-                    print(f"Error broadcasting message to WebSocket: {e}")
-                    disconnected.append(conn)
-            
-            # Remove disconnected connections
-            for conn in disconnected:
-                if msg.chat_id in active_connections:
-                    active_connections[msg.chat_id].remove(conn)
-                    if not active_connections[msg.chat_id]:
-                        del active_connections[msg.chat_id]
-                    if conn in connection_users:
-                        del connection_users[conn]
-        else:
-            print(f"No active WebSocket connections for chat {msg.chat_id}")
-        
-        return message
-    except HTTPException:
-        raise
+        messages = await save_messages(db, current_user.id, batch.messages)
+    except ChatNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Failed to send messages: {str(e)}")
+    
+    # Messages are in id order, so this keeps each chat's newest id
+    last_ids = {message.chat_id: message.id for message in messages}
+    for chat_id, frame in chat_frames(messages, current_user.username).items():
+        await publish(chat_id, frame, exclude_user_id=current_user.id, seq=last_ids[chat_id])
+    return JSONBytesResponse(join_array(encode_message(message) for message in messages))
+
+# Declared before /{chat_id} so "search" is not parsed as a chat id
+@router.get("/search", response_model=list[MessageSearchResult])
+async def search_messages(
+    response: Response,
+    q: str = Query(..., min_length=1),
+    chat_id: Optional[int] = Query(None, ge=1),
+    before_id: Optional[int] = Query(None, ge=1),
+    limit: int = Query(MESSAGE_SEARCH_LIMIT_DEFAULT, ge=1),
+    current_user: CurrentUser = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Full-text search over the chats the current user is a member of.
+
+    Results are newest first, with a highlighted ``snippet``; the cursor
+    for the next page is returned in the ``X-Next-Cursor`` header and is
+    passed back as ``before_id``.
+    """
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Search query cannot be empty")
+    if chat_id is not None:
+        is_member = await db.scalar(
+            select(ChatMember.id).where(ChatMember.chat_id == chat_id, ChatMember.user_id == current_user.id)
+        )
+        if is_member is None:
+            raise HTTPException(status_code=403, detail="Not a member of this chat")
+
+    rows, next_cursor = await find_messages(
+        db, current_user.id, q.strip(), min(limit, MESSAGE_SEARCH_LIMIT_MAX), chat_id=chat_id, before_id=before_id
+    )
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return rows
+
+@router.get("/{chat_id}", response_model=list[MessageOut])
+async def get_messages(
+    chat_id: int,
+    before_id: Optional[int] = Query(None, ge=1),
+    after_id: Optional[int] = Query(None, ge=1),
+    limit: int = Query(MESSAGES_PAGE_DEFAULT, ge=1),
+    current_user: CurrentUser = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Return one page of a chat's history, oldest message first.
+
+    Pagination is keyset-based on ``Message.id`` so every page is a single
+    range scan of the ``(chat_id, id)`` index:
+
+    - no cursor: the newest ``limit`` messages;
+    - ``before_id``: the ``limit`` messages immediately older than it;
+    - ``after_id``: the ``limit`` messages immediately newer than it.
+
+    When more messages exist in the requested direction, the cursor for the
+    next page is returned in the ``X-Next-Cursor`` header.
+
+    With messages partitioned by id range (``app.partitions``) the cursor
+    bound prunes the partitions on its far side, and the ordered, limited
+    scan stops at the first partitions that fill the page.
+
+    The newest page of recently read chats is served from the history cache
+    without touching the database. Messages moved to the archive
+    (``app.archive``) are read from there when a page reaches them.
+    """
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+    limit = min(limit, MESSAGES_PAGE_MAX)
+    newest_page = before_id is None and after_id is None
+
+    if newest_page:
+        cached = recent_messages.page(chat_id, limit)
+        if cached is not None:
+            return messages_response(*cached)
+        # Taken before querying, so a write that lands meanwhile keeps this
+        # (possibly stale) page out of the cache
+        cache_version = recent_messages.version()
 
-@router.get("/{chat_id}")
-def get_messages(chat_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     # Check if chat exists
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
-    if not chat:
+    chat_exists = await db.scalar(select(Chat.id).where(Chat.id == chat_id))
+    if chat_exists is None:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    messages = db.query(Message).filter(Message.chat_id == chat_id).order_by(Message.timestamp).all()
-    return messages
+    # Plain rows: encoded straight to JSON without building ORM objects
+    query = select(*MESSAGE_COLUMNS).where(Message.chat_id == chat_id)
+    if after_id is not None:
+        query = query.where(Message.id > after_id).order_by(Message.id)
+    else:
+        if before_id is not None:
+            query = query.where(Message.id < before_id)
+        query = query.order_by(Message.id.desc())
+    
+    # A cache miss reads enough rows to fill the chat's cache entry
+    fetch = max(limit, MESSAGE_CACHE_PER_CHAT) if newest_page else limit
+    # Fetch one extra row to learn whether another page exists
+    messages = (await db.execute(query.limit(fetch + 1))).all()
+    if after_id is None:
+        messages.reverse()
+    encoded = [(message.id, encode_message(message)) for message in messages]
+    # Old history may have moved to the archive: continue there when the
+    # page runs out in the database or the cursor is behind the boundary
+    boundary = await message_archive.current_boundary(chat_id)
+    if boundary and (after_id < boundary if after_id is not None else len(encoded) <= fetch):
+        encoded = await asyncio.to_thread(
+            message_archive.extend_page, chat_id, encoded, before_id, after_id, fetch + 1
+        )
+    if newest_page:
+        recent_messages.fill(chat_id, encoded[-fetch:], len(encoded) > fetch, cache_version)
+    
+    has_more = len(encoded) > limit
+    encoded = encoded[:limit] if after_id is not None else encoded[-limit:]
+    next_cursor = None
+    if has_more:
+        next_cursor = encoded[-1][0] if after_id is not None else encoded[0][0]
+    return messages_response(join_array(item for _, item in encoded), next_cursor)
+
+def messages_response(body: bytes, next_cursor: Optional[int]) -> Response:
+    headers = {"X-Next-Cursor": str(next_cursor)} if next_cursor is not None else None
+    return JSONBytesResponse(body, headers=headers)
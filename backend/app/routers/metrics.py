@@ -0,0 +1,35 @@
+from fastapi import APIRouter, Depends
+from app.db import async_engine, engine, pool_stats
+from app.dependencies import require_metrics_token
+from app.archive import message_archive
+from app.history import recent_messages
+from app.messaging import message_writer
+from app.websocket import connection_metrics
+
+router = APIRouter(dependencies=[Depends(require_metrics_token)])
+
+@router.get("/websockets")
+def get_websocket_metrics():
+    connections = connection_metrics()
+    return {
+        "connections": len(connections),
+        "queued": sum(c["queue_depth"] for c in connections),
+        "dropped": sum(c["dropped"] for c in connections),
+        "per_connection": connections,
+    }
+
+@router.get("/db")
+def get_db_pool_metrics():
+    return {
+        "sync": pool_stats(engine.pool),
+        "async": pool_stats(async_engine.sync_engine.pool),
+        "group_commit": message_writer.stats(),
+    }
+
+@router.get("/history")
+def get_history_cache_metrics():
+    return recent_messages.stats()
+
+@router.get("/archive")
+def get_archive_metrics():
+    return message_archive.stats()
@@ -1,41 +1,50 @@
-from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from app.db import get_db
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
+import os
+from app.db import get_async_db, get_db
 from app.models import User
-from app.auth import hash_password, verify_password, create_access_token, SECRET_KEY
+from app.auth import (
+    HashingPoolFull, create_access_token, hash_password_async, needs_rehash, verify_password_async
+)
 from app.schemas import UserCreate, UserOut, Token
-from jose import JWTError, jwt
+from app.search import USER_SEARCH_LIMIT_DEFAULT, USER_SEARCH_LIMIT_MAX, search_users as find_users, username_index
+from app.dependencies import CurrentUser, get_current_user, get_current_user_async
 
 router = APIRouter()
 
-def get_current_user(authorization: str = Header(None), db: Session = Depends(get_db)):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    token = authorization.split(" ")[1]
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        username = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
-        raise HTTPException(status_code=401, detail="User not found")
-    return user
+# Page size for GET /api/users/; requests above the cap are clamped
+USERS_PAGE_DEFAULT = int(os.getenv("USERS_PAGE_DEFAULT", "100"))
+USERS_PAGE_MAX = int(os.getenv("USERS_PAGE_MAX", "1000"))
+
+def find_user_by_username(db: Session, username: str):
+    # Case-insensitive lookup
+    # Use lower() for compatibility with both PostgreSQL and SQLite
+    return db.query(User).filter(
+        func.lower(User.username) == username.strip().lower()
+    ).first()
+
+def save_user(db: Session, db_user: User):
+    db.add(db_user)
+    db.commit()
+    db.refresh(db_user)
+    return db_user
+
+def server_busy():
+    return HTTPException(status_code=503, detail="Server is busy, try again later", headers={"Retry-After": "1"})
+
+# register/login are async so that the slow bcrypt step is awaited on the
+# dedicated hashing pool rather than holding a shared threadpool slot; the
+# short DB calls around it still run in the threadpool.
 
 @router.post("/register", response_model=UserOut)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: Session = Depends(get_db)):
     try:
         # Check if username already exists (case-insensitive)
-        # Use lower() for compatibility with both PostgreSQL and SQLite
-        username_lower = user.username.strip().lower()
-        existing_user = db.query(User).filter(
-            func.lower(User.username) == username_lower
-        ).first()
+        existing_user = await run_in_threadpool(find_user_by_username, db, user.username)
         if existing_user:
             raise HTTPException(status_code=400, detail="Username already exists")
         
@@ -46,27 +55,23 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
             password_bytes = password_bytes[:72]
             password = password_bytes.decode('utf-8', errors='ignore')
         
-        hashed = hash_password(password)
+        hashed = await hash_password_async(password)
         db_user = User(username=user.username.strip(), password_hash=hashed)
-        db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+        db_user = await run_in_threadpool(save_user, db, db_user)
+        username_index.add(db_user.id, db_user.username)
         return db_user
     except HTTPException:
         raise
+    except HashingPoolFull:
+        raise server_busy()
     except Exception as e:
-        db.rollback()
+        await run_in_threadpool(db.rollback)
         raise HTTPException(status_code=500, detail=f"Registration failed: {str(e)}")
 
 @router.post("/login", response_model=Token)
-def login(user: UserCreate, db: Session = Depends(get_db)):
+async def login(user: UserCreate, db: Session = Depends(get_db)):
     try:
-        # Case-insensitive username lookup
-        # Use lower() for compatibility with both PostgreSQL and SQLite
-        username_lower = user.username.strip().lower()
-        db_user = db.query(User).filter(
-            func.lower(User.username) == username_lower
-        ).first()
+        db_user = await run_in_threadpool(find_user_by_username, db, user.username)
         
         if not db_user:
             raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -76,32 +81,76 @@ def login(user: UserCreate, db: Session = Depends(get_db)):
         if len(password_to_verify.encode('utf-8')) > 72:
             password_to_verify = password_to_verify.encode('utf-8')[:72].decode('utf-8', errors='ignore')
         
-        if not verify_password(password_to_verify, db_user.password_hash):
+        if not await verify_password_async(password_to_verify, db_user.password_hash):
             raise HTTPException(status_code=401, detail="Invalid credentials")
         
+        # Opportunistically upgrade hashes made with an outdated bcrypt cost.
+        # This is best effort: a busy pool or a failed write must not fail the login.
+        if needs_rehash(db_user.password_hash):
+            try:
+                db_user.password_hash = await hash_password_async(password_to_verify)
+                await run_in_threadpool(db.commit)
+            except HashingPoolFull:
+                pass
+            except Exception:
+                await run_in_threadpool(db.rollback)
+        
         token = create_access_token({"sub": db_user.username})
         return Token(access_token=token, token_type="bearer")
     except HTTPException:
         raise
+    except HashingPoolFull:
+        raise server_busy()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Login failed: {str(e)}")
 
 @router.get("/", response_model=list[UserOut])
-def get_users(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    return db.query(User).all()
+async def get_users(
+    request: Request,
+    response: Response,
+    after_id: Optional[int] = Query(None, ge=1),
+    limit: int = Query(USERS_PAGE_DEFAULT, ge=1),
+    current_user: CurrentUser = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Return one page of users ordered by id, as ``id`` and ``username`` only.
+
+    Pass the ``X-Next-Cursor`` header of a page as ``after_id`` to get the
+    next one. Each page carries an ETag derived from the highest user id, so
+    a client revalidating with ``If-None-Match`` gets an empty 304 until
+    somebody registers.
+    """
+    limit = min(limit, USERS_PAGE_MAX)
+    max_id = await db.scalar(select(func.max(User.id))) or 0
+    etag = f'W/"users-{max_id}-{after_id or 0}-{limit}"'
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    # Only the two public columns: no ORM objects, no password hashes
+    rows = (await db.execute(
+        select(User.id, User.username).where(User.id > (after_id or 0)).order_by(User.id).limit(limit + 1)
+    )).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    response.headers["ETag"] = etag
+    if has_more:
+        response.headers["X-Next-Cursor"] = str(rows[-1].id)
+    return [{"id": row.id, "username": row.username} for row in rows]
 
 @router.get("/me", response_model=UserOut)
-def get_current_user_info(current_user: User = Depends(get_current_user)):
+def get_current_user_info(current_user: CurrentUser = Depends(get_current_user)):
     return current_user
 
 @router.get("/search/{username}", response_model=list[UserOut])
-def search_users(username: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def search_users(
+    username: str,
+    limit: int = Query(USER_SEARCH_LIMIT_DEFAULT, ge=1),
+    current_user: CurrentUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
     if not username or not username.strip():
         raise HTTPException(status_code=400, detail="Username cannot be empty")
     
-    # Search users (excluding current user)
-    users = db.query(User).filter(
-        User.username.contains(username.strip()),
-        User.id != current_user.id
-    ).all()
-    return users
+    # Ranked search, excluding the current user (see app.search)
+    return find_users(db, username, min(limit, USER_SEARCH_LIMIT_MAX), exclude_id=current_user.id)
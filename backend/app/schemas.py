@@ -1,4 +1,5 @@
 from pydantic import BaseModel, validator
+from typing import Optional
 from datetime import datetime
 
 class UserCreate(BaseModel):
@@ -38,6 +39,28 @@ class ChatOut(BaseModel):
     class Config:
         from_attributes = True
 
+class InboxChatOut(ChatOut):
+    # Beginning of the newest message, None until the first one
+    last_message_preview: Optional[str] = None
+    unread_count: int = 0
+
+class ReadReceipt(BaseModel):
+    # Newest message read; the chat's newest message when omitted
+    message_id: Optional[int] = None
+
+class ReadStateOut(BaseModel):
+    chat_id: int
+    last_read_message_id: Optional[int]
+    unread_count: int
+
+class UnreadChatOut(BaseModel):
+    chat_id: int
+    unread_count: int
+
+class UnreadOut(BaseModel):
+    total: int
+    chats: list[UnreadChatOut]
+
 class MessageCreate(BaseModel):
     chat_id: int
     content: str
@@ -48,6 +71,15 @@ class MessageCreate(BaseModel):
             raise ValueError('Message content cannot be empty')
         return v
 
+class MessageBatchCreate(BaseModel):
+    messages: list[MessageCreate]
+    
+    @validator('messages')
+    def batch_must_not_be_empty(cls, v):
+        if not v:
+            raise ValueError('Batch must contain at least one message')
+        return v
+
 class MessageOut(BaseModel):
     id: int
     chat_id: int
@@ -56,3 +88,7 @@ class MessageOut(BaseModel):
     timestamp: datetime
     class Config:
         from_attributes = True
+
+class MessageSearchResult(MessageOut):
+    # HTML-escaped message text around the matches, matched words wrapped in <mark>
+    snippet: str
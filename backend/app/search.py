@@ -0,0 +1,276 @@
+import heapq
+import html
+import os
+import threading
+import time
+from collections import Counter
+from sqlalchemy import case, column, func, literal_column, or_, select, table
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from app.models import ChatMember, Message, User
+
+# Result size for GET /api/users/search/{username}; larger requests are clamped
+USER_SEARCH_LIMIT_DEFAULT = int(os.getenv("USER_SEARCH_LIMIT_DEFAULT", "20"))
+USER_SEARCH_LIMIT_MAX = int(os.getenv("USER_SEARCH_LIMIT_MAX", "100"))
+# The in-memory index catches up with new users on every search; a full
+# rebuild also picks up deleted or renamed users written by other processes
+USER_SEARCH_REBUILD_SECONDS = float(os.getenv("USER_SEARCH_REBUILD_SECONDS", "300"))
+
+# Page size for GET /api/messages/search
+MESSAGE_SEARCH_LIMIT_DEFAULT = int(os.getenv("MESSAGE_SEARCH_LIMIT_DEFAULT", "20"))
+MESSAGE_SEARCH_LIMIT_MAX = int(os.getenv("MESSAGE_SEARCH_LIMIT_MAX", "100"))
+
+# Text search configuration of the PostgreSQL GIN index (migration 0004);
+# queries must use the same one for the index to apply
+MESSAGE_SEARCH_CONFIG = "simple"
+# Matched terms in snippets are wrapped in these markers. The rest of the
+# snippet is HTML-escaped message text.
+SNIPPET_START = "<mark>"
+SNIPPET_END = "</mark>"
+SNIPPET_WORDS = 12
+# The database marks matches with private-use characters instead, so the
+# markers survive escaping the text around them
+_MATCH_START = "\ue000"
+_MATCH_END = "\ue001"
+
+# Same default as pg_trgm's similarity_threshold, so both backends agree on
+# which misspelled names still match
+SIMILARITY_THRESHOLD = 0.3
+# Queries shorter than a trigram only match username prefixes
+MIN_FUZZY_LENGTH = 3
+
+
+def trigrams(text: str, pad_end: bool = True) -> set:
+    """Trigrams of a lowercased string, padded like pg_trgm pads words."""
+    padded = "  " + text + (" " if pad_end else "")
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def rank_key(query: str, name: str, score: float):
+    # Exact match, then prefix, then substring, then closest spelling;
+    # shorter names first among equals
+    if name == query:
+        tier = 0
+    elif name.startswith(query):
+        tier = 1
+    elif query in name:
+        tier = 2
+    else:
+        tier = 3
+    return (tier, -score, len(name), name)
+
+
+class UsernameIndex:
+    """In-memory trigram index over usernames.
+
+    Used where the database has no trigram index (SQLite). Postings map
+    every trigram of a padded, lowercased username to the ids that contain
+    it, so a search only touches users sharing a trigram with the query.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._names = {}
+        self._grams = {}
+        self._postings = {}
+        self._last_id = 0
+        self._built_at = None
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, user_id: int, username: str):
+        name = username.lower()
+        with self._lock:
+            self._remove(user_id)
+            grams = trigrams(name)
+            self._names[user_id] = name
+            self._grams[user_id] = grams
+            for gram in grams:
+                self._postings.setdefault(gram, set()).add(user_id)
+            self._last_id = max(self._last_id, user_id)
+
+    def remove(self, user_id: int):
+        with self._lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id: int):
+        self._names.pop(user_id, None)
+        for gram in self._grams.pop(user_id, ()):
+            ids = self._postings.get(gram)
+            if ids is not None:
+                ids.discard(user_id)
+                if not ids:
+                    del self._postings[gram]
+
+    def clear(self):
+        with self._lock:
+            self._names.clear()
+            self._grams.clear()
+            self._postings.clear()
+            self._last_id = 0
+            self._built_at = None
+
+    def sync(self, db: Session):
+        """Load users added since the last sync, or rebuild when stale."""
+        with self._sync_lock:
+            now = time.monotonic()
+            max_id = db.query(func.max(User.id)).scalar() or 0
+            rebuild = (
+                self._built_at is None
+                or now - self._built_at > USER_SEARCH_REBUILD_SECONDS
+                # Rows were deleted and ids may be handed out again
+                or max_id < self._last_id
+            )
+            if rebuild:
+                self.clear()
+                self._built_at = now
+            if max_id > self._last_id:
+                rows = db.query(User.id, User.username).filter(User.id > self._last_id).yield_per(10000)
+                for user_id, username in rows:
+                    self.add(user_id, username)
+
+    def search(self, query: str, limit: int, exclude_id: int = None) -> list:
+        """Return up to ``limit`` best-ranked user ids for a lowercased query."""
+        with self._lock:
+            if len(query) < MIN_FUZZY_LENGTH:
+                candidates = self._intersect(trigrams(query, pad_end=False))
+                matches = (
+                    (rank_key(query, self._names[user_id], 0.0), user_id)
+                    for user_id in candidates
+                    if self._names[user_id].startswith(query)
+                )
+            else:
+                query_grams = trigrams(query)
+                shared = Counter()
+                for gram in query_grams:
+                    shared.update(self._postings.get(gram, ()))
+                matches = []
+                for user_id, count in shared.items():
+                    name = self._names[user_id]
+                    score = count / (len(query_grams) + len(self._grams[user_id]) - count)
+                    if score >= SIMILARITY_THRESHOLD or query in name:
+                        matches.append((rank_key(query, name, score), user_id))
+            best = heapq.nsmallest(limit + 1, matches)
+        return [user_id for _, user_id in best if user_id != exclude_id][:limit]
+
+    def _intersect(self, grams: set) -> set:
+        postings = sorted((self._postings.get(gram, set()) for gram in grams), key=len)
+        if not postings:
+            return set()
+        result = set(postings[0])
+        for ids in postings[1:]:
+            result &= ids
+        return result
+
+
+username_index = UsernameIndex()
+
+
+def search_users(db: Session, query: str, limit: int, exclude_id: int = None) -> list:
+    """Users whose username matches ``query``, best match first.
+
+    Queries shorter than three characters match username prefixes; longer
+    ones match substrings and similar spellings (trigram similarity). Both
+    backends rank exact matches first, then prefixes, then substrings, then
+    by similarity.
+    """
+    query = query.strip().lower()
+    if db.get_bind().dialect.name == "postgresql":
+        return _search_postgres(db, query, limit, exclude_id)
+    return _search_memory(db, query, limit, exclude_id)
+
+
+def _search_postgres(db: Session, query: str, limit: int, exclude_id: int = None) -> list:
+    # Both conditions are served by the pg_trgm GIN index on lower(username)
+    name = func.lower(User.username)
+    if len(query) < MIN_FUZZY_LENGTH:
+        match = name.startswith(query, autoescape=True)
+    else:
+        match = or_(name.op("%")(query), name.contains(query, autoescape=True))
+    tier = case(
+        (name == query, 0),
+        (name.startswith(query, autoescape=True), 1),
+        (name.contains(query, autoescape=True), 2),
+        else_=3,
+    )
+    return db.query(User).filter(match, User.id != exclude_id).order_by(
+        tier, func.similarity(name, query).desc(), func.length(User.username), name
+    ).limit(limit).all()
+
+
+def _search_memory(db: Session, query: str, limit: int, exclude_id: int = None) -> list:
+    username_index.sync(db)
+    ids = username_index.search(query, limit, exclude_id)
+    if not ids:
+        return []
+    # The index may lag behind deletes made elsewhere; only return live rows
+    users = {user.id: user for user in db.query(User).filter(User.id.in_(ids))}
+    for user_id in ids:
+        if user_id not in users:
+            username_index.remove(user_id)
+    return [users[user_id] for user_id in ids if user_id in users]
+
+
+messages_fts = table("messages_fts", column("rowid"))
+
+
+def fts5_query(text: str) -> str:
+    """Turn free text into an FTS5 query matching messages with every word.
+
+    Each word is quoted, so FTS5 operators and punctuation in user input are
+    searched for literally instead of failing to parse. PostgreSQL gets the
+    same semantics from plainto_tsquery.
+    """
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+def highlight(snippet: str) -> str:
+    """HTML-escape a database snippet and turn its match markers into <mark> tags."""
+    # Marker characters typed into a message can at worst become stray
+    # <mark> tags; no other markup gets through
+    return html.escape(snippet).replace(_MATCH_START, SNIPPET_START).replace(_MATCH_END, SNIPPET_END)
+
+
+async def search_messages(db: AsyncSession, user_id: int, query: str, limit: int,
+                          chat_id: int = None, before_id: int = None):
+    """Messages matching ``query`` in the user's chats, newest first.
+
+    Returns ``(rows, next_cursor)``; each row is a dict of the message
+    columns plus a ``snippet``: HTML-escaped text with the matched words in
+    <mark> tags. Every word of ``query`` must match; operators and quotes
+    are searched for as plain text on both backends. Pages are keyset-based on
+    ``Message.id`` like the chat history: pass ``next_cursor`` as
+    ``before_id`` to continue.
+    """
+    my_chat_ids = select(ChatMember.chat_id).where(ChatMember.user_id == user_id)
+    columns = (Message.id, Message.chat_id, Message.user_id, Message.content, Message.timestamp)
+
+    if db.bind.dialect.name == "postgresql":
+        document = func.to_tsvector(literal_column(f"'{MESSAGE_SEARCH_CONFIG}'"), Message.content)
+        tsquery = func.plainto_tsquery(literal_column(f"'{MESSAGE_SEARCH_CONFIG}'"), query)
+        snippet = func.ts_headline(
+            literal_column(f"'{MESSAGE_SEARCH_CONFIG}'"), Message.content, tsquery,
+            f"StartSel={_MATCH_START}, StopSel={_MATCH_END}, MaxWords={SNIPPET_WORDS}, MinWords=1",
+        )
+        stmt = select(*columns, snippet.label("snippet")).where(document.op("@@")(tsquery))
+    else:
+        match = fts5_query(query)
+        if not match:
+            return [], None
+        snippet = func.snippet(literal_column("messages_fts"), 0, _MATCH_START, _MATCH_END, "…", SNIPPET_WORDS)
+        stmt = select(*columns, snippet.label("snippet")).join(
+            messages_fts, messages_fts.c.rowid == Message.id
+        ).where(literal_column("messages_fts").op("MATCH")(match))
+
+    stmt = stmt.where(Message.chat_id.in_(my_chat_ids))
+    if chat_id is not None:
+        stmt = stmt.where(Message.chat_id == chat_id)
+    if before_id is not None:
+        stmt = stmt.where(Message.id < before_id)
+
+    # Fetch one extra row to learn whether another page exists
+    rows = (await db.execute(stmt.order_by(Message.id.desc()).limit(limit + 1))).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return [{**row._mapping, "snippet": highlight(row.snippet)} for row in rows[:limit]], next_cursor
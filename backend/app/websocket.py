@@ -1,77 +1,389 @@
+import os
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
-from jose import JWTError, jwt
-from app.auth import SECRET_KEY
+from pydantic import ValidationError
+from sqlalchemy import and_, select
+from app.archive import message_archive
+from app.cache import TTLCache
+from app.connections import Connection
+from app.db import AsyncSessionLocal
+from app.encoding import dumps_text, loads
+from app.dependencies import get_cached_user, resolve_user_async
+from app.history import recent_messages
+from app.log import connection_id, get_logger
+from app.messaging import ChatNotFound, batch_frame, message_data, save_messages
+from app.models import Chat, ChatMember, Message, User
+from app.pubsub import WORKER_ID, Event, create_backend
+from app.replay import ReplayBuffers
+from app.schemas import MessageCreate
 
 router = APIRouter()
-active_connections = {}  # chat_id -> list of WebSocket connections
-connection_users = {}  # WebSocket -> user_id (to identify which user owns which connection)
+logger = get_logger(__name__)
+# Fan-out indexes for this worker's sockets. A chat's recipients are found
+# with two dict lookups: the users subscribed to the chat, then each user's
+# connections (only those whose ``chats`` include the chat get the payload).
+user_connections = {}  # user_id -> set of Connection objects
+chat_users = {}  # chat_id -> {user_id: number of that user's connections subscribed}
 
-def verify_websocket_token(token: str):
-    """Verify JWT token from WebSocket query parameter"""
+# Upper bound on chats a single connection may subscribe to
+WS_MAX_SUBSCRIPTIONS = int(os.getenv("WS_MAX_SUBSCRIPTIONS", "1000"))
+
+# Acks of recently persisted sends, keyed by (user_id, client_id), so a
+# client resending after a reconnect gets the original ack instead of a
+# duplicate message. Per worker, so this is best effort.
+WS_ACK_CACHE_SIZE = int(os.getenv("WS_ACK_CACHE_SIZE", "10000"))
+WS_ACK_CACHE_TTL = float(os.getenv("WS_ACK_CACHE_TTL", "300"))
+_recent_acks = TTLCache(WS_ACK_CACHE_SIZE, WS_ACK_CACHE_TTL)
+
+# Recent events per chat, keyed by sequence number (the message id), so a
+# reconnecting client only receives what it missed. Older gaps are read
+# from the database, up to this many messages per chat; beyond that the
+# client is told to resync the chat over HTTP.
+replay_buffers = ReplayBuffers()
+WS_REPLAY_DB_LIMIT = int(os.getenv("WS_REPLAY_DB_LIMIT", "500"))
+
+async def verify_websocket_token(token: str):
+    """Verify JWT token from WebSocket query parameter and resolve its user.
+
+    A DB session is only opened when the token is not in the auth cache.
+    """
     if not token:
         return None
-    
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        username = payload.get("sub")
-        if username is None:
-            return None
-        return username
-    except JWTError:
-        return None
+    user = get_cached_user(token)
+    if user is not None:
+        return user
+    async with AsyncSessionLocal() as db:
+        return await resolve_user_async(token, db)
+
+async def is_member(user_id: int, chat_id: int) -> bool:
+    async with AsyncSessionLocal() as db:
+        member = await db.scalar(
+            select(ChatMember.id).where(ChatMember.user_id == user_id, ChatMember.chat_id == chat_id)
+        )
+    return member is not None
+
+async def send_target_error(user_id: int, chat_id: int):
+    """Why ``user_id`` may not post to ``chat_id``, or None if they may."""
+    async with AsyncSessionLocal() as db:
+        row = (await db.execute(
+            select(Chat.id, ChatMember.id)
+            .outerjoin(ChatMember, and_(ChatMember.chat_id == Chat.id, ChatMember.user_id == user_id))
+            .where(Chat.id == chat_id)
+        )).first()
+    if row is None:
+        return "Chat not found"
+    if row[1] is None:
+        return "Not a member of this chat"
+    return None
+
+@router.websocket("")
+async def user_websocket(websocket: WebSocket, token: str = Query(None)):
+    """One socket per user, multiplexing every chat it subscribes to."""
+    await serve_connection(websocket, token)
 
 @router.websocket("/chat/{chat_id}")
 async def websocket_endpoint(websocket: WebSocket, chat_id: int, token: str = Query(None)):
-    # Verify token
-    username = verify_websocket_token(token)
-    if not username:
+    """Legacy per-chat socket: subscribed to ``chat_id`` from the start."""
+    await serve_connection(websocket, token, chat_id)
+
+async def serve_connection(websocket: WebSocket, token: str, chat_id: int = None):
+    # Verify token and resolve the user it belongs to
+    user = await verify_websocket_token(token)
+    if not user:
         await websocket.close(code=1008, reason="Unauthorized")
         return
+    if chat_id is not None and not await is_member(user.id, chat_id):
+        # Same rule as subscribe frames: only members hear a chat's traffic
+        await websocket.close(code=1008, reason="Not a member of this chat")
+        return
     
     await websocket.accept()
-    if chat_id not in active_connections:
-        active_connections[chat_id] = []
-    active_connections[chat_id].append(websocket)
-    
-    # Get user_id for this connection
-    from app.db import SessionLocal
-    from app.models import User
-    db = SessionLocal()
-    user = db.query(User).filter(User.username == username).first()
-    if user:
-        connection_users[websocket] = user.id
-        print(f"WebSocket connected for chat {chat_id} by user {username} (ID: {user.id})")
-        print(f"Total connections for chat {chat_id}: {len(active_connections[chat_id])}")
-        print(f"Total tracked users: {len(connection_users)}")
-    else:
-        print(f"Warning: User {username} not found in database")
-    db.close()
+    connection = Connection(websocket, user.id, on_close=remove_connection)
+    # Set before the writer task starts so its records carry the id too
+    connection_id.set(connection.id)
+    connection.start()
+    register_connection(connection)
+    if chat_id is not None:
+        subscribe(connection, [chat_id])
+    logger.info("ws_connected", user_id=user.id, user_connections=len(user_connections.get(user.id, ())))
     
     try:
         while True:
             data = await websocket.receive_text()
-            print(f"Received message for chat {chat_id} from {username}: {data}")
-            
-            # Broadcast message to all connections in this chat
-            for conn in active_connections[chat_id]:
-                if conn != websocket:
-                    try:
-                        await conn.send_text(data)
-                    except Exception as e:
-                        print(f"Error sending message: {e}")
-    except WebSocketDisconnect:
-        if chat_id in active_connections:
-            active_connections[chat_id].remove(websocket)
-            if not active_connections[chat_id]:
-                del active_connections[chat_id]
-        if websocket in connection_users:
-            del connection_users[websocket]
-        print(f"WebSocket disconnected for chat {chat_id} by user {username}")
+            await handle_frame(connection, user, data, default_chat_id=chat_id)
+    except WebSocketDisconnect as e:
+        await connection.close()
+        logger.info("ws_disconnected", user_id=user.id, code=e.code)
+    except Exception as e:
+        logger.error("ws_error", exc_info=e, user_id=user.id)
+        await connection.close()
+
+def error_frame(client_id, detail: str) -> str:
+    return dumps_text({"type": "error", "client_id": client_id, "detail": detail})
+
+async def handle_frame(connection: Connection, user, data: str, default_chat_id: int = None):
+    """Handle one client frame; replies are queued on ``connection``.
+
+    Frames are JSON objects with a ``type``. ``subscribe`` and
+    ``unsubscribe`` frames carry ``chat_ids``. ``send`` frames carry a
+    client-generated ``client_id``, ``content`` and optionally ``chat_id``
+    (the socket's chat by default). The message is validated, persisted and
+    published in one step; the sender gets an ``ack`` with the server id and
+    timestamp, or an ``error`` with the same ``client_id``.
+    """
+    try:
+        frame = loads(data)
+    except ValueError:
+        connection.send(error_frame(None, "Frame is not valid JSON"))
+        return
+    if not isinstance(frame, dict):
+        connection.send(error_frame(None, "Frame must be a JSON object"))
+        return
+    client_id = frame.get("client_id")
+    kind = frame.get("type")
+    if kind in ("subscribe", "unsubscribe"):
+        await handle_subscription(connection, kind, frame)
+        return
+    if kind != "send":
+        connection.send(error_frame(client_id, f"Unknown frame type: {kind!r}"))
+        return
+    if not isinstance(client_id, (str, int)) or client_id == "":
+        connection.send(error_frame(client_id, "client_id is required"))
+        return
+    await handle_send(connection, user, client_id, frame, default_chat_id)
+
+async def handle_send(connection: Connection, user, client_id, frame: dict, default_chat_id: int = None):
+    ack_key = (user.id, client_id)
+    ack = _recent_acks.get(ack_key)
+    if ack is not None:
+        connection.send(ack)
+        return
+    try:
+        draft = MessageCreate(chat_id=frame.get("chat_id", default_chat_id), content=frame.get("content"))
+    except ValidationError as e:
+        connection.send(error_frame(client_id, e.errors()[0]["msg"]))
+        return
+    # Subscribed chats were checked for membership when subscribed
+    if draft.chat_id not in connection.chats:
+        error = await send_target_error(user.id, draft.chat_id)
+        if error is not None:
+            connection.send(error_frame(client_id, error))
+            return
+    try:
+        async with AsyncSessionLocal() as db:
+            [message] = await save_messages(db, user.id, [draft])
+    except ChatNotFound:
+        connection.send(error_frame(client_id, "Chat not found"))
+        return
     except Exception as e:
-        print(f"WebSocket error: {e}")
-        if chat_id in active_connections:
-            active_connections[chat_id].remove(websocket)
-            if not active_connections[chat_id]:
-                del active_connections[chat_id]
-        if websocket in connection_users:
-            del connection_users[websocket]
+        logger.error("ws_send_persist_failed", exc_info=e, user_id=user.id, client_id=client_id)
+        connection.send(error_frame(client_id, "Failed to send message"))
+        return
+
+    ack = dumps_text({
+        "type": "ack",
+        "client_id": client_id,
+        "id": message.id,
+        "chat_id": message.chat_id,
+        "timestamp": message.timestamp.isoformat(),
+    })
+    _recent_acks.set(ack_key, ack)
+    connection.send(ack)
+    logger.sampled("ws_message_sent", message_id=message.id, chat_id=message.chat_id, user_id=user.id)
+    # Everyone else in the chat, including the sender's other sockets
+    await publish(message.chat_id, dumps_text(message_data(message, user.username)),
+                  exclude=connection, seq=message.id)
+
+async def handle_subscription(connection: Connection, kind: str, frame: dict):
+    chat_ids = frame.get("chat_ids")
+    if not isinstance(chat_ids, list) or not all(type(chat_id) is int for chat_id in chat_ids):
+        connection.send(error_frame(None, "chat_ids must be a list of chat ids"))
+        return
+    requested = set(chat_ids)
+
+    if kind == "unsubscribe":
+        unsubscribe(connection, requested)
+        connection.send(dumps_text({"type": "unsubscribed", "chat_ids": sorted(requested)}))
+        return
+
+    last_seqs = parse_last_seqs(frame.get("last_seq"))
+    if last_seqs is None:
+        connection.send(error_frame(None, "last_seq must map chat ids to sequence numbers"))
+        return
+
+    new = requested - connection.chats
+    if len(connection.chats) + len(new) > WS_MAX_SUBSCRIPTIONS:
+        connection.send(error_frame(None, f"At most {WS_MAX_SUBSCRIPTIONS} subscriptions per connection"))
+        return
+    allowed = set()
+    if new:
+        # One membership query for the whole frame
+        async with AsyncSessionLocal() as db:
+            allowed = set(await db.scalars(
+                select(ChatMember.chat_id).where(ChatMember.user_id == connection.user_id, ChatMember.chat_id.in_(new))
+            ))
+        subscribe(connection, allowed)
+    connection.send(dumps_text({
+        "type": "subscribed",
+        "chat_ids": sorted(requested & connection.chats),
+        "denied": sorted(new - allowed),
+    }))
+    if last_seqs:
+        await replay_missed(connection, {
+            chat_id: seq for chat_id, seq in last_seqs.items() if chat_id in allowed
+        })
+
+def parse_last_seqs(value):
+    """``{"<chat_id>": seq}`` from a subscribe frame; None if malformed."""
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        return None
+    last_seqs = {}
+    for chat_id, seq in value.items():
+        try:
+            chat_id = int(chat_id)
+        except ValueError:
+            return None
+        if type(seq) is not int:
+            return None
+        last_seqs[chat_id] = seq
+    return last_seqs
+
+async def replay_missed(connection: Connection, last_seqs: dict):
+    """Send a resubscribed connection the events it missed in each chat.
+
+    The connection is already subscribed, so new events are queued behind
+    the replay; the client dedupes by message id if the two overlap.
+    """
+    from_db = {}
+    for chat_id, last_seq in last_seqs.items():
+        payloads = replay_buffers.since(chat_id, last_seq)
+        if payloads is None:
+            from_db[chat_id] = last_seq
+            continue
+        for payload in payloads:
+            connection.send(payload)
+    if not from_db:
+        return
+
+    # The buffer has rolled over (or this worker never saw the chat)
+    async with AsyncSessionLocal() as db:
+        for chat_id, last_seq in from_db.items():
+            if last_seq < await message_archive.current_boundary(chat_id):
+                # Part of the gap is archived; the HTTP history reads it
+                connection.send(dumps_text({"type": "resync", "chat_id": chat_id}))
+                continue
+            rows = (await db.execute(
+                select(Message, User.username).join(User, User.id == Message.user_id)
+                .where(Message.chat_id == chat_id, Message.id > last_seq)
+                .order_by(Message.id).limit(WS_REPLAY_DB_LIMIT + 1)
+            )).all()
+            if len(rows) > WS_REPLAY_DB_LIMIT:
+                connection.send(dumps_text({"type": "resync", "chat_id": chat_id}))
+            elif rows:
+                connection.send(batch_frame(chat_id, [message_data(message, username) for message, username in rows]))
+
+def register_connection(connection: Connection):
+    user_connections.setdefault(connection.user_id, set()).add(connection)
+
+def subscribe(connection: Connection, chat_ids):
+    for chat_id in chat_ids:
+        if chat_id in connection.chats:
+            continue
+        connection.chats.add(chat_id)
+        subscribers = chat_users.setdefault(chat_id, {})
+        subscribers[connection.user_id] = subscribers.get(connection.user_id, 0) + 1
+
+def unsubscribe(connection: Connection, chat_ids):
+    for chat_id in chat_ids:
+        if chat_id not in connection.chats:
+            continue
+        connection.chats.discard(chat_id)
+        subscribers = chat_users.get(chat_id)
+        if subscribers is None:
+            continue
+        remaining = subscribers.get(connection.user_id, 0) - 1
+        if remaining > 0:
+            subscribers[connection.user_id] = remaining
+        else:
+            subscribers.pop(connection.user_id, None)
+            if not subscribers:
+                del chat_users[chat_id]
+
+def remove_connection(connection: Connection):
+    """Forget a connection; safe to call more than once for the same one."""
+    unsubscribe(connection, list(connection.chats))
+    connections = user_connections.get(connection.user_id)
+    if connections is not None:
+        connections.discard(connection)
+        if not connections:
+            del user_connections[connection.user_id]
+
+def broadcast(chat_id: int, payload: str, exclude_connection: int = None, exclude_user_id: int = None,
+              coalesce_key: str = None) -> int:
+    """Queue an already-serialized payload on every local connection in a chat.
+
+    Queuing never blocks: each connection's writer task delivers the payload
+    on its own, so a slow client only backs up its own bounded queue.
+    Returns the number of connections that accepted the payload.
+    """
+    accepted = 0
+    for user_id in list(chat_users.get(chat_id, ())):
+        if user_id == exclude_user_id:
+            continue
+        for conn in list(user_connections.get(user_id, ())):
+            if chat_id not in conn.chats or conn.id == exclude_connection:
+                continue
+            if conn.send(payload, coalesce_key=coalesce_key):
+                accepted += 1
+    return accepted
+
+def deliver_local(event: Event):
+    """Broadcast bus handler: fan an event out to this worker's sockets."""
+    # Connection ids are per process, so only the publishing worker applies them
+    exclude_connection = event.exclude_connection if event.origin == WORKER_ID else None
+    if event.seq is not None:
+        replay_buffers.record(event.chat_id, event.seq, event.payload)
+        # The publishing worker wrote the messages through to its own cache
+        if event.origin != WORKER_ID:
+            recent_messages.invalidate(event.chat_id)
+    broadcast(event.chat_id, event.payload, exclude_connection=exclude_connection,
+              exclude_user_id=event.exclude_user_id, coalesce_key=event.coalesce_key)
+
+broadcast_bus = create_backend(deliver_local)
+
+async def publish(chat_id: int, payload: str, exclude: Connection = None, exclude_user_id: int = None,
+                  seq: int = None, coalesce_key: str = None):
+    """Send a payload to a chat's sockets on every worker.
+
+    The event is published once; each worker's bus subscriber delivers it to
+    the sockets that worker holds. If the bus is unavailable the event is at
+    least delivered to this worker's own sockets. Events with a ``seq`` are
+    also kept in every worker's replay buffer for reconnecting clients.
+    """
+    event = Event(chat_id, payload, exclude_user_id=exclude_user_id, seq=seq, coalesce_key=coalesce_key,
+                  exclude_connection=exclude.id if exclude is not None else None)
+    try:
+        await broadcast_bus.publish(event)
+    except Exception as e:
+        logger.warning("broadcast_publish_failed", chat_id=chat_id, error=repr(e))
+        deliver_local(event)
+
+async def publish_read_state(chat_id: int, user_id: int, last_read_message_id: int):
+    """Tell the chat's sockets (the reader's other devices included) how far a member has read.
+
+    Only the newest read state matters, so a queued one is replaced by the
+    next under the coalesce overflow policy.
+    """
+    payload = dumps_text({
+        "type": "read", "chat_id": chat_id, "user_id": user_id, "last_read_message_id": last_read_message_id,
+    })
+    await publish(chat_id, payload, coalesce_key=f"read:{chat_id}:{user_id}")
+
+def connection_metrics() -> list:
+    """Per-connection queue and delivery counters."""
+    return [
+        {"user_id": user_id, **conn.metrics()}
+        for user_id, connections in list(user_connections.items())
+        for conn in list(connections)
+    ]
@@ -0,0 +1,75 @@
+import os
+import re
+import sys
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine, pool
+
+# Make the backend package importable when alembic runs from any directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db import Base, SQLALCHEMY_DATABASE_URL
+from app import models  # noqa: F401 - registers the tables on Base.metadata
+
+config = context.config
+if config.config_file_name is not None and config.attributes.get("configure_logger", True):
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+# Search objects created with raw SQL by the migrations, not declared on
+# Base.metadata: the SQLite FTS5 table and its shadow tables (0004), the
+# PostgreSQL GIN indexes (0003, 0004) and the message partitions (0007).
+# Autogenerate must not see them, or it would drop them.
+UNMANAGED_TABLES = re.compile(r"messages_fts(_\w+)?|messages_p\d+")
+UNMANAGED_INDEXES = {"ix_messages_content_fts", "ix_users_username_trgm"}
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    if type_ == "table" and reflected and compare_to is None and UNMANAGED_TABLES.fullmatch(name):
+        return False
+    if type_ == "index" and name in UNMANAGED_INDEXES:
+        return False
+    return True
+
+
+def get_url() -> str:
+    return (
+        context.get_x_argument(as_dictionary=True).get("url")
+        or config.get_main_option("sqlalchemy.url")
+        or SQLALCHEMY_DATABASE_URL
+    )
+
+
+def run_migrations_offline():
+    context.configure(
+        url=get_url(),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        render_as_batch=True,
+        include_object=include_object,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    connectable = create_engine(get_url(), poolclass=pool.NullPool)
+    with connectable.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            # SQLite cannot ALTER most constraints in place
+            render_as_batch=connection.dialect.name == "sqlite",
+            include_object=include_object,
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,69 @@
+"""Initial schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+
+Databases created before migrations existed already have these tables,
+so only the missing ones are created.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_context().as_sql:
+        existing = set()
+    else:
+        existing = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if "users" not in existing:
+        op.create_table(
+            "users",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("username", sa.String(), nullable=False),
+            sa.Column("password_hash", sa.String(), nullable=False),
+        )
+        op.create_index("ix_users_id", "users", ["id"])
+        op.create_index("ix_users_username", "users", ["username"], unique=True)
+
+    if "chats" not in existing:
+        op.create_table(
+            "chats",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("name", sa.String(), nullable=True),
+            sa.Column("last_message_time", sa.DateTime(), nullable=True),
+        )
+        op.create_index("ix_chats_id", "chats", ["id"])
+
+    if "chat_members" not in existing:
+        op.create_table(
+            "chat_members",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id"), nullable=False),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+        )
+        op.create_index("ix_chat_members_id", "chat_members", ["id"])
+
+    if "messages" not in existing:
+        op.create_table(
+            "messages",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id"), nullable=False),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("content", sa.Text(), nullable=False),
+            sa.Column("timestamp", sa.DateTime(), nullable=True),
+        )
+        op.create_index("ix_messages_id", "messages", ["id"])
+
+
+def downgrade():
+    op.drop_table("messages")
+    op.drop_table("chat_members")
+    op.drop_table("chats")
+    op.drop_table("users")
@@ -0,0 +1,51 @@
+"""Indexes for message history, chat lists and username lookups
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+
+On PostgreSQL the indexes are built with CREATE INDEX CONCURRENTLY outside
+a transaction, so writes to the tables are not blocked while they build.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+# name, table, columns, unique
+INDEXES = [
+    ("ix_messages_chat_id_id", "messages", ["chat_id", "id"], False),
+    ("ix_messages_chat_id_timestamp", "messages", ["chat_id", "timestamp"], False),
+    ("ix_chat_members_user_id_chat_id", "chat_members", ["user_id", "chat_id"], False),
+    ("uq_chat_members_chat_id_user_id", "chat_members", ["chat_id", "user_id"], True),
+    ("ix_users_username_lower", "users", [sa.text("lower(username)")], False),
+]
+
+
+def _concurrently() -> dict:
+    if op.get_bind().dialect.name == "postgresql":
+        return {"postgresql_concurrently": True}
+    return {}
+
+
+def upgrade():
+    # The unique index cannot be built while duplicate memberships exist;
+    # keep the oldest row of each (chat_id, user_id) pair
+    op.execute(
+        "DELETE FROM chat_members WHERE id NOT IN ("
+        "SELECT min_id FROM (SELECT MIN(id) AS min_id FROM chat_members "
+        "GROUP BY chat_id, user_id) AS keep)"
+    )
+
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in INDEXES:
+            op.create_index(name, table, columns, unique=unique, if_not_exists=True, **_concurrently())
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, if_exists=True, **_concurrently())
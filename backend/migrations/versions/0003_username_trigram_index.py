@@ -0,0 +1,34 @@
+"""Trigram index for username search
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+
+PostgreSQL only: a pg_trgm GIN index on lower(username) serves the
+prefix, substring and similarity matches of GET /api/users/search. Other
+databases use the in-memory index in app.search instead.
+"""
+from alembic import op
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_trgm "
+            "ON users USING gin (lower(username) gin_trgm_ops)"
+        )
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_trgm")
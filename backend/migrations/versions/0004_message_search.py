@@ -0,0 +1,59 @@
+"""Full-text index for message search
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+
+PostgreSQL: a GIN index on to_tsvector('simple', content). SQLite: an
+external-content FTS5 table filled from the existing messages and kept in
+sync by triggers.
+"""
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+SQLITE_UPGRADE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); END",
+    "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+]
+
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER IF EXISTS messages_fts_au",
+    "DROP TRIGGER IF EXISTS messages_fts_ad",
+    "DROP TRIGGER IF EXISTS messages_fts_ai",
+    "DROP TABLE IF EXISTS messages_fts",
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        with op.get_context().autocommit_block():
+            op.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_content_fts "
+                "ON messages USING gin (to_tsvector('simple', content))"
+            )
+    elif dialect == "sqlite":
+        for statement in SQLITE_UPGRADE:
+            op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_messages_content_fts")
+    elif dialect == "sqlite":
+        for statement in SQLITE_DOWNGRADE:
+            op.execute(statement)
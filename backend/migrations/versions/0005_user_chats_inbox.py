@@ -0,0 +1,60 @@
+"""Per-user chat list (inbox) table
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+
+One row per chat member with the chat's display name for that member, a
+preview of the newest message, its time and an unread count. Existing
+chats are backfilled with the names the chat list computed so far and no
+unread messages.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+# Same rules as app.inbox: chats with two members are named after the other one
+BACKFILL = """
+INSERT INTO user_chats (user_id, chat_id, display_name, last_message_preview, last_message_time, unread_count)
+SELECT
+    cm.user_id,
+    c.id,
+    CASE
+        WHEN (SELECT count(*) FROM chat_members m WHERE m.chat_id = c.id) = 2
+         AND (SELECT min(u.username) FROM chat_members m JOIN users u ON u.id = m.user_id
+              WHERE m.chat_id = c.id AND m.user_id != cm.user_id) IS NOT NULL
+        THEN 'Chat with ' || (SELECT min(u.username) FROM chat_members m JOIN users u ON u.id = m.user_id
+                              WHERE m.chat_id = c.id AND m.user_id != cm.user_id)
+        ELSE c.name
+    END,
+    (SELECT substr(msg.content, 1, 100) FROM messages msg WHERE msg.chat_id = c.id ORDER BY msg.id DESC LIMIT 1),
+    c.last_message_time,
+    0
+FROM chat_members cm
+JOIN chats c ON c.id = cm.chat_id
+"""
+
+
+def upgrade():
+    op.create_table(
+        "user_chats",
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id"), primary_key=True),
+        sa.Column("display_name", sa.String(), nullable=True),
+        sa.Column("last_message_preview", sa.String(), nullable=True),
+        sa.Column("last_message_time", sa.DateTime(), nullable=True),
+        sa.Column("unread_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.create_index("ix_user_chats_user_id_last_message_time", "user_chats", ["user_id", "last_message_time"])
+    op.create_index("ix_user_chats_chat_id", "user_chats", ["chat_id"])
+    op.execute(BACKFILL)
+
+
+def downgrade():
+    op.drop_index("ix_user_chats_chat_id", table_name="user_chats")
+    op.drop_index("ix_user_chats_user_id_last_message_time", table_name="user_chats")
+    op.drop_table("user_chats")
@@ -0,0 +1,30 @@
+"""Read cursors on chat members
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17
+
+Existing members are treated as having read their chats up to the newest
+message, which matches the zero unread counts 0005 backfilled.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("chat_members", sa.Column("last_read_message_id", sa.Integer(), nullable=True))
+    op.execute(
+        "UPDATE chat_members SET last_read_message_id = "
+        "(SELECT max(m.id) FROM messages m WHERE m.chat_id = chat_members.chat_id)"
+    )
+
+
+def downgrade():
+    # SQLite cannot drop columns in place; batch mode rebuilds the table
+    with op.batch_alter_table("chat_members") as batch:
+        batch.drop_column("last_read_message_id")
@@ -0,0 +1,71 @@
+"""Partition messages by id range (PostgreSQL, opt-in)
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17
+
+Only runs on PostgreSQL with MESSAGE_PARTITIONING=true; otherwise (and on
+SQLite) it changes nothing. The table is rebuilt as PARTITION BY RANGE (id)
+with partitions of MESSAGE_PARTITION_SIZE ids up to the newest message plus
+MESSAGE_PARTITIONS_AHEAD empty ones, and the rows are copied over. The
+primary key stays (id): the partition key is part of it. Later partitions
+are created by the app (app.partitions). The copy locks messages for its
+duration, so run it in a maintenance window on large tables.
+"""
+from alembic import op
+import sqlalchemy as sa
+from app.partitions import MESSAGE_PARTITIONING, partition_ddl, planned_partitions
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+# Dropped with the old table and rebuilt on the new one
+INDEXES = [
+    ("ix_messages_id", ["id"]),
+    ("ix_messages_chat_id_id", ["chat_id", "id"]),
+    ("ix_messages_chat_id_timestamp", ["chat_id", "timestamp"]),
+]
+
+
+def _is_partitioned(bind) -> bool:
+    return bind.execute(sa.text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('messages')"
+    )).first() is not None
+
+
+def _rebuild(partition: bool):
+    op.execute("ALTER TABLE messages RENAME TO messages_old")
+    layout = " PARTITION BY RANGE (id)" if partition else ""
+    op.execute(f"CREATE TABLE messages (LIKE messages_old INCLUDING DEFAULTS){layout}")
+    # Keep the id sequence when the old table is dropped
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    if partition:
+        max_id = op.get_bind().execute(sa.text("SELECT coalesce(max(id), 0) FROM messages_old")).scalar()
+        for index in range(planned_partitions(max_id)[-1] + 1):
+            op.execute(partition_ddl(index))
+    op.execute("INSERT INTO messages SELECT * FROM messages_old")
+    op.execute("DROP TABLE messages_old")
+
+    # Built after the copy; on a partitioned table each is created on every partition
+    op.create_primary_key("messages_pkey", "messages", ["id"])
+    op.create_foreign_key("messages_chat_id_fkey", "messages", "chats", ["chat_id"], ["id"])
+    op.create_foreign_key("messages_user_id_fkey", "messages", "users", ["user_id"], ["id"])
+    for name, columns in INDEXES:
+        op.create_index(name, "messages", columns)
+    op.execute("CREATE INDEX ix_messages_content_fts ON messages USING gin (to_tsvector('simple', content))")
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != "postgresql" or not MESSAGE_PARTITIONING or _is_partitioned(bind):
+        return
+    _rebuild(partition=True)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != "postgresql" or not _is_partitioned(bind):
+        return
+    _rebuild(partition=False)
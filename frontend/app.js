@@ -4,8 +4,12 @@ let currentUserId = null;
 let currentChat = null;
 let chats = [];
 let messages = {};
+let olderCursors = {}; // chat_id -> before_id for the next older page (X-Next-Cursor), null when none
 let isLoginMode = true;
 let websocket = null;
+let subscribedChats = new Set(); // chats the server confirmed for this socket
+let pendingSends = {}; // client_id -> { chatId, content } awaiting a WebSocket ack
+let nextClientId = 0;
 let token = null;
 
 // API Base URL
@@ -292,6 +296,8 @@ async function loadChats() {
             chats = await response.json();
             console.log('Chats loaded:', chats);
             renderChats();
+            connectWebSocket();
+            subscribeChats(chats.map(chat => chat.id));
         } else {
             console.error('Failed to load chats:', response.status);
             if (response.status === 401) {
@@ -347,41 +353,31 @@ function renderChats() {
             }
         }
         
-        // Get last message preview - will be loaded asynchronously
-        let lastMessagePreview = '';
+        // Last message preview: loaded messages if we have them, otherwise
+        // the preview the chat list already carries (no request per chat)
+        let lastMessageContent = chat.last_message_preview || '';
         if (messages[chat.id] && messages[chat.id].length > 0) {
-            const lastMessage = messages[chat.id][messages[chat.id].length - 1];
-            lastMessagePreview = lastMessage.content.length > 50 
-                ? lastMessage.content.substring(0, 50) + '...' 
-                : lastMessage.content;
+            lastMessageContent = messages[chat.id][messages[chat.id].length - 1].content;
         }
+        const lastMessagePreview = lastMessageContent.length > 50 
+            ? lastMessageContent.substring(0, 50) + '...' 
+            : lastMessageContent;
         
         chatElement.innerHTML = `
             <div class="chat-avatar">${(chat.name || 'C').charAt(0).toUpperCase()}</div>
             <div class="chat-info">
                 <div class="chat-name">${chat.name || `Chat ${chat.id}`}</div>
-                <div class="chat-preview">${lastMessagePreview}</div>
+                <div class="chat-preview"></div>
+            </div>
+            <div class="chat-meta">
+                <div class="chat-time">${timeDisplay}</div>
+                ${chat.unread_count ? `<div class="unread-badge">${chat.unread_count}</div>` : ''}
             </div>
-            <div class="chat-time">${timeDisplay}</div>
         `;
+        chatElement.querySelector('.chat-preview').textContent = lastMessagePreview;
         
         chatElement.addEventListener('click', (event) => selectChat(chat, event));
         chatsList.appendChild(chatElement);
-        
-        // Load last message if not in cache
-        if (!messages[chat.id] || messages[chat.id].length === 0) {
-            loadLastMessage(chat.id).then(lastMsg => {
-                if (lastMsg) {
-                    const previewElement = chatElement.querySelector('.chat-preview');
-                    if (previewElement) {
-                        const preview = lastMsg.content.length > 50 
-                            ? lastMsg.content.substring(0, 50) + '...' 
-                            : lastMsg.content;
-                        previewElement.textContent = preview;
-                    }
-                }
-            });
-        }
     });
 }
 
@@ -402,12 +398,33 @@ function updateChatPreview(chatId) {
     }
 }
 
+// Move the server-side read cursor to the chat's newest message; the
+// server's counter also grows while the chat is open, so force skips the
+// local check
+async function markChatRead(chat, force = false) {
+    if (!token || !(chat.unread_count || force)) return;
+    chat.unread_count = 0;
+    const badge = document.querySelector(`[data-chat-id="${chat.id}"] .unread-badge`);
+    if (badge) badge.remove();
+    try {
+        await fetch(`${API_BASE}/api/chats/${chat.id}/read`, {
+            method: 'POST',
+            headers: {
+                'Authorization': `Bearer ${token}`
+            }
+        });
+    } catch (error) {
+        console.error('Failed to mark chat read:', error);
+    }
+}
+
 function selectChat(chat, event = null) {
     if (!chat || !chat.id) {
         console.error('selectChat: Invalid chat object', chat);
         return;
     }
     currentChat = chat;
+    markChatRead(chat);
     
     // Update UI
     document.querySelectorAll('.chat-item').forEach(item => {
@@ -434,7 +451,8 @@ function selectChat(chat, event = null) {
     // Load messages and update status with last message
     if (chat && chat.id) {
         loadMessages(chat.id);
-        connectWebSocket(chat.id);
+        // Normally already subscribed when the chat list loaded
+        subscribeChats([chat.id]);
         // Update chatStatus with last message
         updateChatStatus(chat.id);
     } else {
@@ -447,7 +465,7 @@ async function loadLastMessage(chatId) {
     if (!token) return null;
     
     try {
-        const response = await fetch(`${API_BASE}/api/messages/${chatId}`, {
+        const response = await fetch(`${API_BASE}/api/messages/${chatId}?limit=1`, {
             headers: {
                 'Authorization': `Bearer ${token}`
             }
@@ -506,6 +524,8 @@ async function loadMessages(chatId) {
             // Sort messages by timestamp
             messagesList.sort((a, b) => new Date(a.timestamp) - new Date(b.timestamp));
             messages[chatId] = messagesList;
+            // Only the newest page is returned; the cursor reaches older ones
+            olderCursors[chatId] = response.headers.get('X-Next-Cursor');
             renderMessages();
             // Update chat status with last message
             if (currentChat && currentChat.id === chatId) {
@@ -527,7 +547,38 @@ async function loadMessages(chatId) {
     }
 }
 
-function renderMessages() {
+// Prepend the page of history before the oldest loaded message
+async function loadOlderMessages(chatId) {
+    const cursor = olderCursors[chatId];
+    if (!token || !cursor) return;
+
+    try {
+        const response = await fetch(`${API_BASE}/api/messages/${chatId}?before_id=${encodeURIComponent(cursor)}`, {
+            headers: {
+                'Authorization': `Bearer ${token}`
+            }
+        });
+        if (!response.ok) {
+            console.error('Failed to load older messages:', response.status);
+            return;
+        }
+        const older = await response.json();
+        const loaded = messages[chatId] || [];
+        const known = new Set(loaded.map(m => m.id));
+        messages[chatId] = older.filter(m => !known.has(m.id)).concat(loaded);
+        olderCursors[chatId] = response.headers.get('X-Next-Cursor');
+        if (currentChat && currentChat.id === chatId) {
+            // Keep the messages that were on screen where they were
+            const fromBottom = messagesContainer.scrollHeight - messagesContainer.scrollTop;
+            renderMessages(false);
+            messagesContainer.scrollTop = messagesContainer.scrollHeight - fromBottom;
+        }
+    } catch (error) {
+        console.error('Failed to load older messages:', error);
+    }
+}
+
+function renderMessages(scrollToBottom = true) {
     if (!currentChat || !messages[currentChat.id]) {
         messagesContainer.innerHTML = `
             <div class="empty-state">
@@ -553,6 +604,18 @@ function renderMessages() {
         return;
     }
 
+    if (olderCursors[currentChat.id]) {
+        const olderButton = document.createElement('button');
+        olderButton.className = 'load-older-btn';
+        olderButton.textContent = 'Load older messages';
+        const chatId = currentChat.id;
+        olderButton.addEventListener('click', () => {
+            olderButton.disabled = true;
+            loadOlderMessages(chatId);
+        });
+        messagesContainer.appendChild(olderButton);
+    }
+
     chatMessages.forEach(message => {
         const messageElement = document.createElement('div');
         const isOwnMessage = message.user_id === currentUserId;
@@ -571,7 +634,9 @@ function renderMessages() {
     });
 
     // Scroll to bottom
-    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    if (scrollToBottom) {
+        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    }
 }
 
 // Send message function
@@ -586,6 +651,12 @@ async function sendMessage() {
         return;
     }
 
+    // Prefer the open WebSocket: the server persists and fans the message
+    // out in one step and answers with an ack. HTTP is the fallback.
+    if (sendOverWebSocket(currentChat.id, content)) {
+        return;
+    }
+
     try {
         const response = await fetch(`${API_BASE}/api/messages/`, {
             method: 'POST',
@@ -639,85 +710,212 @@ async function sendMessage() {
     }
 }
 
-function connectWebSocket(chatId) {
-    // Don't close existing connection if it's for the same chat
-    if (websocket && websocket.readyState === WebSocket.OPEN) {
-        const currentChatId = websocket.url.match(/\/ws\/chat\/(\d+)/)?.[1];
-        if (currentChatId && parseInt(currentChatId) === chatId) {
-            console.log('WebSocket already connected for this chat, reusing connection');
-            return;
+function websocketOpen() {
+    return websocket && websocket.readyState === WebSocket.OPEN;
+}
+
+function sendFrame(clientId, pending) {
+    websocket.send(JSON.stringify({
+        type: 'send',
+        client_id: clientId,
+        chat_id: pending.chatId,
+        content: pending.content
+    }));
+}
+
+function sendOverWebSocket(chatId, content) {
+    if (!websocketOpen() || !subscribedChats.has(chatId)) return false;
+    const clientId = `${currentUserId}-${Date.now()}-${nextClientId++}`;
+    pendingSends[clientId] = { chatId, content };
+    sendFrame(clientId, pendingSends[clientId]);
+    return true;
+}
+
+// Sends that were not acked before the socket dropped; the server answers
+// a repeated client_id with the original ack instead of a duplicate message
+function resendPending() {
+    Object.entries(pendingSends).forEach(([clientId, pending]) => {
+        sendFrame(clientId, pending);
+    });
+}
+
+// Newest message id we hold for a chat, or null if none are loaded
+function lastSeenId(chatId) {
+    const chatMessages = messages[chatId];
+    if (!chatMessages || chatMessages.length === 0) return null;
+    return Math.max(...chatMessages.map(m => m.id));
+}
+
+// Subscribing is idempotent on the server; only ask for chats not yet confirmed.
+// For chats with loaded messages the server replays whatever we missed since.
+function subscribeChats(chatIds) {
+    const missing = chatIds.filter(id => !subscribedChats.has(id));
+    if (websocketOpen() && missing.length) {
+        const lastSeq = {};
+        missing.forEach(id => {
+            const seq = lastSeenId(id);
+            if (seq !== null) lastSeq[id] = seq;
+        });
+        websocket.send(JSON.stringify({ type: 'subscribe', chat_ids: missing, last_seq: lastSeq }));
+    }
+}
+
+function handleAck(ack) {
+    const pending = pendingSends[ack.client_id];
+    if (!pending) return;
+    delete pendingSends[ack.client_id];
+    handleIncomingMessage({
+        id: ack.id,
+        chat_id: ack.chat_id,
+        user_id: currentUserId,
+        content: pending.content,
+        timestamp: ack.timestamp
+    });
+    // Reload chats to update the order based on last message time
+    loadChats();
+}
+
+function handleSendError(error) {
+    console.error('Message rejected by server:', error.detail);
+    if (pendingSends[error.client_id]) {
+        delete pendingSends[error.client_id];
+        alert(error.detail || 'Failed to send message');
+    }
+}
+
+function handleIncomingMessage(message) {
+    // Handle message for any chat, not just currentChat
+    const chatId = message.chat_id;
+    if (chatId) {
+        if (!messages[chatId]) {
+            messages[chatId] = [];
         }
-        console.log('Closing existing WebSocket connection for different chat');
-        websocket.close();
+        // Check if message already exists (avoid duplicates)
+        const messageExists = messages[chatId].some(m => m.id === message.id);
+        if (!messageExists) {
+            messages[chatId].push(message);
+            // Sort messages by timestamp
+            messages[chatId].sort((a, b) => new Date(a.timestamp) - new Date(b.timestamp));
+            
+            console.log('Message added to chat', chatId, 'Total messages:', messages[chatId].length);
+            
+            // If this is the current chat, update UI immediately
+            if (currentChat && currentChat.id === chatId) {
+                console.log('Rendering messages for current chat');
+                renderMessages();
+                // Update chat status with new last message
+                updateChatStatus(chatId);
+                if (message.user_id !== currentUserId) {
+                    markChatRead(currentChat, true);
+                }
+            } else {
+                console.log('Message received for different chat:', chatId, 'Current chat:', currentChat?.id);
+                const chat = chats.find(c => c.id === chatId);
+                if (chat && message.user_id !== currentUserId) {
+                    // Mirrors the server's counter until the chat is opened
+                    chat.unread_count = (chat.unread_count || 0) + 1;
+                    renderChats();
+                }
+            }
+            // Always update chat preview in list
+            updateChatPreview(chatId);
+        } else {
+            console.log('Duplicate message ignored:', message.id);
+        }
+    } else {
+        console.warn('Received message without chat_id:', message);
+    }
+}
+
+// One socket per user, subscribed to all of the user's chats, so switching
+// chats does not reconnect
+function connectWebSocket() {
+    if (websocket && (websocket.readyState === WebSocket.OPEN || websocket.readyState === WebSocket.CONNECTING)) {
+        return;
     }
 
     try {
         // Add token to WebSocket URL as query parameter
-        const wsUrl = `ws://localhost:8000/ws/chat/${chatId}?token=${encodeURIComponent(token)}`;
+        const wsUrl = `ws://localhost:8000/ws?token=${encodeURIComponent(token)}`;
         console.log('Connecting WebSocket to:', wsUrl);
-        websocket = new WebSocket(wsUrl);
+        const socket = new WebSocket(wsUrl);
+        websocket = socket;
+        subscribedChats = new Set();
         
-        websocket.onopen = function() {
-            console.log('WebSocket connected successfully for chat', chatId);
-            console.log('WebSocket readyState:', websocket.readyState, '(OPEN =', WebSocket.OPEN, ')');
+        socket.onopen = function() {
+            console.log('WebSocket connected successfully');
+            subscribeChats(chats.map(chat => chat.id));
+            resendPending();
         };
         
-        websocket.onmessage = function(event) {
+        socket.onmessage = function(event) {
             try {
-                const message = JSON.parse(event.data);
-                console.log('WebSocket message received:', message);
+                const data = JSON.parse(event.data);
+                console.log('WebSocket message received:', data);
                 
-                // Handle message for any chat, not just currentChat
-                const chatId = message.chat_id;
-                if (chatId) {
-                    if (!messages[chatId]) {
-                        messages[chatId] = [];
-                    }
-                    // Check if message already exists (avoid duplicates)
-                    const messageExists = messages[chatId].some(m => m.id === message.id);
-                    if (!messageExists) {
-                        messages[chatId].push(message);
-                        // Sort messages by timestamp
-                        messages[chatId].sort((a, b) => new Date(a.timestamp) - new Date(b.timestamp));
-                        
-                        console.log('Message added to chat', chatId, 'Total messages:', messages[chatId].length);
-                        
-                        // If this is the current chat, update UI immediately
-                        if (currentChat && currentChat.id === chatId) {
-                            console.log('Rendering messages for current chat');
-                            renderMessages();
-                            // Update chat status with new last message
-                            updateChatStatus(chatId);
+                switch (data.type) {
+                    case 'subscribed':
+                        data.chat_ids.forEach(id => subscribedChats.add(id));
+                        break;
+                    case 'unsubscribed':
+                        data.chat_ids.forEach(id => subscribedChats.delete(id));
+                        break;
+                    case 'ack':
+                        handleAck(data);
+                        break;
+                    case 'error':
+                        handleSendError(data);
+                        break;
+                    case 'message_batch':
+                        // Messages sent together through /api/messages/batch arrive in one frame
+                        data.messages.forEach(handleIncomingMessage);
+                        break;
+                    case 'read':
+                        // Read on another device: clear the badge here too
+                        if (data.user_id === currentUserId) {
+                            const chat = chats.find(c => c.id === data.chat_id);
+                            if (chat && chat.unread_count) {
+                                chat.unread_count = 0;
+                                renderChats();
+                            }
+                        }
+                        break;
+                    case 'resync':
+                        // Too much was missed to replay; reload the chat over HTTP
+                        if (currentChat && currentChat.id === data.chat_id) {
+                            loadMessages(data.chat_id);
                         } else {
-                            console.log('Message received for different chat:', chatId, 'Current chat:', currentChat?.id);
+                            // Dropped from the cache, reloaded when the chat is opened
+                            delete messages[data.chat_id];
+                            renderChats();
                         }
-                        // Always update chat preview in list
-                        updateChatPreview(chatId);
-                    } else {
-                        console.log('Duplicate message ignored:', message.id);
-                    }
-                } else {
-                    console.warn('Received message without chat_id:', message);
+                        break;
+                    default:
+                        handleIncomingMessage(data);
                 }
             } catch (error) {
                 console.error('Failed to parse WebSocket message:', error, event.data);
             }
         };
         
-        websocket.onclose = function(event) {
-            console.log('WebSocket disconnected for chat', chatId, 'Code:', event.code, 'Reason:', event.reason);
+        socket.onclose = function(event) {
+            console.log('WebSocket disconnected, Code:', event.code, 'Reason:', event.reason);
+            if (websocket === socket) {
+                websocket = null;
+                subscribedChats = new Set();
+            }
             // Try to reconnect after a short delay if connection was lost unexpectedly
-            if (event.code !== 1000 && currentChat && currentChat.id === chatId) {
+            if (event.code !== 1000 && token) {
                 console.log('Attempting to reconnect WebSocket in 2 seconds...');
                 setTimeout(() => {
-                    if (currentChat && currentChat.id === chatId) {
-                        connectWebSocket(chatId);
+                    if (token) {
+                        connectWebSocket();
                     }
                 }, 2000);
             }
         };
         
-        websocket.onerror = function(error) {
+        socket.onerror = function(error) {
             console.error('WebSocket error:', error);
             console.warn('WebSocket connection failed, messages will still work via HTTP');
             // Don't show error to user, as HTTP fallback works
@@ -737,8 +935,11 @@ function logout() {
     currentChat = null;
     chats = [];
     messages = {};
+    olderCursors = {};
+    pendingSends = {};
+    subscribedChats = new Set();
     if (websocket) {
-        websocket.close();
+        websocket.close(1000);
         websocket = null;
     }
     showAuth();
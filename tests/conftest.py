@@ -149,7 +149,7 @@ def simple_async_client():
     """Create simple async test client without database dependency."""
     # Use the same database as the main app (SQLite when USE_SQLITE=true)
     from app.db import engine, SessionLocal, Base
-    from app.models import User, Chat, ChatMember, Message
+    from app.models import User, Chat, ChatMember, Message, UserChat
     
     # Create tables if they don't exist
     Base.metadata.create_all(bind=engine)
@@ -170,6 +170,7 @@ def simple_async_client():
     try:
         session = SessionLocal()
         session.query(Message).delete()
+        session.query(UserChat).delete()
         session.query(ChatMember).delete()
         session.query(Chat).delete()
         session.query(User).delete()
@@ -178,6 +179,17 @@ def simple_async_client():
     except Exception:
         pass
     
+    # Users are gone, so must be any tokens cached for them
+    from app.dependencies import clear_user_cache
+    clear_user_cache()
+    # Ids are reused once the rows are gone, so forget acks keyed by user id
+    from app.websocket import _recent_acks, replay_buffers
+    _recent_acks.clear()
+    # Message ids are reused too, so buffered events would look like new ones
+    replay_buffers.clear()
+    from app.history import recent_messages
+    recent_messages.clear()
+    
     app.dependency_overrides.clear()
 
 @pytest.fixture
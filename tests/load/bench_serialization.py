@@ -0,0 +1,108 @@
+"""
+Microbenchmark: encoding message history pages and broadcast frames.
+
+Compares the generic path (ORM objects walked by FastAPI's jsonable_encoder,
+then the stdlib json module) with the fast path (row tuples encoded straight
+by orjson) on 10k-message pages, against an in-memory SQLite database.
+
+Usage:
+    python tests/load/bench_serialization.py [--messages 10000] [--rounds 20]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'backend'))
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from app.db import Base
+from app.encoding import dumps_text, join_array
+from app.messaging import MESSAGE_COLUMNS, encode_message, message_data
+from app.models import Chat, Message, User
+
+
+def stdlib_dumps(content) -> bytes:
+    # What fastapi.responses.JSONResponse.render does
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+
+def setup(count: int):
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    start = datetime(2024, 1, 1)
+    with Session(engine) as db:
+        db.add(User(id=1, username="bench", password_hash="x"))
+        db.add(Chat(id=1, name="Bench", last_message_time=start))
+        db.add_all(
+            Message(chat_id=1, user_id=1, content=f"message number {i} with some text", timestamp=start + timedelta(seconds=i))
+            for i in range(count)
+        )
+        db.commit()
+    return engine
+
+
+def generic_page(db: Session, limit: int) -> bytes:
+    messages = db.scalars(select(Message).where(Message.chat_id == 1).order_by(Message.id.desc()).limit(limit)).all()
+    return stdlib_dumps(jsonable_encoder(list(reversed(messages))))
+
+
+def fast_page(db: Session, limit: int) -> bytes:
+    rows = db.execute(select(*MESSAGE_COLUMNS).where(Message.chat_id == 1).order_by(Message.id.desc()).limit(limit)).all()
+    return join_array(encode_message(row) for row in reversed(rows))
+
+
+def measure(fn, rounds: int) -> dict:
+    fn()  # warm up
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return {"median_ms": statistics.median(samples) * 1000, "min_ms": min(samples) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = setup(args.messages)
+    with Session(engine) as db:
+        # Both paths must produce the same document
+        assert json.loads(generic_page(db, args.messages)) == json.loads(fast_page(db, args.messages))
+        messages = db.scalars(select(Message)).all()
+        results = {
+            "page (ORM + jsonable_encoder + json)": measure(lambda: generic_page(db, args.messages), args.rounds),
+            "page (rows + orjson)": measure(lambda: fast_page(db, args.messages), args.rounds),
+            "broadcast frames (json)": measure(
+                lambda: [json.dumps(message_data(m, "bench")) for m in messages], args.rounds
+            ),
+            "broadcast frames (orjson)": measure(
+                lambda: [dumps_text(message_data(m, "bench")) for m in messages], args.rounds
+            ),
+        }
+        # Pure encoding cost, with the rows already fetched
+        rows = db.execute(select(*MESSAGE_COLUMNS)).all()
+        results["encode only (jsonable_encoder + json)"] = measure(
+            lambda: stdlib_dumps(jsonable_encoder(messages)), args.rounds
+        )
+        results["encode only (orjson)"] = measure(
+            lambda: join_array(encode_message(row) for row in rows), args.rounds
+        )
+
+    print(f"{args.messages} messages, {args.rounds} rounds")
+    width = max(len(name) for name in results)
+    for name, result in results.items():
+        print(f"{name:<{width}}  median {result['median_ms']:8.2f} ms  min {result['min_ms']:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
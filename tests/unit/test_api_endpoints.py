@@ -99,6 +99,87 @@ class TestUserEndpoints:
         assert response.status_code == 401
         assert "Invalid credentials" in response.json()["detail"]
     
+    @pytest.mark.asyncio
+    async def test_login_rehashes_outdated_cost(self, simple_async_client, monkeypatch):
+        """Test that login upgrades a hash made with a different bcrypt cost."""
+        import app.auth
+        from app.db import SessionLocal
+        user_data = {
+            "username": "testuser_api_rehash",
+            "password": "testpassword123"
+        }
+        
+        monkeypatch.setattr(app.auth, "BCRYPT_ROUNDS", 4)
+        await simple_async_client.post("/api/users/register", json=user_data)
+        monkeypatch.setattr(app.auth, "BCRYPT_ROUNDS", 5)
+        response = await simple_async_client.post("/api/users/login", json=user_data)
+        
+        assert response.status_code == 200
+        db = SessionLocal()
+        try:
+            stored = db.query(User).filter(User.username == "testuser_api_rehash").one()
+            assert stored.password_hash.startswith("$2b$05$")
+        finally:
+            db.close()
+    
+    @pytest.mark.asyncio
+    async def test_login_survives_failed_rehash_write(self, simple_async_client, monkeypatch):
+        """Test that a failed rehash write is rolled back off the event loop and the login still succeeds."""
+        import threading
+        import app.auth
+        from sqlalchemy.orm import Session
+        user_data = {
+            "username": "testuser_api_rehash_fail",
+            "password": "testpassword123"
+        }
+        monkeypatch.setattr(app.auth, "BCRYPT_ROUNDS", 4)
+        await simple_async_client.post("/api/users/register", json=user_data)
+        monkeypatch.setattr(app.auth, "BCRYPT_ROUNDS", 5)
+
+        def failing_commit(self):
+            raise RuntimeError("database went away")
+
+        rollback_threads = []
+        original_rollback = Session.rollback
+
+        def recording_rollback(self):
+            rollback_threads.append(threading.current_thread())
+            original_rollback(self)
+
+        monkeypatch.setattr(Session, "commit", failing_commit)
+        monkeypatch.setattr(Session, "rollback", recording_rollback)
+        response = await simple_async_client.post("/api/users/login", json=user_data)
+
+        assert response.status_code == 200
+        assert rollback_threads
+        assert threading.main_thread() not in rollback_threads
+
+    @pytest.mark.asyncio
+    async def test_register_sheds_load_when_hashing_pool_full(self, simple_async_client, monkeypatch):
+        """Test that a saturated hashing pool fails fast with 503."""
+        import asyncio
+        import threading
+        import app.auth
+        pool = app.auth.HashingPool(workers=1, max_pending=1)
+        monkeypatch.setattr(app.auth, "hashing_pool", pool)
+        release = threading.Event()
+        blocked = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0)
+        user_data = {
+            "username": "testuser_api_busy",
+            "password": "testpassword123"
+        }
+        
+        try:
+            response = await simple_async_client.post("/api/users/register", json=user_data)
+        finally:
+            release.set()
+            await blocked
+            pool.shutdown()
+        
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+    
     @pytest.mark.asyncio
     async def test_get_current_user(self, simple_async_client, test_user_data):
         """Test getting current user info."""
@@ -144,6 +225,40 @@ class TestUserEndpoints:
         assert "alice" in usernames
         assert "alex" in usernames
 
+    @pytest.mark.asyncio
+    async def test_list_users_paginated(self, simple_async_client, test_user_data):
+        """Test cursor pagination and projection of the user list."""
+        for i in range(4):
+            await simple_async_client.post("/api/users/register", json={"username": f"pageuser{i}", "password": "password123"})
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+
+        first = await simple_async_client.get("/api/users/", params={"limit": 3}, headers=headers)
+        cursor = first.headers["X-Next-Cursor"]
+        second = await simple_async_client.get("/api/users/", params={"limit": 3, "after_id": cursor}, headers=headers)
+
+        assert first.status_code == second.status_code == 200
+        assert all(set(user) == {"id", "username"} for user in first.json())
+        names = [user["username"] for user in first.json() + second.json()]
+        assert names == [f"pageuser{i}" for i in range(4)] + [test_user_data["username"]]
+        assert "X-Next-Cursor" not in second.headers
+
+    @pytest.mark.asyncio
+    async def test_list_users_etag(self, simple_async_client, test_user_data):
+        """Test revalidation of the user list with If-None-Match."""
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+
+        response = await simple_async_client.get("/api/users/", headers=headers)
+        etag = response.headers["ETag"]
+        cached = await simple_async_client.get("/api/users/", headers={**headers, "If-None-Match": etag})
+        await simple_async_client.post("/api/users/register", json={"username": "latecomer", "password": "password123"})
+        changed = await simple_async_client.get("/api/users/", headers={**headers, "If-None-Match": etag})
+
+        assert cached.status_code == 304
+        assert cached.content == b""
+        assert changed.status_code == 200
+        assert changed.headers["ETag"] != etag
+        assert "latecomer" in [user["username"] for user in changed.json()]
+
 
 class TestChatEndpoints:
     """Test chat-related API endpoints."""
@@ -211,6 +326,59 @@ class TestChatEndpoints:
         assert len(data) >= 1
         assert data[0]["name"] == "Test Chat"
     
+    @pytest.mark.asyncio
+    async def test_get_chats_inbox_tracks_messages(self, simple_async_client):
+        """The chat list shows each side's name, the newest message and unread counts."""
+        alice = {"username": "inbox_alice", "password": "password123"}
+        bob = {"username": "inbox_bob", "password": "password123"}
+        alice_headers = await get_auth_headers(simple_async_client, alice)
+        bob_headers = await get_auth_headers(simple_async_client, bob)
+        bob_id = (await simple_async_client.get("/api/users/me", headers=bob_headers)).json()["id"]
+        group_id = (await simple_async_client.post("/api/chats/", params={"name": "Older"}, headers=alice_headers)).json()["id"]
+        chat_id = (await simple_async_client.post("/api/chats/", params={"user_id": bob_id}, headers=alice_headers)).json()["id"]
+        await simple_async_client.post("/api/messages/", json={"chat_id": group_id, "content": "note"}, headers=alice_headers)
+        for content in ("hi", "are you there?"):
+            await simple_async_client.post("/api/messages/", json={"chat_id": chat_id, "content": content}, headers=bob_headers)
+        
+        alice_chats = (await simple_async_client.get("/api/chats/", headers=alice_headers)).json()
+        bob_chats = (await simple_async_client.get("/api/chats/", headers=bob_headers)).json()
+        
+        assert [chat["id"] for chat in alice_chats] == [chat_id, group_id]
+        assert alice_chats[0]["name"] == "Chat with inbox_bob"
+        assert (alice_chats[0]["last_message_preview"], alice_chats[0]["unread_count"]) == ("are you there?", 2)
+        assert (alice_chats[1]["last_message_preview"], alice_chats[1]["unread_count"]) == ("note", 0)
+        [bob_chat] = bob_chats
+        assert (bob_chat["name"], bob_chat["unread_count"]) == ("Chat with inbox_alice", 0)
+    
+    @pytest.mark.asyncio
+    async def test_read_cursor_updates_unread_counts(self, simple_async_client):
+        """Marking a chat read moves the cursor forward and recounts what is left."""
+        alice = {"username": "read_alice", "password": "password123"}
+        bob = {"username": "read_bob", "password": "password123"}
+        carol = {"username": "read_carol", "password": "password123"}
+        alice_headers = await get_auth_headers(simple_async_client, alice)
+        bob_headers = await get_auth_headers(simple_async_client, bob)
+        carol_headers = await get_auth_headers(simple_async_client, carol)
+        bob_id = (await simple_async_client.get("/api/users/me", headers=bob_headers)).json()["id"]
+        chat_id = (await simple_async_client.post("/api/chats/", params={"user_id": bob_id}, headers=alice_headers)).json()["id"]
+        ids = []
+        for content in ("one", "two", "three"):
+            response = await simple_async_client.post("/api/messages/", json={"chat_id": chat_id, "content": content}, headers=bob_headers)
+            ids.append(response.json()["id"])
+        
+        unread = (await simple_async_client.get("/api/chats/unread", headers=alice_headers)).json()
+        partial = await simple_async_client.post(f"/api/chats/{chat_id}/read", json={"message_id": ids[0]}, headers=alice_headers)
+        backwards = await simple_async_client.post(f"/api/chats/{chat_id}/read", json={"message_id": 1}, headers=alice_headers)
+        full = await simple_async_client.post(f"/api/chats/{chat_id}/read", headers=alice_headers)
+        forbidden = await simple_async_client.post(f"/api/chats/{chat_id}/read", headers=carol_headers)
+        
+        assert unread == {"total": 3, "chats": [{"chat_id": chat_id, "unread_count": 3}]}
+        assert partial.json() == {"chat_id": chat_id, "last_read_message_id": ids[0], "unread_count": 2}
+        assert backwards.json()["last_read_message_id"] == ids[0]
+        assert full.json() == {"chat_id": chat_id, "last_read_message_id": ids[2], "unread_count": 0}
+        assert (await simple_async_client.get("/api/chats/unread", headers=alice_headers)).json()["total"] == 0
+        assert forbidden.status_code == 403
+    
     @pytest.mark.asyncio
     async def test_get_chats_unauthorized(self, simple_async_client):
         """Test getting chats without authentication."""
@@ -287,6 +455,118 @@ class TestMessageEndpoints:
         assert len(data) == 1
         assert data[0]["content"] == "Test message"
     
+    @pytest.mark.asyncio
+    async def test_get_messages_pagination(self, simple_async_client, test_user_data):
+        """Test keyset pagination of chat history."""
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+
+        chat_response = await simple_async_client.post(
+            "/api/chats/",
+            params={"name": "Test Chat"},
+            headers=headers
+        )
+        chat_id = chat_response.json()["id"]
+
+        for i in range(5):
+            await simple_async_client.post(
+                "/api/messages/",
+                json={"chat_id": chat_id, "content": f"Message {i}"},
+                headers=headers
+            )
+
+        # Newest page first, returned oldest-first
+        response = await simple_async_client.get(
+            f"/api/messages/{chat_id}",
+            params={"limit": 2},
+            headers=headers
+        )
+        assert response.status_code == 200
+        assert [m["content"] for m in response.json()] == ["Message 3", "Message 4"]
+        cursor = response.headers["X-Next-Cursor"]
+
+        # Walk back through older pages
+        response = await simple_async_client.get(
+            f"/api/messages/{chat_id}",
+            params={"limit": 2, "before_id": cursor},
+            headers=headers
+        )
+        assert [m["content"] for m in response.json()] == ["Message 1", "Message 2"]
+        cursor = response.headers["X-Next-Cursor"]
+
+        response = await simple_async_client.get(
+            f"/api/messages/{chat_id}",
+            params={"limit": 2, "before_id": cursor},
+            headers=headers
+        )
+        data = response.json()
+        assert [m["content"] for m in data] == ["Message 0"]
+        assert "X-Next-Cursor" not in response.headers
+
+        # And forward again from the oldest message
+        response = await simple_async_client.get(
+            f"/api/messages/{chat_id}",
+            params={"limit": 3, "after_id": data[0]["id"]},
+            headers=headers
+        )
+        assert [m["content"] for m in response.json()] == ["Message 1", "Message 2", "Message 3"]
+        assert "X-Next-Cursor" in response.headers
+
+    @pytest.mark.asyncio
+    async def test_get_messages_conflicting_cursors(self, simple_async_client, test_user_data):
+        """Test that before_id and after_id cannot be combined."""
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+
+        chat_response = await simple_async_client.post(
+            "/api/chats/",
+            params={"name": "Test Chat"},
+            headers=headers
+        )
+        chat_id = chat_response.json()["id"]
+
+        response = await simple_async_client.get(
+            f"/api/messages/{chat_id}",
+            params={"before_id": 10, "after_id": 1},
+            headers=headers
+        )
+
+        assert response.status_code == 400
+
+    @pytest.mark.asyncio
+    async def test_send_message_batch(self, simple_async_client, test_user_data):
+        """Test sending messages to several chats in one request."""
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+        first = (await simple_async_client.post("/api/chats/", params={"name": "First"}, headers=headers)).json()["id"]
+        second = (await simple_async_client.post("/api/chats/", params={"name": "Second"}, headers=headers)).json()["id"]
+
+        response = await simple_async_client.post("/api/messages/batch", json={"messages": [
+            {"chat_id": first, "content": "one"},
+            {"chat_id": second, "content": "two"},
+            {"chat_id": first, "content": "three"},
+        ]}, headers=headers)
+
+        assert response.status_code == 200
+        data = response.json()
+        assert [(m["chat_id"], m["content"]) for m in data] == [(first, "one"), (second, "two"), (first, "three")]
+        assert data[0]["id"] < data[1]["id"] < data[2]["id"]
+        history = (await simple_async_client.get(f"/api/messages/{first}", headers=headers)).json()
+        assert [m["content"] for m in history] == ["one", "three"]
+
+    @pytest.mark.asyncio
+    async def test_send_message_batch_is_atomic(self, simple_async_client, test_user_data):
+        """Test that a batch naming a missing chat saves nothing."""
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+        chat_id = (await simple_async_client.post("/api/chats/", params={"name": "Real"}, headers=headers)).json()["id"]
+
+        response = await simple_async_client.post("/api/messages/batch", json={"messages": [
+            {"chat_id": chat_id, "content": "kept?"},
+            {"chat_id": 99999, "content": "nowhere"},
+        ]}, headers=headers)
+        empty = await simple_async_client.post("/api/messages/batch", json={"messages": []}, headers=headers)
+
+        assert response.status_code == 404
+        assert (await simple_async_client.get(f"/api/messages/{chat_id}", headers=headers)).json() == []
+        assert empty.status_code == 422
+
     @pytest.mark.asyncio
     async def test_send_message_unauthorized(self, simple_async_client):
         """Test sending message without authentication."""
@@ -11,7 +11,10 @@ from jose import jwt, JWTError
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'backend'))
 
 from app.auth import (
+    HashingPool,
+    HashingPoolFull,
     hash_password,
+    needs_rehash,
     verify_password,
     create_access_token,
     SECRET_KEY,
@@ -56,6 +59,61 @@ class TestPasswordHashing:
         assert hash1 != hash2  # bcrypt should produce different salts
 
 
+class TestHashingPool:
+    """Test the bounded bcrypt worker pool."""
+    
+    @pytest.mark.asyncio
+    async def test_run_returns_result(self):
+        """Test that jobs run on the pool and return their result."""
+        pool = HashingPool(workers=1, max_pending=2)
+        try:
+            hashed = await pool.run(hash_password, "test_password_123")
+            assert await pool.run(verify_password, "test_password_123", hashed) is True
+        finally:
+            pool.shutdown()
+    
+    @pytest.mark.asyncio
+    async def test_rejects_when_full(self):
+        """Test that submissions beyond the queue depth are shed immediately."""
+        import asyncio
+        import threading
+        pool = HashingPool(workers=1, max_pending=1)
+        release = threading.Event()
+        try:
+            blocked = asyncio.ensure_future(pool.run(release.wait))
+            await asyncio.sleep(0)
+            with pytest.raises(HashingPoolFull):
+                await pool.run(hash_password, "test_password_123")
+            release.set()
+            assert await blocked is True
+            # The slot is free again once the job has finished
+            assert await pool.run(len, "abc") == 3
+        finally:
+            release.set()
+            pool.shutdown()
+    
+    @pytest.mark.asyncio
+    async def test_non_positive_depth_is_unbounded(self):
+        """Test that HASH_QUEUE_DEPTH <= 0 disables the limit instead of rejecting everything."""
+        pool = HashingPool(workers=1, max_pending=0)
+        try:
+            assert await pool.run(len, "abc") == 3
+        finally:
+            pool.shutdown()
+    
+    def test_needs_rehash(self, monkeypatch):
+        """Test detection of hashes made with a different bcrypt cost."""
+        import app.auth
+        monkeypatch.setattr(app.auth, "BCRYPT_ROUNDS", 4)
+        hashed = hash_password("test_password_123")
+        
+        assert hashed.startswith("$2b$04$")
+        assert needs_rehash(hashed) is False
+        monkeypatch.setattr(app.auth, "BCRYPT_ROUNDS", 5)
+        assert needs_rehash(hashed) is True
+        assert needs_rehash("not-a-bcrypt-hash") is True
+
+
 class TestTokenCreation:
     """Test JWT token creation and validation."""
     
@@ -149,3 +207,42 @@ class TestSecurityConstants:
     def test_token_expiry_reasonable(self):
         """Test that token expiry is reasonable."""
         assert 5 <= ACCESS_TOKEN_EXPIRE_MINUTES <= 60
+
+
+class TestTTLCache:
+    """Test the bounded TTL/LRU cache used for authenticated users."""
+    
+    def test_evicts_least_recently_used(self):
+        """Test that a full cache evicts the least recently used entry."""
+        from app.cache import TTLCache
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+    
+    def test_entries_expire(self):
+        """Test that entries are not returned after their TTL."""
+        from app.cache import TTLCache
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("short", 1, ttl=0)
+        cache.set("long", 2)
+        
+        assert cache.get("short") is None
+        assert cache.get("long") == 2
+        assert len(cache) == 1
+    
+    def test_discard_where(self):
+        """Test removing entries by value."""
+        from app.cache import TTLCache
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("t1", 1)
+        cache.set("t2", 1)
+        cache.set("t3", 2)
+        
+        assert cache.discard_where(lambda value: value == 1) == 2
+        assert len(cache) == 1
@@ -0,0 +1,77 @@
+"""
+Unit tests for structured logging.
+"""
+import io
+import json
+import logging
+import queue
+import pytest
+import sys
+import os
+
+# Add backend directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'backend'))
+
+from app import log
+
+
+@pytest.fixture
+def captured():
+    """Route the test logger through a queue handler into a buffer."""
+    stream = io.StringIO()
+    log.configure_logging(level="DEBUG", fmt="json", stream=stream)
+    yield stream
+    log.configure_logging()
+
+
+def lines(stream):
+    log.stop_logging()
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+class TestStructuredLogger:
+    """Test event records, levels and sampling."""
+
+    def test_event_fields_and_correlation_ids(self, captured):
+        logger = log.get_logger("test.events")
+        token = log.connection_id.set(42)
+        try:
+            logger.info("ws_connected", user_id=7)
+        finally:
+            log.connection_id.reset(token)
+        logger.debug("plain")
+
+        first, second = lines(captured)
+        assert (first["event"], first["level"], first["logger"]) == ("ws_connected", "info", "test.events")
+        assert (first["user_id"], first["connection_id"]) == (7, 42)
+        assert "connection_id" not in second
+
+    def test_sampling(self, captured):
+        logger = log.get_logger("test.sampled")
+        for i in range(20):
+            logger.sampled("message_sent", rate=0, message_id=i)
+        logger.sampled("message_sent", rate=1, message_id=99)
+
+        [entry] = lines(captured)
+        assert (entry["message_id"], entry["sample_rate"]) == (99, 1)
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = log.DroppingQueueHandler(queue.Queue(1))
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, "event", (), None)
+
+        handler.handle(record)
+        handler.handle(record)
+
+        assert handler.dropped == 1
+
+
+class TestRequestIds:
+    """Test the HTTP correlation id middleware."""
+
+    @pytest.mark.asyncio
+    async def test_request_id_is_generated_or_echoed(self, simple_async_client):
+        generated = await simple_async_client.get("/api/users/me")
+        echoed = await simple_async_client.get("/api/users/me", headers={"X-Request-ID": "req-123"})
+
+        assert len(generated.headers["X-Request-ID"]) == 32
+        assert echoed.headers["X-Request-ID"] == "req-123"
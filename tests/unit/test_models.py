@@ -229,3 +229,117 @@ class TestModelRelationships:
         assert len(chat_messages) == 2
         assert chat_messages[0].content == "Message 1"
         assert chat_messages[1].content == "Message 2"
+
+
+class TestMigrations:
+    """Test the Alembic migrations."""
+
+    def _config(self, db_path):
+        from alembic.config import Config
+        backend = os.path.join(os.path.dirname(__file__), '..', '..', 'backend')
+        config = Config(os.path.join(backend, "alembic.ini"))
+        config.set_main_option("sqlalchemy.url", f"sqlite:///{db_path}")
+        config.attributes["configure_logger"] = False
+        return config
+
+    def test_upgrade_creates_indexes(self, tmp_path):
+        from alembic import command
+        from sqlalchemy import create_engine, text
+        db_path = tmp_path / "migrated.db"
+
+        command.upgrade(self._config(db_path), "head")
+
+        with create_engine(f"sqlite:///{db_path}").connect() as conn:
+            indexes = dict(conn.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'index'")).all())
+        assert {"ix_messages_chat_id_id", "ix_messages_chat_id_timestamp", "ix_chat_members_user_id_chat_id"} <= indexes.keys()
+        assert indexes["uq_chat_members_chat_id_user_id"].startswith("CREATE UNIQUE INDEX")
+        assert "lower(username)" in indexes["ix_users_username_lower"]
+
+    def test_upgraded_schema_matches_models(self, tmp_path):
+        from alembic import command
+        config = self._config(tmp_path / "check.db")
+        command.upgrade(config, "head")
+
+        # Raises if autogenerate would emit anything, e.g. dropping messages_fts
+        command.check(config)
+
+    def test_upgrade_removes_duplicate_members(self, tmp_path):
+        from alembic import command
+        from sqlalchemy import create_engine, text
+        db_path = tmp_path / "legacy.db"
+        config = self._config(db_path)
+        command.upgrade(config, "0001")
+        engine = create_engine(f"sqlite:///{db_path}")
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO users (id, username, password_hash) VALUES (1, 'a', 'x')"))
+            conn.execute(text("INSERT INTO chats (id, name) VALUES (1, 'c')"))
+            for _ in range(3):
+                conn.execute(text("INSERT INTO chat_members (chat_id, user_id) VALUES (1, 1)"))
+
+        command.upgrade(config, "head")
+
+        with engine.connect() as conn:
+            ids = conn.execute(text("SELECT id FROM chat_members")).scalars().all()
+        assert ids == [1]
+        with pytest.raises(IntegrityError):
+            with engine.begin() as conn:
+                conn.execute(text("INSERT INTO chat_members (chat_id, user_id) VALUES (1, 1)"))
+
+    def test_upgrade_backfills_inbox(self, tmp_path):
+        from alembic import command
+        from sqlalchemy import create_engine, text
+        db_path = tmp_path / "inbox.db"
+        config = self._config(db_path)
+        command.upgrade(config, "0004")
+        engine = create_engine(f"sqlite:///{db_path}")
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO users (id, username, password_hash) VALUES (1, 'ann', 'x'), (2, 'ben', 'x')"))
+            conn.execute(text("INSERT INTO chats (id, name) VALUES (1, 'Chat with ben'), (2, 'Group')"))
+            conn.execute(text("INSERT INTO chat_members (chat_id, user_id) VALUES (1, 1), (1, 2), (2, 1)"))
+            conn.execute(text("INSERT INTO messages (chat_id, user_id, content) VALUES (1, 1, 'first'), (1, 2, 'latest')"))
+
+        command.upgrade(config, "head")
+
+        with engine.connect() as conn:
+            rows = conn.execute(text(
+                "SELECT user_id, chat_id, display_name, last_message_preview, unread_count FROM user_chats ORDER BY user_id, chat_id"
+            )).all()
+        assert [tuple(row) for row in rows] == [
+            (1, 1, "Chat with ben", "latest", 0),
+            (1, 2, "Group", None, 0),
+            (2, 1, "Chat with ann", "latest", 0),
+        ]
+
+        with engine.connect() as conn:
+            cursors = conn.execute(text(
+                "SELECT chat_id, user_id, last_read_message_id FROM chat_members ORDER BY chat_id, user_id"
+            )).all()
+        # Existing history counts as read
+        assert [tuple(row) for row in cursors] == [(1, 1, 2), (1, 2, 2), (2, 1, None)]
+
+    def test_models_declare_migrated_indexes(self):
+        indexes = {ix.name for table in Base.metadata.tables.values() for ix in table.indexes}
+        assert {
+            "ix_messages_chat_id_id", "ix_messages_chat_id_timestamp",
+            "ix_chat_members_user_id_chat_id", "uq_chat_members_chat_id_user_id",
+            "ix_users_username_lower", "ix_user_chats_user_id_last_message_time",
+        } <= indexes
+
+
+class TestMessagePartitions:
+    """Test the id-range partition planning for PostgreSQL."""
+
+    def test_planned_partitions_cover_current_and_ahead(self):
+        from app.partitions import planned_partitions
+        assert planned_partitions(0, size=100, ahead=2) == [0, 1, 2]
+        assert planned_partitions(250, size=100, ahead=2) == [2, 3, 4]
+
+    def test_partition_ddl(self):
+        from app.partitions import partition_ddl
+        assert partition_ddl(3, size=100) == (
+            "CREATE TABLE IF NOT EXISTS messages_p00003 PARTITION OF messages FOR VALUES FROM (300) TO (400)"
+        )
+
+    def test_sqlite_is_left_unpartitioned(self, test_db_session):
+        from app.partitions import ensure_partitions
+        assert ensure_partitions(test_db_session.connection()) == []
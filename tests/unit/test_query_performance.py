@@ -0,0 +1,431 @@
+"""
+Query-count benchmarks for hot API endpoints.
+
+These tests guard against N+1 query regressions: the number of SQL
+statements an endpoint issues must not grow with the size of the data set.
+"""
+import pytest
+import sys
+import os
+from contextlib import contextmanager
+from sqlalchemy import event
+
+# Add backend directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'backend'))
+
+from app.db import engine, async_engine, SessionLocal
+from app.inbox import new_chat_entries
+from app.models import User, Chat, ChatMember
+
+
+@contextmanager
+def count_queries():
+    """Count SQL statements executed on the application's sync and async engines."""
+    statements = []
+    engines = (engine, async_engine.sync_engine)
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    for target in engines:
+        event.listen(target, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        for target in engines:
+            event.remove(target, "before_cursor_execute", before_cursor_execute)
+
+
+async def register_and_login(client, username, password="password123"):
+    """Register a user and return (user_id, auth headers)."""
+    response = await client.post("/api/users/register", json={"username": username, "password": password})
+    user_id = response.json()["id"]
+    login_response = await client.post("/api/users/login", json={"username": username, "password": password})
+    token = login_response.json()["access_token"]
+    return user_id, {"Authorization": f"Bearer {token}"}
+
+
+def create_chats(owner_id, count):
+    """Create `count` private and `count` group chats for the owner directly in the database."""
+    db = SessionLocal()
+    try:
+        for i in range(count):
+            peer = User(username=f"peer_{owner_id}_{i}", password_hash="hash")
+            private_chat = Chat(name=f"Chat with peer_{owner_id}_{i}")
+            group_chat = Chat(name=f"Group {owner_id}_{i}")
+            db.add_all([peer, private_chat, group_chat])
+            db.flush()
+            db.add_all([
+                ChatMember(chat_id=private_chat.id, user_id=owner_id),
+                ChatMember(chat_id=private_chat.id, user_id=peer.id),
+                ChatMember(chat_id=group_chat.id, user_id=owner_id),
+            ])
+            owner = db.get(User, owner_id)
+            db.add_all(new_chat_entries(private_chat, [(owner_id, owner.username), (peer.id, peer.username)]))
+            db.add_all(new_chat_entries(group_chat, [(owner_id, owner.username)]))
+        db.commit()
+    finally:
+        db.close()
+
+
+class TestChatListQueryCount:
+    """GET /api/chats/ must issue a constant number of queries."""
+
+    @pytest.mark.asyncio
+    async def test_get_chats_query_count_is_constant(self, simple_async_client):
+        small_user_id, small_headers = await register_and_login(simple_async_client, "qc_small")
+        large_user_id, large_headers = await register_and_login(simple_async_client, "qc_large")
+        create_chats(small_user_id, 2)
+        create_chats(large_user_id, 50)
+
+        with count_queries() as small_statements:
+            small_response = await simple_async_client.get("/api/chats/", headers=small_headers)
+        with count_queries() as large_statements:
+            large_response = await simple_async_client.get("/api/chats/", headers=large_headers)
+
+        assert small_response.status_code == 200
+        assert large_response.status_code == 200
+        assert len(small_response.json()) == 4
+        assert len(large_response.json()) == 100
+        assert len(large_statements) == len(small_statements)
+
+    @pytest.mark.asyncio
+    async def test_get_chats_private_chat_names(self, simple_async_client):
+        user_id, headers = await register_and_login(simple_async_client, "qc_names")
+        create_chats(user_id, 1)
+
+        response = await simple_async_client.get("/api/chats/", headers=headers)
+
+        names = sorted(chat["name"] for chat in response.json())
+        assert names == [f"Chat with peer_{user_id}_0", f"Group {user_id}_0"]
+
+
+class TestAuthCacheQueryCount:
+    """Authenticated requests must not query the users table once cached."""
+
+    @pytest.mark.asyncio
+    async def test_cached_token_skips_user_lookup(self, simple_async_client):
+        _, headers = await register_and_login(simple_async_client, "qc_auth")
+
+        with count_queries() as first_statements:
+            first = await simple_async_client.get("/api/users/me", headers=headers)
+        with count_queries() as second_statements:
+            second = await simple_async_client.get("/api/users/me", headers=headers)
+
+        assert first.status_code == second.status_code == 200
+        assert first.json() == second.json()
+        assert len(first_statements) == 1
+        assert len(second_statements) == 0
+
+    @pytest.mark.asyncio
+    async def test_invalidate_user_forces_lookup(self, simple_async_client):
+        from app.dependencies import invalidate_user
+
+        user_id, headers = await register_and_login(simple_async_client, "qc_invalidate")
+        await simple_async_client.get("/api/users/me", headers=headers)
+
+        assert invalidate_user(user_id) == 1
+        with count_queries() as statements:
+            response = await simple_async_client.get("/api/users/me", headers=headers)
+
+        assert response.status_code == 200
+        assert len(statements) == 1
+
+
+class TestSendMessageQueryCount:
+    """POST /api/messages/ must not re-read the row it just inserted."""
+
+    @pytest.mark.asyncio
+    async def test_send_message_skips_refresh(self, simple_async_client):
+        _, headers = await register_and_login(simple_async_client, "qc_send")
+        chat_response = await simple_async_client.post("/api/chats/", params={"name": "Send"}, headers=headers)
+        chat_id = chat_response.json()["id"]
+        # Warm the auth cache
+        await simple_async_client.get("/api/users/me", headers=headers)
+
+        with count_queries() as statements:
+            response = await simple_async_client.post(
+                "/api/messages/", json={"chat_id": chat_id, "content": "hi"}, headers=headers
+            )
+
+        assert response.status_code == 200
+        assert response.json()["id"] is not None
+        assert sorted(s.split()[0] for s in statements) == ["INSERT", "SELECT", "UPDATE", "UPDATE"]
+
+    @pytest.mark.asyncio
+    async def test_batch_statement_count_is_constant(self, simple_async_client):
+        _, headers = await register_and_login(simple_async_client, "qc_batch")
+        chat_ids = [
+            (await simple_async_client.post("/api/chats/", params={"name": f"Batch {i}"}, headers=headers)).json()["id"]
+            for i in range(3)
+        ]
+        await simple_async_client.get("/api/users/me", headers=headers)
+        batch = [{"chat_id": chat_ids[i % 3], "content": f"m{i}"} for i in range(60)]
+
+        with count_queries() as statements:
+            response = await simple_async_client.post("/api/messages/batch", json={"messages": batch}, headers=headers)
+
+        assert response.status_code == 200
+        assert len(response.json()) == 60
+        assert sorted(s.split()[0] for s in statements) == ["INSERT", "SELECT", "UPDATE", "UPDATE"]
+
+
+class TestGroupCommit:
+    """Concurrent sends share one INSERT and one commit when grouped."""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_sends_are_flushed_together(self, simple_async_client):
+        import asyncio
+        from app.group_commit import GroupCommitWriter
+        from app.messaging import ChatNotFound, _flush_group
+        from app.schemas import MessageCreate
+        user_id, headers = await register_and_login(simple_async_client, "qc_group")
+        chat_id = (await simple_async_client.post("/api/chats/", params={"name": "Group"}, headers=headers)).json()["id"]
+        writer = GroupCommitWriter(_flush_group, max_batch=100, delay=0.05)
+
+        with count_queries() as statements:
+            results = await asyncio.gather(
+                *(writer.submit(user_id, [MessageCreate(chat_id=chat_id, content=f"m{i}")]) for i in range(20)),
+                writer.submit(user_id, [MessageCreate(chat_id=99999, content="lost")]),
+                return_exceptions=True,
+            )
+        await writer.stop()
+
+        *saved, missing = results
+        assert isinstance(missing, ChatNotFound)
+        assert [message.content for [message] in saved] == [f"m{i}" for i in range(20)]
+        assert len({message.id for [message] in saved}) == 20
+        assert sorted(s.split()[0] for s in statements) == ["INSERT", "SELECT", "UPDATE", "UPDATE"]
+        assert writer.stats()["batches"] == 1
+
+    @pytest.mark.asyncio
+    async def test_batch_is_flushed_when_full(self, simple_async_client):
+        import asyncio
+        from app.group_commit import GroupCommitWriter
+        from app.messaging import _flush_group
+        from app.schemas import MessageCreate
+        user_id, headers = await register_and_login(simple_async_client, "qc_group_full")
+        chat_id = (await simple_async_client.post("/api/chats/", params={"name": "Full"}, headers=headers)).json()["id"]
+        # A deadline the test would notice if a full batch waited for it
+        writer = GroupCommitWriter(_flush_group, max_batch=5, delay=30)
+
+        results = await asyncio.wait_for(asyncio.gather(
+            *(writer.submit(user_id, [MessageCreate(chat_id=chat_id, content=f"m{i}")]) for i in range(10))
+        ), timeout=10)
+        await writer.stop()
+
+        assert len(results) == 10
+        assert writer.stats()["batches"] == 2
+
+
+class TestHistoryCacheQueryCount:
+    """The newest page of a recently read chat is served without the database."""
+
+    @pytest.mark.asyncio
+    async def test_hot_chat_first_page_issues_no_queries(self, simple_async_client):
+        _, headers = await register_and_login(simple_async_client, "qc_history")
+        chat_id = (await simple_async_client.post("/api/chats/", params={"name": "Hot"}, headers=headers)).json()["id"]
+        for i in range(3):
+            await simple_async_client.post("/api/messages/", json={"chat_id": chat_id, "content": f"m{i}"}, headers=headers)
+        # The first read fills the cache; later sends are written through
+        await simple_async_client.get(f"/api/messages/{chat_id}", headers=headers)
+        await simple_async_client.post("/api/messages/", json={"chat_id": chat_id, "content": "m3"}, headers=headers)
+
+        with count_queries() as statements:
+            response = await simple_async_client.get(f"/api/messages/{chat_id}", params={"limit": 2}, headers=headers)
+
+        assert statements == []
+        assert [m["content"] for m in response.json()] == ["m2", "m3"]
+        assert response.headers["X-Next-Cursor"] == str(response.json()[0]["id"])
+        older = await simple_async_client.get(
+            f"/api/messages/{chat_id}", params={"before_id": response.headers["X-Next-Cursor"]}, headers=headers
+        )
+        assert [m["content"] for m in older.json()] == ["m0", "m1"]
+
+
+class TestMessageArchive:
+    """Test the cold-storage archive and reads that cross into it."""
+
+    def test_segments_are_append_only_and_idempotent(self, tmp_path):
+        from app.archive import MessageArchive
+        archive = MessageArchive(str(tmp_path), codec="zlib", chunk=2, chunk_cache=0)
+        messages = [(i, b'{"id":%d}' % i) for i in range(1, 6)]
+
+        assert archive.append(7, messages[:3]) == 3
+        # Retried after a crash before the rows were deleted
+        assert archive.append(7, messages) == 2
+
+        assert archive.boundary(7) == 5
+        assert archive.read_before(7, None, 2) == messages[3:]
+        assert archive.read_before(7, 4, 10) == messages[:3]
+        assert archive.read_after(7, 1, 3) == messages[1:4]
+        assert archive.boundary(8) == 0
+
+    @pytest.mark.asyncio
+    async def test_current_boundary_stays_off_the_disk(self, tmp_path, monkeypatch):
+        from app.archive import MessageArchive
+        disabled = MessageArchive(str(tmp_path), codec="zlib")
+        disabled.append(7, [(3, b"{}")])
+        archive = MessageArchive(str(tmp_path), codec="zlib", enabled=True)
+        reads = []
+        read_boundary = archive.boundary
+        monkeypatch.setattr(archive, "boundary", lambda chat_id: reads.append(chat_id) or read_boundary(chat_id))
+
+        assert await disabled.current_boundary(7) == 0
+        assert await archive.current_boundary(7) == 3
+        assert await archive.current_boundary(7) == 3
+        assert await archive.current_boundary(8) == 0
+        assert await archive.current_boundary(8) == 0
+        assert reads == [7, 8]
+        # Appends through this instance update the boundary in memory
+        archive.append(7, [(4, b"{}")])
+        assert await archive.current_boundary(7) == 4
+
+    def test_zstd_chunks(self, tmp_path):
+        pytest.importorskip("zstandard")
+        from app.archive import MessageArchive
+        archive = MessageArchive(str(tmp_path), codec="zstd")
+        archive.append(1, [(1, b'{"id":1}')])
+        assert archive.read_after(1, 0) == [(1, b'{"id":1}')]
+
+    def test_archiver_requires_shared_storage(self, tmp_path):
+        from app.archive import Archiver, MessageArchive
+        archiver = Archiver(MessageArchive(str(tmp_path), codec="zlib"), SessionLocal, engine, after_days=30, shared=False)
+        with pytest.raises(RuntimeError):
+            archiver.start()
+
+    def test_archiver_run_moves_old_messages(self, tmp_path, test_db_session):
+        from datetime import datetime, timedelta
+        from app.archive import Archiver, MessageArchive
+        from app.models import Message
+        chat = Chat(name="Cold")
+        user = User(username="cold_user", password_hash="hash")
+        test_db_session.add_all([chat, user])
+        test_db_session.flush()
+        old = datetime.utcnow() - timedelta(days=40)
+        test_db_session.add_all([Message(chat_id=chat.id, user_id=user.id, content=f"c{i}", timestamp=old) for i in range(3)])
+        test_db_session.commit()
+        from sqlalchemy.orm import sessionmaker
+        bind = test_db_session.get_bind()
+        archiver = Archiver(MessageArchive(str(tmp_path), codec="zlib"), sessionmaker(bind=bind), bind, after_days=30, shared=True)
+
+        # The table's newest message stays behind
+        assert archiver.run_once() == 2
+        assert archiver.archive.boundary(chat.id) > 0
+
+    @pytest.mark.asyncio
+    async def test_history_falls_through_to_archive(self, simple_async_client, tmp_path, monkeypatch):
+        from datetime import datetime, timedelta
+        from app.archive import MessageArchive, archive_messages
+        from app.history import recent_messages
+        from app.routers import messages as messages_router
+        archive = MessageArchive(str(tmp_path), codec="zlib", chunk=2, enabled=True)
+        monkeypatch.setattr(messages_router, "message_archive", archive)
+        _, headers = await register_and_login(simple_async_client, "qc_archive")
+        chat_id = (await simple_async_client.post("/api/chats/", params={"name": "Old"}, headers=headers)).json()["id"]
+        for content in ("old0", "old1", "old2", "old3", "new"):
+            await simple_async_client.post("/api/messages/", json={"chat_id": chat_id, "content": content}, headers=headers)
+        db = SessionLocal()
+        try:
+            # The newest message stays in the table whatever its age
+            assert archive_messages(db, archive, datetime.utcnow() + timedelta(seconds=1)) == 4
+        finally:
+            db.close()
+        recent_messages.clear()
+
+        newest = await simple_async_client.get(f"/api/messages/{chat_id}", params={"limit": 3}, headers=headers)
+        cursor = newest.headers["X-Next-Cursor"]
+        older = await simple_async_client.get(f"/api/messages/{chat_id}", params={"before_id": cursor}, headers=headers)
+        first_id = older.json()[0]["id"]
+        forward = await simple_async_client.get(f"/api/messages/{chat_id}", params={"after_id": first_id, "limit": 3}, headers=headers)
+
+        assert [m["content"] for m in newest.json()] == ["old2", "old3", "new"]
+        assert [m["content"] for m in older.json()] == ["old0", "old1"]
+        assert "X-Next-Cursor" not in older.headers
+        assert [m["content"] for m in forward.json()] == ["old1", "old2", "old3"]
+
+
+class TestRecentMessagesCache:
+    """Test the history cache's bounds and its protection against stale fills."""
+
+    def test_fill_racing_a_write_is_rejected(self):
+        from app.history import RecentMessagesCache
+        cache = RecentMessagesCache(per_chat=10, max_chats=10, max_bytes=1000)
+        version = cache.version()
+        cache.append(1, 3, b"3")
+        cache.fill(1, [(1, b"1"), (2, b"2")], False, version)
+
+        assert cache.page(1, 10) is None
+        cache.fill(1, [(1, b"1"), (2, b"2"), (3, b"3")], False, cache.version())
+        cache.append(1, 4, b"4")
+        assert cache.page(1, 2) == (b"[3,4]", 3)
+        assert cache.page(1, 10) == (b"[1,2,3,4]", None)
+
+    def test_bounded_by_chats_and_bytes(self):
+        from app.history import RecentMessagesCache
+        cache = RecentMessagesCache(per_chat=2, max_chats=2, max_bytes=8)
+        cache.fill(1, [(1, b"aa"), (2, b"bb"), (3, b"cc")], False, cache.version())
+        # Only the newest two are kept, so older pages must come from the database
+        assert cache.page(1, 2) == (b"[bb,cc]", 2)
+        assert cache.page(1, 3) is None
+
+        cache.fill(2, [(4, b"dd")], False, cache.version())
+        cache.fill(3, [(5, b"ee")], False, cache.version())
+        assert cache.stats()["chats"] == 2 and cache.page(1, 1) is None
+
+        cache.fill(4, [(6, b"ffffffff")], False, cache.version())
+        assert cache.stats()["bytes"] <= 8
+        assert cache.page(4, 1) == (b"[ffffffff]", None)
+
+
+class TestPoolMetrics:
+    """Connection pool metrics are exposed for pool sizing."""
+
+    @pytest.mark.asyncio
+    async def test_db_metrics_endpoint(self, simple_async_client, monkeypatch):
+        monkeypatch.setattr("app.dependencies.METRICS_TOKEN", "ops-secret")
+        _, headers = await register_and_login(simple_async_client, "qc_pool")
+        await simple_async_client.get("/api/chats/", headers=headers)
+
+        response = await simple_async_client.get("/api/metrics/db", headers={"X-Metrics-Token": "ops-secret"})
+
+        assert response.status_code == 200
+        data = response.json()
+        for pool in ("sync", "async"):
+            assert data[pool]["checkouts"] >= 1
+            assert data[pool]["timeouts"] == 0
+            assert 0 <= data[pool]["utilization"] <= 1
+            assert data[pool]["wait_max_ms"] >= data[pool]["wait_avg_ms"] >= 0
+
+    @pytest.mark.asyncio
+    async def test_metrics_need_operator_token(self, simple_async_client, monkeypatch):
+        _, headers = await register_and_login(simple_async_client, "qc_metrics_user")
+        response = await simple_async_client.get("/api/metrics/websockets", headers=headers)
+        assert response.status_code == 404
+
+        monkeypatch.setattr("app.dependencies.METRICS_TOKEN", "ops-secret")
+        for path in ("websockets", "db", "history", "archive"):
+            response = await simple_async_client.get(f"/api/metrics/{path}", headers=headers)
+            assert response.status_code == 403
+        response = await simple_async_client.get("/api/metrics/history", headers={"X-Metrics-Token": "wrong"})
+        assert response.status_code == 403
+
+    def test_pool_timeout_is_counted(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+        from app.db import InstrumentedQueuePool, pool_stats
+        test_engine = create_engine(
+            "sqlite://", poolclass=InstrumentedQueuePool,
+            pool_size=1, max_overflow=0, pool_timeout=0.01
+        )
+        held = test_engine.connect()
+        try:
+            with pytest.raises(PoolTimeoutError):
+                test_engine.connect()
+            stats = pool_stats(test_engine.pool)
+            assert stats["timeouts"] == 1
+            assert stats["checked_out"] == 1
+            assert stats["utilization"] == 1.0
+        finally:
+            held.close()
+            test_engine.dispose()
@@ -0,0 +1,152 @@
+"""
+Unit tests for username search.
+"""
+import pytest
+import sys
+import os
+
+# Add backend directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'backend'))
+
+from app.search import UsernameIndex
+from tests.unit.test_api_endpoints import get_auth_headers
+
+
+@pytest.fixture
+def index():
+    index = UsernameIndex()
+    for user_id, username in enumerate(["alex", "Alexander", "malexa", "aleks", "bob", "xal"], start=1):
+        index.add(user_id, username)
+    return index
+
+
+class TestUsernameIndex:
+    """Test the in-memory trigram index."""
+
+    def test_short_query_matches_prefixes_only(self, index):
+        assert index.search("al", 10) == [1, 4, 2]
+
+    def test_ranks_exact_prefix_substring_then_similar(self, index):
+        # alex (exact), alexander (prefix), malexa (substring), aleks (similar)
+        assert index.search("alex", 10) == [1, 2, 3, 4]
+
+    def test_limit_and_exclude(self, index):
+        assert index.search("alex", 2) == [1, 2]
+        assert index.search("alex", 2, exclude_id=1) == [2, 3]
+
+    def test_remove_and_rename(self, index):
+        index.remove(2)
+        index.add(1, "bobby")
+
+        assert index.search("alex", 10) == [3, 4]
+        assert index.search("bob", 10) == [5, 1]
+
+    def test_case_insensitive(self, index):
+        assert index.search("alexander", 10)[0] == 2
+
+
+class TestSearchEndpoint:
+    """Test GET /api/users/search/{username}."""
+
+    @pytest.mark.asyncio
+    async def test_ranked_and_limited(self, simple_async_client, test_user_data):
+        for username in ["searchbob", "bob", "bobby", "robert"]:
+            await simple_async_client.post("/api/users/register", json={"username": username, "password": "password123"})
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+
+        response = await simple_async_client.get("/api/users/search/BOB", headers=headers)
+        limited = await simple_async_client.get("/api/users/search/bob", params={"limit": 1}, headers=headers)
+
+        assert [user["username"] for user in response.json()] == ["bob", "bobby", "searchbob"]
+        assert [user["username"] for user in limited.json()] == ["bob"]
+
+    @pytest.mark.asyncio
+    async def test_excludes_current_user(self, simple_async_client, test_user_data):
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+
+        response = await simple_async_client.get(f"/api/users/search/{test_user_data['username']}", headers=headers)
+
+        assert response.status_code == 200
+        assert response.json() == []
+
+
+class TestMessageSearch:
+    """Test GET /api/messages/search."""
+
+    async def _chat_with_messages(self, client, headers, name, contents):
+        chat = (await client.post("/api/chats/", params={"name": name}, headers=headers)).json()
+        for content in contents:
+            await client.post("/api/messages/", json={"chat_id": chat["id"], "content": content}, headers=headers)
+        return chat["id"]
+
+    @pytest.mark.asyncio
+    async def test_finds_messages_with_snippets(self, simple_async_client, test_user_data):
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+        chat_id = await self._chat_with_messages(simple_async_client, headers, "Deploys", [
+            "Deploy finished on staging", "Lunch?", "Rolling back the deploy",
+        ])
+
+        response = await simple_async_client.get("/api/messages/search", params={"q": "DEPLOY"}, headers=headers)
+
+        assert response.status_code == 200
+        results = response.json()
+        assert [r["content"] for r in results] == ["Rolling back the deploy", "Deploy finished on staging"]
+        assert results[0]["chat_id"] == chat_id
+        assert "<mark>deploy</mark>" in results[0]["snippet"]
+
+    @pytest.mark.asyncio
+    async def test_scoped_to_member_chats(self, simple_async_client, test_user_data):
+        other = {"username": "outsider", "password": "password123"}
+        other_headers = await get_auth_headers(simple_async_client, other)
+        foreign_chat = await self._chat_with_messages(simple_async_client, other_headers, "Private", ["secret plans"])
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+
+        response = await simple_async_client.get("/api/messages/search", params={"q": "secret"}, headers=headers)
+        scoped = await simple_async_client.get(
+            "/api/messages/search", params={"q": "secret", "chat_id": foreign_chat}, headers=headers
+        )
+
+        assert response.json() == []
+        assert scoped.status_code == 403
+
+    @pytest.mark.asyncio
+    async def test_cursor_pagination(self, simple_async_client, test_user_data):
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+        await self._chat_with_messages(simple_async_client, headers, "Log", [f"build {i} ok" for i in range(5)])
+
+        first = await simple_async_client.get("/api/messages/search", params={"q": "build", "limit": 3}, headers=headers)
+        second = await simple_async_client.get(
+            "/api/messages/search",
+            params={"q": "build", "limit": 3, "before_id": first.headers["X-Next-Cursor"]},
+            headers=headers,
+        )
+
+        contents = [r["content"] for r in first.json() + second.json()]
+        assert contents == [f"build {i} ok" for i in reversed(range(5))]
+        assert "X-Next-Cursor" not in second.headers
+
+    @pytest.mark.asyncio
+    async def test_snippet_escapes_message_html(self, simple_async_client, test_user_data):
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+        await self._chat_with_messages(simple_async_client, headers, "Web", ['<img src=x onerror="alert(1)"> payload'])
+
+        response = await simple_async_client.get("/api/messages/search", params={"q": "payload"}, headers=headers)
+
+        snippet = response.json()[0]["snippet"]
+        assert "<img" not in snippet
+        assert "&lt;img" in snippet
+        assert snippet.endswith("<mark>payload</mark>")
+
+    @pytest.mark.asyncio
+    async def test_query_syntax_is_literal(self, simple_async_client, test_user_data):
+        headers = await get_auth_headers(simple_async_client, test_user_data)
+        await self._chat_with_messages(simple_async_client, headers, "Ops", ["cpu AND memory"])
+
+        response = await simple_async_client.get("/api/messages/search", params={"q": 'memory" OR ('}, headers=headers)
+        either = await simple_async_client.get("/api/messages/search", params={"q": "cpu OR disk"}, headers=headers)
+        excluded = await simple_async_client.get("/api/messages/search", params={"q": "cpu -memory"}, headers=headers)
+
+        assert response.status_code == 200
+        # OR and - are words to match, not operators
+        assert either.json() == []
+        assert [r["content"] for r in excluded.json()] == ["cpu AND memory"]
@@ -0,0 +1,650 @@
+"""
+Unit tests for WebSocket message delivery.
+"""
+import asyncio
+import json
+import pytest
+import pytest_asyncio
+import sys
+import os
+
+# Add backend directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'backend'))
+
+import app.websocket as ws
+from app.connections import Connection
+
+
+class FakeWebSocket:
+    """Minimal stand-in for a Starlette WebSocket."""
+
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, data):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("connection reset")
+        self.sent.append(data)
+
+    async def close(self, code=1000, reason=None):
+        self.close_code = code
+
+
+async def drain():
+    """Give writer tasks a chance to run."""
+    await asyncio.sleep(0.01)
+
+
+@pytest_asyncio.fixture
+async def chat_connections():
+    """Register connections wrapping fake sockets, subscribed to a chat (1 by default)."""
+    created = []
+
+    def register(sock, user_id, chat_id=1, **options):
+        conn = Connection(sock, user_id, on_close=ws.remove_connection, **options)
+        conn.start()
+        ws.register_connection(conn)
+        ws.subscribe(conn, [chat_id])
+        created.append(conn)
+        return conn
+
+    yield register
+    for conn in created:
+        await conn.close()
+
+
+class TestBroadcast:
+    """Test fan-out to chat connections."""
+
+    @pytest.mark.asyncio
+    async def test_slow_and_dead_clients_are_evicted(self, chat_connections):
+        good = FakeWebSocket()
+        slow = FakeWebSocket(delay=1)
+        dead = FakeWebSocket(fail=True)
+        good_conn = chat_connections(good, 1)
+        chat_connections(slow, 2, send_timeout=0.05)
+        chat_connections(dead, 3)
+
+        accepted = ws.broadcast(1, "payload")
+        await asyncio.sleep(0.1)
+
+        assert accepted == 3
+        assert good.sent == ["payload"]
+        assert ws.chat_users[1] == {1: 1}
+        assert [conn for conns in ws.user_connections.values() for conn in conns] == [good_conn]
+        assert slow.close_code == dead.close_code == 1013
+
+    @pytest.mark.asyncio
+    async def test_broadcast_does_not_wait_for_delivery(self, chat_connections):
+        sockets = [FakeWebSocket(delay=0.1) for _ in range(10)]
+        for i, sock in enumerate(sockets):
+            chat_connections(sock, i)
+
+        started = asyncio.get_running_loop().time()
+        accepted = ws.broadcast(1, "payload")
+        elapsed = asyncio.get_running_loop().time() - started
+        await asyncio.sleep(0.3)
+
+        assert accepted == 10
+        assert elapsed < 0.05
+        assert all(sock.sent == ["payload"] for sock in sockets)
+
+    @pytest.mark.asyncio
+    async def test_excludes_sender(self, chat_connections):
+        sender = FakeWebSocket()
+        other = FakeWebSocket()
+        chat_connections(sender, 1)
+        chat_connections(other, 2)
+
+        ws.broadcast(1, "payload", exclude_user_id=1)
+        await drain()
+
+        assert sender.sent == []
+        assert other.sent == ["payload"]
+
+
+class TestBatchFrames:
+    """Test how batched sends are framed for WebSocket clients."""
+
+    def test_one_frame_per_chat(self):
+        import json
+        from datetime import datetime
+        from app.messaging import chat_frames
+        from app.models import Message
+        now = datetime(2024, 1, 1)
+        messages = [
+            Message(id=1, chat_id=1, user_id=5, content="a", timestamp=now),
+            Message(id=2, chat_id=2, user_id=5, content="b", timestamp=now),
+            Message(id=3, chat_id=1, user_id=5, content="c", timestamp=now),
+        ]
+
+        frames = {chat_id: json.loads(frame) for chat_id, frame in chat_frames(messages, "bot").items()}
+
+        assert frames[1]["type"] == "message_batch"
+        assert [m["content"] for m in frames[1]["messages"]] == ["a", "c"]
+        # A lone message keeps the plain single-message shape
+        assert frames[2]["content"] == "b" and frames[2]["username"] == "bot"
+
+
+class TestConnectionQueue:
+    """Test the bounded outbound queue and its overflow policies."""
+
+    @pytest.mark.asyncio
+    async def test_preserves_order(self):
+        sock = FakeWebSocket()
+        conn = Connection(sock, 1)
+        conn.start()
+        for i in range(5):
+            conn.send(str(i))
+        await drain()
+
+        assert sock.sent == ["0", "1", "2", "3", "4"]
+        assert conn.sent == 5
+        await conn.close()
+
+    @pytest.mark.asyncio
+    async def test_drop_oldest(self):
+        sock = FakeWebSocket()
+        conn = Connection(sock, 1, max_queue=2, overflow_policy="drop_oldest")
+        # Writer not started: everything stays queued
+        for payload in ("a", "b", "c"):
+            assert conn.send(payload) is True
+
+        assert conn.queue_depth == 2
+        assert conn.dropped == 1
+        conn.start()
+        await drain()
+        assert sock.sent == ["b", "c"]
+        await conn.close()
+
+    @pytest.mark.asyncio
+    async def test_coalesce_replaces_queued_payload(self):
+        sock = FakeWebSocket()
+        conn = Connection(sock, 1, max_queue=4, overflow_policy="coalesce")
+        conn.send("typing:1", coalesce_key="typing")
+        conn.send("message")
+        conn.send("typing:2", coalesce_key="typing")
+
+        assert conn.queue_depth == 2
+        assert conn.coalesced == 1
+        conn.start()
+        await drain()
+        assert sock.sent == ["typing:2", "message"]
+        await conn.close()
+
+    @pytest.mark.asyncio
+    async def test_read_states_coalesce_per_reader(self):
+        sock = FakeWebSocket()
+        conn = Connection(sock, 1, max_queue=8, overflow_policy="coalesce", on_close=ws.remove_connection)
+        ws.register_connection(conn)
+        ws.subscribe(conn, [1])
+        await ws.publish_read_state(1, 2, 10)
+        await ws.publish_read_state(1, 3, 10)
+        await ws.publish_read_state(1, 2, 11)
+        await drain()
+
+        assert conn.queue_depth == 2
+        assert conn.coalesced == 1
+        conn.start()
+        await drain()
+        frames = [json.loads(frame) for frame in sock.sent]
+        assert [(f["type"], f["user_id"], f["last_read_message_id"]) for f in frames] == [
+            ("read", 2, 11), ("read", 3, 10),
+        ]
+        await conn.close()
+
+    @pytest.mark.asyncio
+    async def test_disconnect_slow_consumer(self):
+        sock = FakeWebSocket()
+        closed = []
+        conn = Connection(sock, 1, max_queue=1, overflow_policy="disconnect", on_close=closed.append)
+        assert conn.send("a") is True
+        assert conn.send("b") is False
+        await drain()
+
+        assert conn.closed
+        assert closed == [conn]
+        assert sock.close_code == 1013
+        assert conn.send("c") is False
+
+    def test_rejects_unknown_policy(self):
+        with pytest.raises(ValueError):
+            Connection(FakeWebSocket(), 1, overflow_policy="block")
+
+
+class TestBroadcastBus:
+    """Test the cross-worker broadcast backends."""
+
+    def test_event_round_trip(self):
+        from app.pubsub import Event, decode_event, encode_event
+        event = Event(7, '{"content": "multi\\nline"}\nraw', exclude_user_id=3, origin="w1", exclude_connection=9, seq=42)
+
+        decoded = decode_event(encode_event(event))
+
+        assert (decoded.chat_id, decoded.payload, decoded.exclude_user_id) == (7, event.payload, 3)
+        assert (decoded.origin, decoded.exclude_connection, decoded.seq) == ("w1", 9, 42)
+
+    @pytest.mark.asyncio
+    async def test_local_hub_reaches_every_worker(self):
+        from app.pubsub import Event, LocalBackend, LocalHub
+        hub = LocalHub()
+        received_a, received_b = [], []
+        worker_a = LocalBackend(received_a.append, hub)
+        worker_b = LocalBackend(received_b.append, hub)
+        await worker_a.start()
+        await worker_b.start()
+
+        await worker_a.publish(Event(1, "hello", exclude_user_id=5))
+
+        assert [e.payload for e in received_a] == ["hello"]
+        assert [e.payload for e in received_b] == ["hello"]
+        assert received_b[0].exclude_user_id == 5
+
+        await worker_b.stop()
+        await worker_a.publish(Event(1, "again"))
+        assert len(received_b) == 1
+
+    @pytest.mark.asyncio
+    async def test_connection_exclusion_only_applies_on_origin_worker(self, chat_connections):
+        from app.pubsub import Event
+        sender = FakeWebSocket()
+        other = FakeWebSocket()
+        sender_conn = chat_connections(sender, 1)
+        chat_connections(other, 2)
+
+        # The same connection id published by another worker refers to a
+        # different socket, so nothing is excluded here
+        ws.deliver_local(Event(1, "remote", origin="another-worker", exclude_connection=sender_conn.id))
+        await ws.publish(1, "local", exclude=sender_conn)
+        await drain()
+
+        assert sender.sent == ["remote"]
+        assert other.sent == ["remote", "local"]
+
+    def test_unknown_backend(self):
+        from app.pubsub import create_backend
+        with pytest.raises(ValueError):
+            create_backend(lambda event: None, "carrier-pigeon")
+
+    @pytest.mark.asyncio
+    async def test_redis_reader_resubscribes_after_failure(self):
+        from app.pubsub import Event, RedisBackend, encode_event
+        received = []
+
+        class FakePubSub:
+            def __init__(self, messages):
+                self.messages = messages
+
+            async def subscribe(self, channel):
+                pass
+
+            async def listen(self):
+                for message in self.messages:
+                    if isinstance(message, Exception):
+                        raise message
+                    yield message
+
+            async def reset(self):
+                pass
+
+        def handler(event):
+            if event.payload == "bad":
+                raise RuntimeError("handler failed")
+            received.append(event.payload)
+
+        class FakeClient:
+            def pubsub(self):
+                return FakePubSub([{"type": "message", "data": encode_event(Event(1, "after reconnect"))}])
+
+        backend = RedisBackend(handler)
+        backend.RETRY_MIN_SECONDS = 0
+        backend._client = FakeClient()
+        first = FakePubSub([
+            {"type": "message", "data": encode_event(Event(1, "bad"))},
+            {"type": "message", "data": encode_event(Event(1, "before"))},
+            ConnectionError("connection lost"),
+        ])
+        reader = asyncio.ensure_future(backend._read(first))
+        await drain()
+        reader.cancel()
+
+        assert received[:2] == ["before", "after reconnect"]
+
+    @pytest.mark.asyncio
+    async def test_postgres_spooled_events_keep_notify_order(self):
+        from app.pubsub import Event, PostgresBackend, encode_event
+        received = []
+
+        class FakePool:
+            async def fetchval(self, query, spool_id):
+                # Yields, so a racing dispatcher would let "inline" overtake
+                await asyncio.sleep(0)
+                if spool_id == 2:
+                    raise ConnectionError("pool closed")
+                return encode_event(Event(1, "spooled"))
+
+        backend = PostgresBackend(lambda event: received.append(event.payload), "postgresql://unused")
+        backend._pool = FakePool()
+        dispatcher = asyncio.ensure_future(backend._dispatch_in_order())
+        for data in ("@1", encode_event(Event(1, "inline")), "@2", encode_event(Event(1, "after failure"))):
+            backend._on_notify(None, 0, backend.channel, data)
+        await drain()
+        dispatcher.cancel()
+
+        assert received == ["spooled", "inline", "after failure"]
+
+    @pytest.mark.asyncio
+    async def test_failed_start_is_retried(self):
+        from app.pubsub import RedisBackend
+        attempts = []
+
+        async def start():
+            attempts.append(None)
+            if len(attempts) == 1:
+                raise ConnectionError("server down")
+
+        backend = RedisBackend(lambda event: None)
+        with pytest.raises(ConnectionError):
+            await backend._start_once(start)
+        await backend._start_once(start)
+        await backend._start_once(start)
+
+        assert len(attempts) == 2
+
+    def test_postgres_backend_rejects_pgbouncer(self, monkeypatch):
+        from app import db
+        from app.pubsub import create_backend
+        monkeypatch.setattr(db, "SQLALCHEMY_DATABASE_URL", "postgresql+psycopg2://u:p@pgbouncer/messenger")
+        monkeypatch.setattr(db, "DB_PGBOUNCER", True)
+        with pytest.raises(ValueError, match="PgBouncer"):
+            create_backend(lambda event: None, "postgres")
+
+
+class TestSubscriptions:
+    """Test the multiplexed per-user socket."""
+
+    @pytest.mark.asyncio
+    async def test_legacy_chat_socket_requires_membership(self, simple_async_client):
+        from tests.unit.test_query_performance import register_and_login
+        _, owner_headers = await register_and_login(simple_async_client, "ws_legacy_owner")
+        _, outsider_headers = await register_and_login(simple_async_client, "ws_legacy_outsider")
+        chat_id = (await simple_async_client.post("/api/chats/", params={"name": "Private"}, headers=owner_headers)).json()["id"]
+        sock = FakeWebSocket()
+
+        await ws.serve_connection(sock, outsider_headers["Authorization"].split()[1], chat_id)
+
+        assert sock.close_code == 1008
+        assert sock.sent == []
+        assert chat_id not in ws.chat_users
+
+    @pytest.mark.asyncio
+    async def test_fan_out_follows_subscriptions(self, chat_connections):
+        sock = FakeWebSocket()
+        conn = chat_connections(sock, 1, chat_id=10)
+        ws.subscribe(conn, [11])
+
+        ws.broadcast(10, "a")
+        ws.broadcast(11, "b")
+        ws.unsubscribe(conn, [10])
+        ws.broadcast(10, "c")
+        ws.broadcast(12, "d")
+        await drain()
+
+        assert sock.sent == ["a", "b"]
+        assert 10 not in ws.chat_users
+        assert ws.chat_users[11] == {1: 1}
+
+    @pytest.mark.asyncio
+    async def test_closing_one_socket_keeps_the_users_others(self, chat_connections):
+        first, second = FakeWebSocket(), FakeWebSocket()
+        first_conn = chat_connections(first, 1, chat_id=20)
+        chat_connections(second, 1, chat_id=20)
+        assert ws.chat_users[20] == {1: 2}
+
+        await first_conn.close()
+        ws.broadcast(20, "still here")
+        await drain()
+
+        assert ws.chat_users[20] == {1: 1}
+        assert first.sent == [] and second.sent == ["still here"]
+
+    @pytest.mark.asyncio
+    async def test_subscribe_frame_checks_membership(self, simple_async_client):
+        import json
+        from app.dependencies import CurrentUser
+        from tests.unit.test_query_performance import register_and_login
+        user_id, headers = await register_and_login(simple_async_client, "ws_subscriber")
+        mine = (await simple_async_client.post("/api/chats/", params={"name": "Mine"}, headers=headers)).json()["id"]
+        _, other_headers = await register_and_login(simple_async_client, "ws_stranger")
+        theirs = (await simple_async_client.post("/api/chats/", params={"name": "Theirs"}, headers=other_headers)).json()["id"]
+        sock = FakeWebSocket()
+        conn = Connection(sock, user_id, on_close=ws.remove_connection)
+        conn.start()
+        ws.register_connection(conn)
+        user = CurrentUser(user_id, "ws_subscriber")
+
+        await ws.handle_frame(conn, user, json.dumps({"type": "subscribe", "chat_ids": [mine, theirs]}))
+        await ws.handle_frame(conn, user, json.dumps({"type": "subscribe", "chat_ids": "all"}))
+        await drain()
+
+        subscribed, error = [json.loads(frame) for frame in sock.sent]
+        assert subscribed == {"type": "subscribed", "chat_ids": [mine], "denied": [theirs]}
+        assert error["type"] == "error"
+        assert conn.chats == {mine}
+        await conn.close()
+        assert mine not in ws.chat_users
+
+
+class TestSendFrames:
+    """Test sending messages over the WebSocket protocol."""
+
+    async def _setup(self, client, chat_connections, username):
+        from app.dependencies import CurrentUser
+        from tests.unit.test_query_performance import register_and_login
+        user_id, headers = await register_and_login(client, username)
+        chat = await client.post("/api/chats/", params={"name": "Socket chat"}, headers=headers)
+        chat_id = chat.json()["id"]
+        sender, other = FakeWebSocket(), FakeWebSocket()
+        sender_conn = chat_connections(sender, user_id, chat_id=chat_id)
+        chat_connections(other, user_id + 1, chat_id=chat_id)
+        return CurrentUser(user_id, username), chat_id, headers, sender, sender_conn, other
+
+    @pytest.mark.asyncio
+    async def test_send_is_persisted_acked_and_fanned_out(self, simple_async_client, chat_connections):
+        import json
+        user, chat_id, headers, sender, sender_conn, other = await self._setup(
+            simple_async_client, chat_connections, "ws_sender"
+        )
+
+        await ws.handle_frame(sender_conn, user, json.dumps(
+            {"type": "send", "client_id": "c1", "chat_id": chat_id, "content": "over the socket"}
+        ))
+        await drain()
+
+        ack = json.loads(sender.sent[0])
+        assert ack["type"] == "ack" and ack["client_id"] == "c1" and ack["timestamp"]
+        [delivered] = [json.loads(frame) for frame in other.sent]
+        assert delivered["type"] == "message"
+        assert (delivered["id"], delivered["content"], delivered["username"]) == (ack["id"], "over the socket", "ws_sender")
+        history = (await simple_async_client.get(f"/api/messages/{chat_id}", headers=headers)).json()
+        assert [m["id"] for m in history] == [ack["id"]]
+
+    @pytest.mark.asyncio
+    async def test_resent_client_id_is_not_duplicated(self, simple_async_client, chat_connections):
+        import json
+        user, chat_id, headers, sender, sender_conn, other = await self._setup(
+            simple_async_client, chat_connections, "ws_retry"
+        )
+        frame = json.dumps({"type": "send", "client_id": 7, "chat_id": chat_id, "content": "once"})
+
+        await ws.handle_frame(sender_conn, user, frame)
+        await ws.handle_frame(sender_conn, user, frame)
+        await drain()
+
+        assert sender.sent[0] == sender.sent[1]
+        assert len(other.sent) == 1
+        history = (await simple_async_client.get(f"/api/messages/{chat_id}", headers=headers)).json()
+        assert len(history) == 1
+
+    @pytest.mark.asyncio
+    async def test_invalid_frames_get_errors(self, simple_async_client, chat_connections):
+        import json
+        from tests.unit.test_query_performance import register_and_login
+        user, chat_id, _, sender, sender_conn, other = await self._setup(
+            simple_async_client, chat_connections, "ws_invalid"
+        )
+        _, owner_headers = await register_and_login(simple_async_client, "ws_invalid_owner")
+        foreign = await simple_async_client.post("/api/chats/", params={"name": "Closed"}, headers=owner_headers)
+        foreign_id = foreign.json()["id"]
+
+        await ws.handle_frame(sender_conn, user, "not json")
+        await ws.handle_frame(sender_conn, user, json.dumps({"type": "shout", "client_id": "a"}))
+        await ws.handle_frame(sender_conn, user, json.dumps({"type": "send", "content": "no id"}))
+        await ws.handle_frame(sender_conn, user, json.dumps({"type": "send", "client_id": "b", "content": "  "}),
+                              default_chat_id=chat_id)
+        await ws.handle_frame(sender_conn, user, json.dumps(
+            {"type": "send", "client_id": "c", "chat_id": 99999, "content": "lost"}
+        ))
+        await ws.handle_frame(sender_conn, user, json.dumps(
+            {"type": "send", "client_id": "d", "chat_id": foreign_id, "content": "intruder"}
+        ))
+        await drain()
+
+        errors = [json.loads(frame) for frame in sender.sent]
+        assert [e["type"] for e in errors] == ["error"] * 6
+        assert [e["client_id"] for e in errors] == [None, "a", None, "b", "c", "d"]
+        assert errors[4]["detail"] == "Chat not found"
+        assert errors[5]["detail"] == "Not a member of this chat"
+        assert other.sent == []
+        history = await simple_async_client.get(f"/api/messages/{foreign_id}", headers=owner_headers)
+        assert history.json() == []
+
+
+class TestReplay:
+    """Test resuming a chat's event stream after a reconnect."""
+
+    def test_buffer_returns_events_after_last_seq(self):
+        from app.replay import ChatReplayBuffer
+        buffer = ChatReplayBuffer(3, first_seq=10)
+        for seq in (10, 12, 11, 12):
+            buffer.record(seq, f"m{seq}")
+
+        assert buffer.since(10) == ["m11", "m12"]
+        assert buffer.since(12) == []
+        # Nothing before the first recorded event is known
+        assert buffer.since(8) is None
+
+    def test_buffer_rolls_over(self):
+        from app.replay import ChatReplayBuffer
+        buffer = ChatReplayBuffer(2, first_seq=1)
+        for seq in (1, 2, 3):
+            buffer.record(seq, f"m{seq}")
+
+        assert buffer.since(1) == ["m2", "m3"]
+        assert buffer.since(0) is None
+
+    def test_buffers_are_bounded_by_chat_count(self):
+        from app.replay import ReplayBuffers
+        buffers = ReplayBuffers(buffer_size=5, max_chats=2)
+        buffers.record(1, 1, "a")
+        buffers.record(2, 2, "b")
+        buffers.record(1, 3, "c")
+        buffers.record(3, 4, "d")
+
+        assert len(buffers) == 2
+        assert buffers.since(2, 0) is None
+        assert buffers.since(1, 1) == ["c"]
+
+    async def _setup(self, client, username, count):
+        from app.dependencies import CurrentUser
+        from tests.unit.test_query_performance import register_and_login
+        user_id, headers = await register_and_login(client, username)
+        chat_id = (await client.post("/api/chats/", params={"name": "Replay"}, headers=headers)).json()["id"]
+        ids = []
+        for i in range(count):
+            response = await client.post("/api/messages/", json={"chat_id": chat_id, "content": f"m{i}"}, headers=headers)
+            ids.append(response.json()["id"])
+        sock = FakeWebSocket()
+        conn = Connection(sock, user_id, on_close=ws.remove_connection)
+        conn.start()
+        ws.register_connection(conn)
+        return CurrentUser(user_id, username), chat_id, ids, sock, conn
+
+    @pytest.mark.asyncio
+    async def test_resubscribe_replays_missed_events_from_buffer(self, simple_async_client):
+        import json
+        user, chat_id, ids, sock, conn = await self._setup(simple_async_client, "ws_resume", 3)
+        await drain()
+
+        await ws.handle_frame(conn, user, json.dumps(
+            {"type": "subscribe", "chat_ids": [chat_id], "last_seq": {str(chat_id): ids[0]}}
+        ))
+        await drain()
+
+        subscribed, *replayed = [json.loads(frame) for frame in sock.sent]
+        assert subscribed["type"] == "subscribed"
+        assert [m["id"] for m in replayed] == ids[1:]
+        await conn.close()
+
+    @pytest.mark.asyncio
+    async def test_rolled_over_buffer_falls_back_to_database(self, simple_async_client):
+        import json
+        user, chat_id, ids, sock, conn = await self._setup(simple_async_client, "ws_resume_db", 3)
+        await drain()
+        ws.replay_buffers.clear()
+
+        await ws.handle_frame(conn, user, json.dumps(
+            {"type": "subscribe", "chat_ids": [chat_id], "last_seq": {str(chat_id): ids[0]}}
+        ))
+        await drain()
+
+        _, batch = [json.loads(frame) for frame in sock.sent]
+        assert batch["type"] == "message_batch" and batch["chat_id"] == chat_id
+        assert [(m["id"], m["username"]) for m in batch["messages"]] == [(ids[1], "ws_resume_db"), (ids[2], "ws_resume_db")]
+        await conn.close()
+
+    @pytest.mark.asyncio
+    async def test_too_large_a_gap_asks_for_resync(self, simple_async_client, monkeypatch):
+        import json
+        user, chat_id, ids, sock, conn = await self._setup(simple_async_client, "ws_resync", 3)
+        await drain()
+        ws.replay_buffers.clear()
+        monkeypatch.setattr(ws, "WS_REPLAY_DB_LIMIT", 1)
+
+        await ws.handle_frame(conn, user, json.dumps(
+            {"type": "subscribe", "chat_ids": [chat_id], "last_seq": {str(chat_id): ids[0]}}
+        ))
+        await ws.handle_frame(conn, user, json.dumps(
+            {"type": "subscribe", "chat_ids": [chat_id + 1], "last_seq": [1]}
+        ))
+        await drain()
+
+        _, resync, error = [json.loads(frame) for frame in sock.sent]
+        assert resync == {"type": "resync", "chat_id": chat_id}
+        assert error["type"] == "error"
+        await conn.close()
+
+    @pytest.mark.asyncio
+    async def test_gap_reaching_into_archive_asks_for_resync(self, simple_async_client, tmp_path, monkeypatch):
+        import json
+        from app.archive import MessageArchive
+        user, chat_id, ids, sock, conn = await self._setup(simple_async_client, "ws_resume_archive", 3)
+        await drain()
+        ws.replay_buffers.clear()
+        archive = MessageArchive(str(tmp_path), codec="zlib", enabled=True)
+        archive.append(chat_id, [(ids[1], b"{}")])
+        monkeypatch.setattr(ws, "message_archive", archive)
+
+        await ws.handle_frame(conn, user, json.dumps(
+            {"type": "subscribe", "chat_ids": [chat_id], "last_seq": {str(chat_id): ids[0]}}
+        ))
+        await drain()
+
+        _, resync = [json.loads(frame) for frame in sock.sent]
+        assert resync == {"type": "resync", "chat_id": chat_id}
+        await conn.close()